@@ -6,10 +6,20 @@
 
 import numpy as np
 import matplotlib.pyplot as plt
+import os
+import shutil
 from .dict_manip import *
+from .dict_cache import DictCache, seq_hash_name, grid_hash_name, backend_of, copy_entries
+from .helpers import update_hash
+from .svd import StreamingSVD, stats_name as svd_stats_name, FINALIZED
+from hashlib import sha256
 from .sim_blocks import *
 from .pb import create_pb, refresh_pb, finish_pb
+from .timeline import SequenceTimeline
+from .template import SequenceTemplate
 from copy import deepcopy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 M_init = np.array([0.0, 0.0, 1.0, 1.0])
 
@@ -32,6 +42,14 @@ class MRFSim:
                     SimObj that was last run, and is used as the starting magnetization for the
                     next SimObj to be run. When this class is first instantiated, M_cur is set to
                     M_cur = [0 0 1 1].
+        samples:    The (num_samples, ) samples of the current run. This buffer is allocated
+                    once by setup() and every run writes into it (see run_one_np()), so it
+                    must be copied if it is kept past the next run.
+        sample_offsets: Index in samples of the first sample of each SimObj
+        timeline:   The fields of the whole sequence in contiguous arrays (see get_timeline()),
+                    or None when they have to be gathered again
+        template:   The compiled sequence (see get_template()), or None when it has to be
+                    compiled again
 
     Crucial Methods:
         __init__():     Creates a new instance of the MRFSim class.
@@ -57,6 +75,8 @@ class MRFSim:
         self.sample_times = np.array([])
 
         self.sims = []
+        self.timeline = None
+        self.template = None
 
 
     def add_sim(self, SimObj):
@@ -69,6 +89,8 @@ class MRFSim:
 
         self.sims.append(SimObj)
         self.num_sim += 1
+        self.timeline = None
+        self.template = None
 
 
     def clear(self, M_start=M_init):
@@ -80,6 +102,8 @@ class MRFSim:
         self.cur_sim = 0
         self.num_sim = 0
         self.M_cur = M_start
+        self.timeline = None
+        self.template = None
 
 
     def set_control(self):
@@ -101,49 +125,25 @@ class MRFSim:
     def setup(self):
         """
         Helper method that does the following for each SimObj in the list:
-            runs set_gradients() to incorporate the gradients into the sim
-            runs set_rf() to incorporate the RF pulses into the sim
-            runs set_s_sig() (see SimObj.set_s_sig() for details)
+            computes B(t) (gradients and RF pulses), s(t) (see SimObj.set_s_shape() for
+            details) and the time grid from scratch (see update_fields())
+            collects the sample times and the number of samples
+            allocates the sample buffer (see run_one_np())
         """
-        # Initialize an empty queue of bolus times
-        time_queue = []
-
-        T = 0.0
-        self.num_samples = 0
-
-        for sim in self.sims:
-            # Compute and store gradients (Integrate them into B(t))
-            sim.set_gradients()
-
-            # Compute and store the RF pulses (Integrate them into B(t))
-            sim.set_rf(self.params)
-
-            # Store the sample times (w.r. to the whole pulse sequence)
-            if np.size(sim.sample_times) != 0:
-                if sim.avg_samples:
-                    # In this case, the sim block will return one number for the
-                    # average of all samples in the block. In that case we just
-                    # choose the first sample time as a representation of when the samples
-                    # started.
-                    #                                                                 |
-                    #                                                    Hence the [0]V
-                    self.sample_times = np.append(self.sample_times, sim.sample_times[0] + T)
-                else:
-                    # Here we keep all of the samples.
-                    self.sample_times = np.append(self.sample_times, sim.sample_times + T)
-
-            # We add an entry to the time queue (if there is one)
-            time_queue = sim.set_s_shape(time_queue, self.params.BAT)
+        # Compute B(t) and s(t) of every block from scratch (see update_fields())
+        self.update_fields(force=True)
 
-            # Scale the s(t) function based on our furrent parameters M0, BAT, T1_b, F, lambda, alpha
-            sim.scale_s(self.params.F, self.params.lam, self.params.alpha, self.params.M0_f, self.params.BAT, self.params.T1_b)
+        # Store the sample times (w.r. to the whole pulse sequence). A block that averages
+        # its samples returns one number, represented by the time of its first sample.
+        self.sample_times = self.get_timeline().get_sample_times()
 
-            # Reoptimize the simulated timepoints
-            sim.optimize_time()
+        # Add to simulation constants
+        num_samples = np.array([sim.num_samples for sim in self.sims], dtype=int)
+        self.sample_offsets = np.cumsum(num_samples) - num_samples
+        self.num_samples = int(np.sum(num_samples))
 
-            # Add to simulation constants
-            T += sim.T
-            self.num_samples += sim.num_samples
+        # Every run writes its samples here (see run_one_np())
+        self.samples = np.zeros(self.num_samples)
 
 
     def compute_s(self):
@@ -153,7 +153,7 @@ class MRFSim:
         time_queue = []
 
         for sim in self.sims:
-            time_queue = sim.set_s_shape(time_queue, self.params)
+            time_queue = sim.set_s_shape(time_queue, self.params.BAT)
             sim.scale_s(self.params.F, self.params.lam, self.params.alpha, self.params.M0_f, self.params.BAT, self.params.T1_b)
 
     
@@ -270,11 +270,12 @@ class MRFSim:
         # and use it as the starting magnetization for the next sim (M_cur)
         self.M_cur = self.sims[self.cur_sim].M[-1, :]
 
-        # Get the samples from the current simulation and ass them to the array
-        # of all samples, as well as the time in which they were taken w.r. to
-        # the pulse sequence
-        if np.size(self.sims[self.cur_sim].sample_times) != 0:
-            self.samples = np.append(self.samples, self.sims[self.cur_sim].sample(self.params.CBV))
+        # Get the samples from the current simulation and write them to their place
+        # in the buffer of all samples (allocated by setup())
+        sim = self.sims[self.cur_sim]
+        if sim.num_samples != 0:
+            start = self.sample_offsets[self.cur_sim]
+            sim.sample(self.params.CBV, out=self.samples[start:start + sim.num_samples])
             #self.sample_times = np.append(self.sample_times, self.sims[self.cur_sim].sample_times + self.cur_time)
 
         # Increment the current time
@@ -293,58 +294,266 @@ class MRFSim:
             self.run_one_np()
 
 
+    def update_fields(self, force=False):
+        """
+        This method brings B(t), s(t) and the time grid of every block up to date with the
+        current values of self.params. Each block declares which parameters its fields depend
+        on (see SimObj.get_depends()), and only the fields whose inputs changed since the last
+        call are recomputed (see SimObj.update_fields()), so e.g. a new BAT does not rebuild any
+        RF waveform, and a new flip angle only rebuilds the B field of the readout blocks.
+
+        Input Parameters:
+            force:      Recompute every field of every block
+        """
+        # Blocks before the first labeling block never see a bolus. Changing which blocks
+        # label changes the queue of every block after them, so everything is redone.
+        labels = tuple(sim.adds_bolus() for sim in self.sims)
+        if labels != getattr(self, "labels", None):
+            force = True
+        self.labels = labels
+
+        time_queue = []
+        labeled = False
+        for sim, label in zip(self.sims, labels):
+            labeled = labeled or label
+            time_queue = sim.update_fields(self.params, time_queue, labeled, force)
+
+        # The timeline and the compiled sequence were built from the old fields
+        if any(sim.updated for sim in self.sims):
+            self.timeline = None
+            self.template = None
+
+        self.params.recompute_s = False
+        self.params.rescale_s = False
+        self.params.recompute_B = False
+
+
     def optimize_time(self):
+        self.timeline = None
+        self.template = None
         for sim in self.sims:
             sim.optimize_time()
 
     def reset_time(self):
+        self.timeline = None
+        self.template = None
         for sim in self.sims:
             sim.reset_fields()
         
-    # FOR NEXT COMMIT
-    def generate_dict(self, dict_filename):
+    def get_seq_hash(self, paired=False):
+        """
+        This method returns a hash of the pulse sequence (the description of every block, see
+        SimObj.describe()) and of the simulation constants held in self.params. Two simulators
+        with the same hash produce the same entry for the same parameter values. Paired
+        dictionaries (see generate_dict()) hold other entries, so they get another hash.
+        """
+        h = sha256()
+        update_hash(h, [sim.describe() for sim in self.sims])
+        update_hash(h, self.params.get_consts())
+        if paired:
+            update_hash(h, "paired")
+        return h.hexdigest()
+
+
+    def generate_dict(self, dict_filename, flush_every=100, backend="hdf5", cache_dir=None, svd_rank=None, svd_max_rank=None, svd_only=False, batch_rf=False, paired=False, fused=False, threads=None, chunk_size=16):
+        """
+        This method loops over every combination of parameters held in self.params, simulates
+        the pulse sequence for each one, and stores the samples in a dictionary file (see
+        dict_manip.py).
+
+        If self.params.resume() was called beforehand, the existing file is reused and only
+        the entries that are not yet marked as done in its completion bitmap are simulated.
+        dict_filename must then be the file that was resumed. Once the dictionary is complete,
+        the next call starts a new one.
+
+        The file is kept open in SWMR mode for the whole run and flushed every flush_every
+        entries, so it can be read with a DictReader while it is being generated.
+
+        backend selects how the dictionary is stored: "hdf5" (a single file) or "memmap"
+        (a directory holding raw .npy files and a JSON sidecar, see dict_memmap.py). Use
+        dict_manip.convert_dict() to go from one to the other.
+
+        The dictionary records a hash of the sequence and one of the parameter grid (see
+        dict_cache.py). If cache_dir is given, a complete cached dictionary with the same
+        hashes is simply copied to dict_filename, any entries that cached dictionaries of the
+        same sequence already hold are copied over instead of simulated, and the finished
+        dictionary is added to the cache.
+
+        If svd_rank is given, a streaming SVD of the entries is computed as they are simulated
+        (see svd.py): the coefficients of each entry are stored in the "svd_coeffs" channel and
+        the rank-svd_rank basis is written once the dictionary is complete, when the channel is
+        cut down to svd_rank coefficients per entry (read it back with svd.load_svd()). svd_max_rank is the size of the working basis (see StreamingSVD). If
+        svd_only is True, the full entries are not stored at all, only the coefficients. The
+        streaming SVD can't be combined with cache_dir, since cached entries would not be
+        part of it.
+
+        If batch_rf is True, the entries that only differ by their flip angle and B1 scale are
+        simulated together, in one batched pass (see simulate_rf_batch()), so that a dictionary
+        with many flip angles or B1 scales costs about the same as one with a single value.
+
+        If paired is True, the label and control versions of the sequence are simulated
+        together for every entry (see simulate_paired()). The entries of the dictionary are
+        then the difference (label - control) fingerprints, and the label and control
+        fingerprints are stored in the "label" and "control" channels.
+
+        If fused is True, every entry is simulated by one call of the LJN simulator on the whole
+        compiled sequence (see compile_sequence()) instead of one call per block (see
+        run_all_np()). batch_rf and paired always run that way.
+
+        If threads is given, the entries are simulated by a pool of that many threads, in chunks
+        of chunk_size entries (see run_threaded()). This only pays off if the simulator releases
+        the GIL for a large enough part of each entry (see np_blochsim_ljn_batch()). The threads
+        always run the fused numpy LJN kernel on the compiled sequence (see template.py),
+        whatever fused is, so the entries match those of fused=True.
+        """
+        resume_name = self.params.resume_name
+        if (resume_name is not None) and (os.path.abspath(resume_name) != os.path.abspath(dict_filename)):
+            raise ValueError(f"Error: Resuming {resume_name}, can't generate {dict_filename}. Call params.resume() on it instead")
+
         # Initialize params so that we can iterate over it
         iter(self.params)
 
-        # Initialize the dictionary file
-        init_dict(dict_filename, self.params, np.size(self.sample_times))
+        if paired and not any(sim.adds_bolus() for sim in self.sims):
+            raise ValueError("Error: No block of the sequence labels a bolus, the label and control fingerprints would be the same")
+
+        hashes = {seq_hash_name: self.get_seq_hash(paired), grid_hash_name: self.params.get_grid_hash()}
+        cache = None if cache_dir is None else DictCache(cache_dir)
+
+        if (cache is not None) and self.params.is_constrained():
+            raise ValueError("Error: Constrained grids can't be combined with a dictionary cache")
+
+        svd = None
+        if svd_rank is not None:
+            if cache is not None:
+                raise ValueError("Error: The streaming SVD can't be combined with a dictionary cache")
+            svd = StreamingSVD(np.size(self.sample_times), svd_rank, svd_max_rank)
+        elif svd_only:
+            raise ValueError("Error: svd_only requires svd_rank")
+
+        pair_channels = {label_name: np.size(self.sample_times), control_name: np.size(self.sample_times)} if paired else {}
+
+        if self.params.done is not None:
+            # Make sure that the file we resume holds the same kind of dictionary
+            with open_reader(dict_filename) as r:
+                file_hashes = r.get_hashes()
+                num_samples = r.num_samples
+                channels = r.get_channels()
+                has_svd = svd_stats_name in r.aux_names()
+
+            if file_hashes.get(seq_hash_name, hashes[seq_hash_name]) != hashes[seq_hash_name]:
+                raise ValueError("Error: The dictionary was generated with a different pulse sequence, simulation constants or paired setting")
+            if paired != (label_name in channels):
+                raise ValueError(f"Error: The dictionary was generated with paired={not paired}, resume it with the same setting")
+            if (svd is not None) != has_svd:
+                raise ValueError("Error: The dictionary was generated " + ("with" if svd is None else "without") + " a streaming SVD, resume it with the same svd_rank")
+            if num_samples != (0 if svd_only else np.size(self.sample_times)):
+                raise ValueError("Error: The dictionary does not have the same number of samples as this pulse sequence (or svd_only setting)")
+
+        if self.params.done is None:
+            if (cache is not None) and cache.fetch(hashes, dict_filename, backend):
+                # Already generated, nothing to do
+                return
+
+            # Initialize the dictionary file
+            if svd is None:
+                init_dict(dict_filename, self.params, np.size(self.sample_times), backend=backend, hashes=hashes, channels=pair_channels)
+            else:
+                num_samples = 0 if svd_only else np.size(self.sample_times)
+                init_dict(dict_filename, self.params, num_samples, backend=backend, hashes=hashes, channels={**svd.get_channels(), **pair_channels}, aux=svd.get_aux_shapes())
+        elif svd is not None:
+            # Pick up the SVD where it was left
+            svd.load(dict_filename)
+
+            if np.all(self.params.done):
+                # Every entry was stored, but the run was interrupted before the SVD was finalized
+                # (or compacted)
+                if not svd.stats[FINALIZED]:
+                    with open_writer(dict_filename) as writer:
+                        writer.aux = svd.get_aux()
+                        svd.finalize(writer)
+                svd.compact(dict_filename)
+                self.params.end_resume()
+                return
+        elif np.all(self.params.done):
+            # Nothing left to simulate
+            self.params.end_resume()
+            return
 
-        # Create Progress Bar
-        create_pb()
+        # Open the file for the whole run
+        writer = open_writer(dict_filename, flush_every=flush_every)
 
-        # Time re-op flag
-        reoptimize_time = True
+        if svd is not None:
+            # The SVD state is saved with every flush, together with the entries it describes
+            writer.aux = svd.get_aux()
 
-        # Do the actual looping now
-        try:
-            while True:
-                # Modify s(t) if needed
-                if self.params.recompute_s or self.params.recompute_B:
-                    self.reset_time()
-                    self.modify_flips()
-                    self.compute_s()
-                    reoptimize_time = True
+        if cache is not None:
+            # Copy over whatever the cache already has
+            self.params.done = cache.prefill(hashes, writer, self.params.get_vals(), self.params.done)
 
-                # if self.params.recompute_s:
-                #     self.compute_s()
-                #     reoptimize_time = True
+        def write_entry(idx, samples, control=None):
+            # Paired entries are stored as the difference, along with both fingerprints
+            pair = {}
+            if control is not None:
+                pair = {label_name: samples, control_name: control}
+                samples = samples - control
 
-                elif self.params.rescale_s:
-                    self.scale_s()
+            channels = {} if svd is None else svd.add(samples)
+            writer.write(idx, samples, **channels, **pair)
 
-                # if self.params.recompute_B:
-                #     self.modify_flips()
-                #     reoptimize_time = True
+        complete = False
 
-                if reoptimize_time:
-                    self.optimize_time()
-                    reoptimize_time = False
+        # Create Progress Bar
+        create_pb()
 
-                # Run simulations for the entire pulse sequence
-                self.run_all_np()
+        # Do the actual looping now
+        try:
+            if threads is not None:
+                # Raises StopIteration once every entry is written, as next() does
+                self.run_threaded(write_entry, threads, chunk_size, batch_rf, paired)
 
-                #Store samples
-                store_entry(dict_filename, self.params.get_cur_idx(), self.samples)
+            while True:
+                if batch_rf:
+                    # Every flip angle and B1 scale is simulated along with the first ones
+                    # (the batch is empty everywhere else, see Params.get_rf_batch())
+                    flips, B1s, inds = self.params.get_rf_batch()
+                    if len(inds) > 0:
+                        if paired:
+                            label, control = self.simulate_rf_batch(flips, B1s, paired=True)
+                            for idx, l, c in zip(inds, label, control):
+                                write_entry(idx, l, c)
+                        else:
+                            for idx, samples in zip(inds, self.simulate_rf_batch(flips, B1s)):
+                                write_entry(idx, samples)
+
+                        refresh_pb(min(1.0, self.params.get_comp_perc() * np.size(self.params.flip_vals) * np.size(self.params.B1_vals)))
+
+                    next(self.params)
+                    continue
+
+                if self.params.entry_done():
+                    # This entry is already in the file (we are resuming). The flags set
+                    # by next() accumulate, so the setup below still happens once we reach
+                    # an entry that is missing.
+                    next(self.params)
+                    continue
+
+                # Recompute whatever the new parameters change (B(t), s(t), time grid)
+                if self.params.recompute_s or self.params.recompute_B or self.params.rescale_s:
+                    self.update_fields()
+
+                if paired:
+                    # Label and control in one pass
+                    write_entry(self.params.get_store_idx(), *self.simulate_paired())
+                elif fused:
+                    # The whole sequence in one pass
+                    self.run_fused()
+                    write_entry(self.params.get_store_idx(), self.samples)
+                else:
+                    # Run simulations for the entire pulse sequence
+                    self.run_all_np()
+
+                    #Store samples
+                    write_entry(self.params.get_store_idx(), self.samples)
 
                 # Soft reset to prepare for the next run
                 self.soft_reset()
@@ -358,86 +567,486 @@ class MRFSim:
         except StopIteration:
             finish_pb()
             print("Dictionary Generation Complete!!")
+            complete = True
+
+            if svd is not None:
+                writer.flush()
+                svd.finalize(writer)
+
+        finally:
+            # Flushes whatever is left, even if we crashed
+            writer.close()
+
+        if complete:
+            if svd is not None:
+                svd.compact(dict_filename)
+
+            # The next call starts a new dictionary
+            self.params.end_resume()
+
+            if cache is not None:
+                cache.store(dict_filename, hashes)
+
+
+    def run_threaded(self, write_entry, threads, chunk_size=16, batch_rf=False, paired=False):
+        """
+        This method is the loop of generate_dict() (see there for batch_rf and paired) with the
+        entries simulated by a pool of threads.
+
+        The MRFSim, its blocks and self.params are only used by the calling thread: it walks
+        the grid, brings the fields up to date and compiles the sequence whenever they change
+        (see get_template()), and hands the entries to the pool in chunks. Each thread runs the
+        entries of a chunk against their read-only template, with a SimState of its own (see
+        template.py), so the threads share the sequence and nothing else. The entries are written
+        (by write_entry(idx, samples, control=None)) in order, by the calling thread, and at
+        most 2 * threads chunks are waiting to be written at any time.
+
+        The entries are always simulated with the fused numpy LJN kernel (see
+        SequenceTemplate.run()), never block by block (see run_all_np()).
+
+        Raises StopIteration once every entry is written (as next(self.params) does).
+        """
+        p = self.params
+
+        def run_chunk(chunk):
+            out = []
+            for template, point, flips, B1s in chunk:
+                state = template.new_state()
+                state.set_point_vals(point)
+                out.append(state.run_rf_batch(flips, B1s, paired))
+            return out
+
+        def write_chunk(inds, future):
+            for idx, out in zip(inds, future.result()):
+                if paired:
+                    for i, l, c in zip(idx, *out):
+                        write_entry(i, l, c)
+                else:
+                    for i, samples in zip(idx, out):
+                        write_entry(i, samples)
+
+        pending = deque()
+        chunk, inds = [], []
+        with ThreadPoolExecutor(threads) as pool:
+            try:
+                while True:
+                    if batch_rf:
+                        # See generate_dict()
+                        flips, B1s, idx = p.get_rf_batch()
+                        if len(idx) == 0:
+                            next(p)
+                            continue
+                        template = self.get_rf_template(flips, B1s)
+                        perc = min(1.0, p.get_comp_perc() * np.size(p.flip_vals) * np.size(p.B1_vals))
+                    else:
+                        if p.entry_done():
+                            next(p)
+                            continue
+                        template = self.get_template()
+                        flips, B1s, idx = [p.flip], [p.B1], [p.get_store_idx()]
+                        perc = p.get_comp_perc()
+
+                    chunk.append((template, tuple(getattr(p, n) for n in p.axis_names), flips, B1s))
+                    inds.append(idx)
+
+                    if len(chunk) == chunk_size:
+                        pending.append((inds, pool.submit(run_chunk, chunk)))
+                        chunk, inds = [], []
+
+                        while len(pending) > 2 * threads:
+                            write_chunk(*pending.popleft())
+
+                    refresh_pb(perc)
+                    next(p)
+
+            except StopIteration:
+                # The last chunk, and everything that is still running
+                if chunk:
+                    pending.append((inds, pool.submit(run_chunk, chunk)))
+                while pending:
+                    write_chunk(*pending.popleft())
+
+                raise
+
+
+    def extend_dict(self, dict_filename, flush_every=100, cache_dir=None, **new_vals):
+        """
+        This method adds parameter values to an existing dictionary, for example:
+
+            ps.extend_dict("dict.h5", T1_f=np.array([2200, 2400]), flip=30)
+
+        The parameter arrays stored in the dictionary are reused (whatever self.params holds is
+        replaced by them) and merged with the new values, keeping each axis sorted. The entries
+        of the existing dictionary are copied to their new position, and only the new entries
+        are simulated.
+
+        The extended dictionary is written next to the original one (same name with an
+        ".extending" suffix) and only replaces it once it is complete. If the extension is
+        interrupted, calling extend_dict() again with the same values picks it up where it
+        stopped (the ".extending" file is resumed, see Params.resume()) and then replaces the
+        original. A memory-mapped dictionary is renamed with an ".old" suffix while it is being
+        replaced, so one of the two is always there.
+
+        Constrained dictionaries (see Params.add_constraint()) can't be extended, since their
+        constraints are not stored with them, and neither can scattered ones (see adaptive.py
+        and pointset.py).
+
+        Input Parameters:
+            dict_filename:  Path of the existing dictionary (either backend)
+            flush_every:    See generate_dict()
+            cache_dir:      See generate_dict()
+            new_vals:       New values for any of the axes (see Params.axis_names)
+        """
+        with open_reader(dict_filename) as r:
+            vals = r.get_vals()
+            hashes = r.get_hashes()
+            num_samples = r.num_samples
+            channels = r.get_channels()
+            has_svd = svd_stats_name in r.aux_names()
+
+        if points_name in vals:
+            # Constrained grids store a table of their points just like scattered dictionaries
+            # do, and both only hold the distinct values of each axis, so they look the same
+            raise ValueError("Error: Dictionaries with a table of points (constrained grids, see Params.add_constraint(), or "
+                             "scattered dictionaries, see adaptive.py and pointset.py) can't be extended, the rule that picked "
+                             "their points is not stored with them. Generate them again with the new values")
+        if label_name in channels:
+            raise ValueError("Error: Paired dictionaries can't be extended, generate them again with the new values")
+        if has_svd:
+            raise ValueError("Error: Dictionaries generated with a streaming SVD can't be extended, the basis would not cover the new entries")
+
+        # Make sure that we are simulating the same thing as the original dictionary
+        if hashes.get(seq_hash_name, self.get_seq_hash()) != self.get_seq_hash():
+            raise ValueError("Error: The dictionary was generated with a different pulse sequence or simulation constants")
+        if num_samples != np.size(self.sample_times):
+            raise ValueError("Error: The dictionary does not have the same number of samples as this pulse sequence")
+
+        self.params.set_vals(vals)
+        self.params.extend_vals(**new_vals)
+
+        backend = backend_of(dict_filename)
+        tmp_filename = dict_filename.rstrip(os.sep) + ".extending"
+
+        new_hashes = {seq_hash_name: self.get_seq_hash(), grid_hash_name: self.params.get_grid_hash()}
+
+        tmp_hashes = None
+        if os.path.exists(tmp_filename):
+            with open_reader(tmp_filename) as r:
+                tmp_hashes = r.get_hashes()
+
+        if tmp_hashes == new_hashes:
+            # An earlier extension to the same values was interrupted, we pick it up
+            self.params.resume(tmp_filename)
+        else:
+            if tmp_hashes is not None:
+                # Left over by an interrupted extension to other values
+                shutil.rmtree(tmp_filename) if backend == "memmap" else os.remove(tmp_filename)
+
+            init_dict(tmp_filename, self.params, num_samples, backend=backend, hashes=new_hashes)
+
+            # Copy the existing entries to their new positions
+            with open_writer(tmp_filename) as w:
+                self.params.done = copy_entries(dict_filename, w, self.params.get_vals())
+            self.params.resume_name = tmp_filename
+
+        print(f"Extending dictionary: {np.count_nonzero(~self.params.done)} new entries to simulate")
+
+        # Simulate whatever is missing (generate_dict() skips the entries that are done)
+        self.generate_dict(tmp_filename, flush_every=flush_every, cache_dir=cache_dir)
+
+        # Replace the original
+        if backend == "memmap":
+            # A directory can't be renamed over another one, so the original is moved out of the
+            # way first (and only removed once the extended one is in place)
+            old_filename = dict_filename.rstrip(os.sep) + ".old"
+            if os.path.isdir(old_filename):
+                # Left over by an earlier extension that crashed before removing it
+                shutil.rmtree(old_filename)
+            os.replace(dict_filename, old_filename)
+            os.replace(tmp_filename, dict_filename)
+            shutil.rmtree(old_filename)
+        else:
+            os.replace(tmp_filename, dict_filename)
+
+
+    def generate_adaptive_dict(self, dict_filename, tol=0.01, max_level=3, max_entries=None, backend="hdf5"):
+        """
+        This method generates a scattered dictionary, starting from the grid of self.params and
+        refining it only where adjacent entries differ by more than tol (see adaptive.py for the
+        details and the inputs).
+        """
+        from .adaptive import generate_adaptive_dict
+        return generate_adaptive_dict(self, dict_filename, tol, max_level, max_entries, backend)
+
+
+    def simulate_point(self, inds):
+        """
+        This method simulates the single dictionary entry with the given parameter indices (see
+        Params.get_cur_idx()), outside of generate_dict(), and returns its samples. This is used
+        to fill in entries on demand (see match.CoarseToFineMatcher).
+
+        The next loop over self.params starts from the beginning again.
+        """
+        self.params.set_point(inds)
+
+        return self.run_point()
+
+
+    def simulate_vals(self, point):
+        """
+        This method simulates the pulse sequence for arbitrary parameter values (in the order of
+        Params.axis_names), which do not have to be on the grid of self.params, and returns the
+        samples. This is how scattered dictionaries are generated (see adaptive.py).
+
+        The next loop over self.params starts from the beginning again.
+        """
+        self.params.set_point_vals(point)
+
+        return self.run_point()
+
+
+    def simulate_rf_batch(self, flips, B1s, paired=False):
+        """
+        This method simulates the pulse sequence for the current parameters of self.params and a
+        batch of flip angles and B1 scales at once, and returns the (K, num_samples) samples
+        (or the label and control samples if paired, see simulate_paired()).
+
+        The RF field of every block is proportional to a known function of the flip angle and
+        B1 (see SimObj.get_rf_scale()), so the fields are computed once, for the largest flip
+        angle and B1 scale of the batch, and each member of the batch only scales them (see
+        SimObj.run_ljn_batch()).
+
+        Input Parameters:
+            flips:      (K, ) flip angles
+            B1s:        (K, ) B1 scales
+            paired:     Also simulate the control version of the sequence
+        """
+        template = self.get_rf_template(flips, B1s)
+
+        return template.run(self.params, template.get_rf_scales(flips, B1s), paired)
+
+
+    def get_rf_template(self, flips, B1s):
+        """
+        Returns the compiled sequence (see get_template()) for the current parameters of
+        self.params, with the fields of the largest flip angle and B1 scale of the batch, so that
+        every member of the batch is a scale of them (see simulate_rf_batch()).
+        """
+        p = self.params
+        for sim in self.sims:
+            if set(sim.B_depends) - {"flip", "B1"}:
+                raise ValueError(f"Error: The B field of {type(sim).__name__} blocks depends on {sim.B_depends}, only the flip angle and B1 can be batched")
+
+        flips = np.asarray(flips, dtype=np.float64)
+        B1s = np.asarray(B1s, dtype=np.float64)
+        flip, B1 = p.flip, p.B1
+
+        # The reference fields (a zero RF field could not be scaled up)
+        p.flip = flips[np.argmax(np.abs(flips))]
+        p.B1 = B1s[np.argmax(np.abs(B1s))]
+        template = self.get_template()
+
+        p.flip, p.B1 = flip, B1
+
+        return template
+
+
+    def simulate_paired(self):
+        """
+        This method simulates the label and control versions of the pulse sequence for the
+        current parameters of self.params at once, and returns their (num_samples, ) samples.
+
+        The label version is the sequence as it is (e.g. after set_label()), the control version
+        is the same sequence with every pCASL block in control. The two only differ by s(t),
+        which is 0 for the control version since no bolus is labeled (see pCASL.set_s_shape()),
+        so the fields and time grids are shared, and both are run as a batch of two (see
+        SequenceTemplate.run()).
+        """
+        label, control = self.get_template().run(self.params, np.ones((1, self.num_sim)), paired=True)
+
+        return label[0], control[0]
+
+
+    def compile_sequence(self):
+        """
+        This method packs the pulse sequence (the current fields of every block) into contiguous
+        arrays, so that it is simulated by one call of the batched LJN simulator instead of one
+        call per block (see template.py and simulators/np_blochsim_ljn.py). The first
+        timepoint of a block is the last one of the block before it, so the step into it is a
+        zero length step, without absorption or saturation, that leaves the magnetization as
+        it is.
+
+        Blocks that can't be fused (see SimObj.can_fuse) split the sequence: they are run on
+        their own, between the fused parts. B(t) and s(t) of the fused parts are slices of the
+        timeline (see get_timeline()), not copies.
+
+        Output Values:
+            Python list of the parts of the sequence, in order. Each part is a python dict
+            holding the range of blocks it covers ("start", "stop"), whether it is "fused", and
+            for fused parts:
+                "B", "s", "dts", "absorp", "s_sat":
+                                    Concatenated arrays, see np_blochsim_ljn_batch()
+                "block_lengths":    Number of timepoints of each block
+                "crusher_inds":     Indices of the crushers
+                "sample_inds":      Indices of the timepoints that are sampled
+                "sample_cols":      Index (in the samples of the sequence) of the sample each of
+                                    them goes to, several go to the same one when a block
+                                    averages its samples
+                "sample_weights":   Weight of each of them in that sample
+        """
+        timeline = self.get_timeline()
+
+        parts = []
+        for i, sim in enumerate(self.sims):
+            if sim.can_fuse and parts and parts[-1]["fused"]:
+                parts[-1]["stop"] = i + 1
+            else:
+                parts.append({"start": i, "stop": i + 1, "fused": sim.can_fuse})
+
+        for part in parts:
+            if not part["fused"]:
+                continue
+
+            sims = self.sims[part["start"]:part["stop"]]
+            lengths = np.array([sim.ntime for sim in sims])
+            offsets = np.cumsum(lengths) - lengths
+
+            part["B"] = timeline.B[timeline.block_range(part["start"], part["stop"])]
+            part["s"] = timeline.s[timeline.block_range(part["start"], part["stop"])]
+            part["dts"] = np.concatenate([sim.get_dts() for sim in sims])
+            part["absorp"] = np.repeat([float(sim.absorption) for sim in sims], lengths)
+            part["s_sat"] = np.repeat([float(sim.saturation) for sim in sims], lengths)
+            part["block_lengths"] = lengths
+
+            # Steps into the first timepoint of each block
+            for key in ("dts", "absorp", "s_sat"):
+                part[key][offsets] = 0
+
+            # Crushers at the first timepoint of a block are not applied (see np_blochsim_ljn_batch())
+            part["crusher_inds"] = np.concatenate([np.zeros(0, dtype=int)] + [o + sim.crusher_inds[sim.crusher_inds > 0] for o, sim in zip(offsets, sims)])
+
+            inds, cols, weights = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)], [np.zeros(0)]
+            for i, (o, sim) in enumerate(zip(offsets, sims)):
+                if sim.num_samples == 0:
+                    continue
+                n = len(sim.sample_inds)
+                col = self.sample_offsets[part["start"] + i]
+                inds.append(o + sim.sample_inds)
+                if sim.avg_samples:
+                    cols.append(np.full(n, col))
+                    weights.append(np.full(n, 1 / n))
+                else:
+                    cols.append(col + np.arange(n))
+                    weights.append(np.ones(n))
+
+            part["sample_inds"] = np.concatenate(inds)
+            part["sample_cols"] = np.concatenate(cols)
+            part["sample_weights"] = np.concatenate(weights)
+
+        return parts
+
+
+    def get_template(self):
+        """
+        This method brings the fields up to date with the current parameters of self.params
+        (see update_fields()) and returns the compiled sequence as a read-only SequenceTemplate
+        (see template.py), which any number of SimState objects can run at once. It is kept
+        until the fields of a block change.
+        """
+        self.update_fields()
+        if self.template is None:
+            self.template = SequenceTemplate(self, M_init)
+
+        return self.template
+
+
+    def run_fused(self):
+        """
+        This method runs the whole sequence for the current parameters of self.params with one
+        call of the simulator per fused part of the compiled sequence (see compile_sequence()),
+        instead of one per block (see run_all_np()), and leaves the samples in self.samples. The
+        fields are brought up to date (see get_template()). The magnetization of the blocks is
+        not kept, use run_all_np() to plot it.
+        """
+        self.samples[:] = self.get_template().run(self.params, np.ones((1, self.num_sim)))[0]
+
+
+    def run_point(self):
+        """
+        Helper method that runs the whole sequence for the current parameters of self.params
+        (see simulate_point()). Only the fields that the new parameters change are recomputed
+        (see update_fields()).
+        """
+        self.soft_reset()
+        self.update_fields()
+        self.run_all_np()
+
+        # The buffer is overwritten by the next run
+        samples = self.samples.copy()
+        self.soft_reset()
+        self.params.needs_setup = True
+
+        return samples
 
 
     def soft_reset(self):
+        # The sample buffer is kept, the next run overwrites every sample
         self.cur_sim = 0
         self.cur_time = 0
         self.M_cur = M_init
-        self.samples = np.array([])
         #self.sample_times = np.array([])
 
 
-    def get_times(self):
+    def get_timeline(self):
         """
-        Helper function that returns an array of time points accross all
-        SimObj blocks. The time array from each SimObj are combined in order
-        to create an array of all sample times throughout the entire simulation.
-
-        This is mainly used for plotting purposes. Once this array is calculated, 
-        it is stored in case it is needed later.
+        Returns the fields of the whole sequence in contiguous arrays (see timeline.py). The
+        timeline is built once and kept until the blocks or their fields change (see
+        update_fields()), the blocks hold views into it.
         """
+        if self.timeline is None:
+            self.timeline = SequenceTimeline(self.sims)
 
-        if hasattr(self, "time_vec"):
-            # We have already calculated this, nothing to do.
-            return self.time_vec
-        
-        cur_time = 0.0
-        self.time_vec = np.empty(0)
+        return self.timeline
 
-        for sim in self.sims:
-            self.time_vec = np.append(self.time_vec, sim.time + cur_time)
-            cur_time += sim.T
 
-        return self.time_vec
+    def get_times(self):
+        """
+        Helper function that returns an array of time points accross all
+        SimObj blocks, w.r. to the start of the sequence (see get_timeline()).
+
+        This is mainly used for plotting purposes.
+        """
+        return self.get_timeline().time
     
 
     def get_M(self):
         """
-        Helper method that concatenates the magnetization from each SimObj block
-        sequentially.
+        Helper method that returns the magnetization from each SimObj block
+        sequentially, as simulated by the last run (see run_all_np()).
 
-        This is mainly used for plotting purposes. Once this array is calculated, 
-        it is stored in case it is needed later.
+        This is mainly used for plotting purposes.
         """
-        M_out = np.empty((0, 4))
-
-        for sim in self.sims:
-            M_out = np.append(M_out, sim.M, axis=0)
-
-        return M_out
+        return self.get_timeline().gather_M()
     
 
     def get_B(self):
         """
-        Helper method that concatenates the effective B field array from each SimObj
-        block sequentially.
+        Helper method that returns the effective B field array from each SimObj
+        block sequentially (see get_timeline()).
 
-        This is mainly used for plotting purposes. Once this array is calculated, 
-        it is stored in case it is needed later.
+        This is mainly used for plotting purposes.
         """
-        B_out = np.empty((0, 3))
-
-        for sim in self.sims:
-            B_out= np.append(B_out, sim.B, axis=0)
-
-        return B_out
+        return self.get_timeline().B
 
 
     def get_s(self):
         """
-        Helper method that concatenates the arterial magnetization array from each 
-        SimObj block sequentially.
+        Helper method that returns the arterial magnetization array from each 
+        SimObj block sequentially (see get_timeline()).
 
-        This is mainly used for plotting purposes. Once this array is calculated, 
-        it is stored in case it is needed later.
+        This is mainly used for plotting purposes.
         """
-        s_out = np.empty((0,))
-
-        for sim in self.sims:
-            s_out= np.append(s_out, sim.s, axis=0)
-
-        return s_out
+        return self.get_timeline().s
 
 
     def plot_B(self, dsample=1, ylim=[]):
@@ -447,12 +1056,12 @@ class MRFSim:
         """
 
         # Get the things to plot
-        self.get_times()
+        time_vec = self.get_times()
         B = self.get_B()
 
-        plt.plot(self.time_vec[::dsample ], B[::dsample, 0], label = 'x')
-        plt.plot(self.time_vec[::dsample ], B[::dsample, 1], label = 'y')
-        plt.plot(self.time_vec[::dsample ], B[::dsample, 2], label = 'z')
+        plt.plot(time_vec[::dsample ], B[::dsample, 0], label = 'x')
+        plt.plot(time_vec[::dsample ], B[::dsample, 1], label = 'y')
+        plt.plot(time_vec[::dsample ], B[::dsample, 2], label = 'z')
         if not ylim == []:
             plt.ylim(ylim)
         plt.xlabel("Time [ms]")
@@ -469,13 +1078,13 @@ class MRFSim:
         """
 
         # Get the things to plot
-        self.get_times()
+        time_vec = self.get_times()
         M = self.get_M()
 
-        plt.plot(self.time_vec[::dsample ], M[::dsample, 0], label = 'x tissue')
-        plt.plot(self.time_vec[::dsample ], M[::dsample, 1], label = 'y tissue')
-        plt.plot(self.time_vec[::dsample ], M[::dsample, 2], label = 'z tissue')
-        plt.plot(self.time_vec[::dsample ], M[::dsample, 3], label = 'semisolid')
+        plt.plot(time_vec[::dsample ], M[::dsample, 0], label = 'x tissue')
+        plt.plot(time_vec[::dsample ], M[::dsample, 1], label = 'y tissue')
+        plt.plot(time_vec[::dsample ], M[::dsample, 2], label = 'z tissue')
+        plt.plot(time_vec[::dsample ], M[::dsample, 3], label = 'semisolid')
         if not ylim == []:
             plt.ylim(ylim)
         plt.xlabel("Time [ms]")
@@ -491,10 +1100,10 @@ class MRFSim:
         """
 
         # Get the things to plot
-        self.get_times()
+        time_vec = self.get_times()
         s = self.get_s()
 
-        plt.plot(self.time_vec[::dsample ], s[::dsample], label = 's(t)')
+        plt.plot(time_vec[::dsample ], s[::dsample], label = 's(t)')
         if not ylim == []:
             plt.ylim(ylim)
         plt.xlabel("Time [ms]")
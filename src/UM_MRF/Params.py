@@ -7,8 +7,9 @@
 import numpy as np
 from numbers import Number
 import os
-import h5py
+from hashlib import sha256
 from .dict_manip import *
+from .helpers import update_hash
 
 
 
@@ -39,9 +40,11 @@ class Params:
     This class holds all simulation parameters that are not related layout and timing
     of the pulse sequence. 
     """
+    # Names of the iterated parameters, in the same order as get_cur_idx()
+    axis_names = ("CBV", "ks", "kf", "T1_f", "T2_f", "T1_s", "F", "alpha", "BAT", "flip", "B1")
 
 
-    def __init__(self, T1_f, T2_f, T1_s, ks, kf, F, lam, zvel, zpos_init, CBV, BAT, M0_f, M0_s, flip_angle, alpha = 0.86):
+    def __init__(self, T1_f, T2_f, T1_s, ks, kf, F, lam, zvel, zpos_init, CBV, BAT, M0_f, M0_s, flip_angle, alpha = 0.86, B1 = 1.0):
         """
         This method initializes an instance of the Params object. 
 
@@ -55,6 +58,8 @@ class Params:
             CBV:        Cerebral Blood Volume [unitless]
             BAT:        Bollus Arrival Time [ms]
             alpha:      Labelling efficiency [unitless]
+            B1:         B1+ scale, the factor by which every RF pulse is scaled (transmit field
+                        inhomogeneity) [unitless]
 
         Non-Iterable Input Parameters:
             lam:        Blood Brain Barrier Coeff [mL / g]
@@ -75,6 +80,7 @@ class Params:
         self.BAT_vals = arr_or_num(BAT)
         self.alpha_vals = arr_or_num(alpha)
         self.flip_vals = arr_or_num(flip_angle)
+        self.B1_vals = arr_or_num(B1)
 
         # Defining simulation constants
         self.T1_b = 1600                        # Blood T1 (set to the typical 1600 ms)   
@@ -106,11 +112,20 @@ class Params:
         self.CBV = self.CBV_vals[0]
         self.BAT = self.BAT_vals[0]
         self.flip = self.flip_vals[0]
+        self.B1 = self.B1_vals[0]
         # This way, we do not have to call iter() in any way to initialize
         # if the object doesnt have anything to iterate over anywqays.
         self.calc_R_T_vals()
         self.needs_setup = True
 
+        # Completion state, only set when resuming a dictionary (see resume())
+        self.done = None
+        self.resume_name = None
+
+        # Constraints on the grid (see add_constraint() and set_mask())
+        self.constraints = []
+        self.mask = None
+
 
     def __iter__(self):
         """
@@ -138,18 +153,10 @@ class Params:
         self.BAT_ind = 0
         self.alpha_ind = 0
         self.flip_ind = 0
+        self.B1_ind = 0
 
         # INITIALIZING CURRENT VALUES
-        self.T1_f = self.T1_f_vals[self.T1_f_ind]
-        self.T2_f = self.T2_f_vals[self.T2_f_ind]
-        self.T1_s = self.T1_s_vals[self.T1_s_ind]
-        self.alpha = self.alpha_vals[self.alpha_ind]
-        self.F = self.F_vals[self.F_ind]
-        self.ks = self.ks_vals[self.ks_ind]
-        self.kf = self.kf_vals[self.kf_ind]
-        self.CBV = self.CBV_vals[self.CBV_ind]
-        self.BAT = self.BAT_vals[self.BAT_ind]
-        self.flip = self.flip_vals[self.flip_ind]
+        self.set_cur_vals()
 
         # Calculating apparent Rs and Ts
         self.calc_R_T_vals()
@@ -159,33 +166,88 @@ class Params:
     
 
     def resume(self, name):
+        """
+        This method prepares the Params object to resume generating a partially completed
+        dictionary. The parameter values are loaded from the file, and the completion bitmap
+        is used to find exactly which entries still need to be simulated. Entries do not need
+        to have been completed in order, MRFSim.generate_dict() simply skips any entry that
+        is already marked as done.
+
+        Files written before the completion bitmap existed fall back to the stored cur_index,
+        in which case every entry up to (and including) that index is assumed to be done.
+
+        Both HDF5 and memory-mapped dictionaries (see dict_memmap.py) can be resumed.
+        """
         # Check if the dictionary exists
         if not os.path.exists(name):
             raise ValueError(f"Error: No dictionary found at path {name}")
         
-        file = h5py.File(name, "r")
+        with open_reader(name) as reader:
+            # Get the parameter values (and the valid points, for a constrained grid)
+            self.set_vals(reader.get_vals())
+
+            # Get the completed entries (see DictReader.done_mask() for older files)
+            done = reader.done_mask()
+
+        self.done = done
+        self.resume_name = name
+
         # Check if we have already finished
-        if not np.any(file[idx_name]):
+        if np.all(self.done):
             print("Nothing to do, we have already completed this dict")
+            self.needs_setup = False
             return
 
-        # Get the parameter values
-        self.T1_f_vals = file[T1f_name][:]
-        self.T2_f_vals = file[T2f_name][:]
-        self.T1_s_vals = file[T1s_name][:]
-        self.alpha_vals = file[alpha_name][:]
-        self.F_vals = file[F_name][:]
-        self.ks_vals = file[ks_name][:]
-        self.kf_vals = file[kf_name][:]
-        self.CBV_vals = file[CBV_name][:]
-        self.BAT_vals = file[BAT_name][:]
-        self.flip_vals = file[flip_name][:]
+        # Start from the first point (in iteration order) that has an entry missing
+        self.seek_first_missing()
 
-        # Set the indices
+        # Set the current Values
+        self.set_cur_vals()
 
-        self.set_inds(np.int32(file[idx_name][:]))
+        print(f"Resuming dictionary generation ({np.count_nonzero(self.done)} of {np.size(self.done)} entries done)\nPATH: {name}")
 
-        # Set the current Values
+        self.calc_R_T_vals()
+        self.recompute_s = True
+        self.rescale_s = False
+        self.recompute_B = True
+        self.needs_setup = False
+
+
+    def end_resume(self):
+        """
+        This method forgets the completion state of the dictionary that was resumed (see
+        resume()), once MRFSim.generate_dict() is done with it, so that the next dictionary is
+        generated from scratch. The next loop over the parameters starts from the beginning.
+        """
+        self.done = None
+        self.resume_name = None
+        self.needs_setup = True
+
+
+    def seek_first_missing(self):
+        """
+        Helper method that sets the current indices to the first flip angle and B1 scale of the
+        first point (in iteration order over the other parameters) that has an entry that is not
+        done (see resume()). The flip angle and B1 are the last parameters to be incremented, so
+        every entry before that one is done, and a batch of flip angles and B1 scales (see
+        get_rf_batch()), which is only formed there, holds every entry of the point that is
+        missing. On a constrained grid, the points that are left out count as done.
+        """
+        grid_done = self.done
+        if self.is_constrained():
+            grid_done = np.ones(self.get_num_combs(), dtype=bool)
+            grid_done[self.get_valid()] = self.done
+
+        shape = self.get_shape()
+        point_done = np.all(grid_done.reshape(shape), axis=(-2, -1))
+        first = np.argmin(point_done.ravel(order="F"))
+        self.set_inds(np.unravel_index(first, shape[:-2], order="F") + (0, 0))
+
+
+    def set_cur_vals(self):
+        """
+        Helper method that sets the current parameter values from the current indices.
+        """
         self.T1_f = self.T1_f_vals[self.T1_f_ind]
         self.T2_f = self.T2_f_vals[self.T2_f_ind]
         self.T1_s = self.T1_s_vals[self.T1_s_ind]
@@ -196,18 +258,193 @@ class Params:
         self.CBV = self.CBV_vals[self.CBV_ind]
         self.BAT = self.BAT_vals[self.BAT_ind]
         self.flip = self.flip_vals[self.flip_ind]
+        self.B1 = self.B1_vals[self.B1_ind]
 
-        print(f"Resuming dictionary generation from {100*self.get_comp_perc():.2f}%\nPATH: {name}")
 
-        self.calc_R_T_vals()
-        self.recompute_s = True
-        self.recompute_B = True
-        self.needs_setup = False
+    def get_vals(self):
+        """
+        Helper method that returns a python dict mapping the names used in the dictionary
+        file (see dict_manip.val_names) to the arrays of parameter values. On a constrained
+        grid, it also holds the table of the valid points (see dict_manip.get_dict_shape()),
+        so that the dictionary only stores those.
+        """
+        vals = {
+            CBV_name: self.CBV_vals,
+            ks_name: self.ks_vals,
+            kf_name: self.kf_vals,
+            T1f_name: self.T1_f_vals,
+            T2f_name: self.T2_f_vals,
+            T1s_name: self.T1_s_vals,
+            F_name: self.F_vals,
+            alpha_name: self.alpha_vals,
+            BAT_name: self.BAT_vals,
+            flip_name: self.flip_vals,
+            B1_name: self.B1_vals,
+        }
+
+        if self.is_constrained():
+            inds = np.unravel_index(self.get_valid(), self.get_shape())
+            vals[points_name] = np.stack([np.asarray(vals[n], dtype=np.float64)[i] for n, i in zip(val_names, inds)], axis=1)
+
+        return vals
+
+
+    def set_vals(self, vals):
+        """
+        Helper method that replaces the arrays of parameter values with the ones held in a
+        python dict using the names of the dictionary file (see get_vals()). Any constraints
+        are dropped, unless vals holds a table of points, in which case the grid is restricted
+        to these points (which must all be on the grid). Parameters that vals is missing (from
+        older dictionaries) get their default values (see dict_manip.default_vals).
+        """
+        vals = fill_vals(dict(vals))
+
+        self.T1_f_vals = arr_or_num(vals[T1f_name])
+        self.T2_f_vals = arr_or_num(vals[T2f_name])
+        self.T1_s_vals = arr_or_num(vals[T1s_name])
+        self.alpha_vals = arr_or_num(vals[alpha_name])
+        self.F_vals = arr_or_num(vals[F_name])
+        self.ks_vals = arr_or_num(vals[ks_name])
+        self.kf_vals = arr_or_num(vals[kf_name])
+        self.CBV_vals = arr_or_num(vals[CBV_name])
+        self.BAT_vals = arr_or_num(vals[BAT_name])
+        self.flip_vals = arr_or_num(vals[flip_name])
+        self.B1_vals = arr_or_num(vals[B1_name])
+
+        # The shape may have changed, so we forget any cached values
+        self.clear_cache()
+        self.needs_setup = True
 
-        
-        
+        self.constraints = []
+        self.mask = None
+        if points_name in vals:
+            points = np.asarray(vals[points_name])
+            grid = self.get_vals()
+            inds = []
+            for a, n in enumerate(val_names):
+                same = np.isclose(points[:, a][:, None], np.asarray(grid[n], dtype=np.float64)[None, :], rtol=1e-12, atol=0.0)
+                if not np.all(np.any(same, axis=1)):
+                    raise ValueError("Error: The points are not on the grid of the parameter values")
+                inds.append(np.argmax(same, axis=1))
+
+            mask = np.zeros(self.get_shape(), dtype=bool)
+            mask[tuple(inds)] = True
+            self.set_mask(mask)
+
+
+    def extend_vals(self, **new_vals):
+        """
+        Helper method that adds values to any of the parameter axes. The keywords are the
+        names of the axes (see axis_names), for example:
+
+            p.extend_vals(T1_f=np.array([2200, 2400]), flip=30)
+
+        The new values are merged with the existing ones, and each extended axis is kept
+        sorted (duplicates are dropped).
+        """
+        for axis, new in new_vals.items():
+            if axis not in self.axis_names:
+                raise ValueError(f"Error: Unknown parameter axis '{axis}' (expected one of {', '.join(self.axis_names)})")
+
+            setattr(self, axis + "_vals", np.union1d(getattr(self, axis + "_vals"), arr_or_num(new)))
+
+        self.clear_cache()
+        self.needs_setup = True
+
+
+    def add_constraint(self, constraint):
+        """
+        This method restricts the grid to the points that satisfy a constraint, for example:
+
+            p.add_constraint(lambda T1_f, T2_f, **others: T2_f < T1_f)
+
+        The constraint is called with every axis (see axis_names) as a keyword argument,
+        shaped so that they broadcast over the grid (like np.ix_()), and returns a boolean
+        array that broadcasts to the shape of the grid. Only the points that satisfy every
+        constraint (and the mask, see set_mask()) are simulated and stored, see get_vals().
+        """
+        self.constraints.append(constraint)
+        self.clear_cache()
+        self.needs_setup = True
+
+
+    def set_mask(self, mask):
+        """
+        This method restricts the grid to the points where the boolean mask (of the shape of
+        the grid, see get_shape()) is True, on top of any constraint (see add_constraint()).
+        None removes the mask.
+        """
+        if (mask is not None) and (np.shape(mask) != self.get_shape()):
+            raise ValueError(f"Error: The mask has shape {np.shape(mask)}, the grid has {self.get_shape()}")
+
+        self.mask = None if mask is None else np.asarray(mask, dtype=bool)
+        self.clear_cache()
+        self.needs_setup = True
+
+
+    def is_constrained(self):
+        """
+        Returns True if only part of the grid is simulated (see add_constraint() and set_mask()).
+        """
+        return (len(self.constraints) > 0) or (self.mask is not None)
+
+
+    def get_valid(self):
+        """
+        Returns the sorted C-order flat indices of the valid points of the grid (all of them if
+        there are no constraints).
+        """
+        if not hasattr(self, "valid"):
+            shape = self.get_shape()
+            valid = np.ones(shape, dtype=bool) if self.mask is None else self.mask.copy()
+
+            if self.mask is not None and self.mask.shape != shape:
+                raise ValueError(f"Error: The mask has shape {self.mask.shape}, the grid has {shape}")
+
+            axes = dict(zip(self.axis_names, np.ix_(*[np.asarray(getattr(self, a + "_vals")) for a in self.axis_names])))
+            for constraint in self.constraints:
+                valid &= np.broadcast_to(np.asarray(constraint(**axes), dtype=bool), shape)
+
+            self.valid = np.flatnonzero(valid)
+
+        return self.valid
+
+
+    def get_consts(self):
+        """
+        Helper method that returns a python dict of the simulation constants (the parameters
+        that are not iterated over).
+        """
+        return {
+            "T1_b": self.T1_b,
+            "lam": self.lam,
+            "M0_f": self.M0_f,
+            "M0_s": self.M0_s,
+            "xpos": self.xpos,
+            "ypos": self.ypos,
+            "zvel": self.zvel,
+            "zpos_init": self.zpos_init,
+        }
+
+
+    def get_grid_hash(self):
+        """
+        Returns a hash of the arrays of parameter values (see dict_cache.py).
+        """
+        h = sha256()
+        update_hash(h, self.get_vals())
+        return h.hexdigest()
+
+
+    def clear_cache(self):
+        """
+        Helper method that forgets the cached shape, size, fitting flag and valid points. This must be
+        called whenever the arrays of parameter values are replaced.
+        """
+        for attr in ("val_shape", "total_combs", "fitting", "valid"):
+            if hasattr(self, attr):
+                delattr(self, attr)
 
-        
 
     def __next__(self):
         """
@@ -228,10 +465,12 @@ class Params:
             - alpha
             - BAT
             - flip_angle
+            - B1
             --LAST--
 
         The parameters that are incremented last involve the most setup, particulatly
-        BAT, which requires that we recalculate a different s(t) signal from scratch.
+        BAT, which requires that we recalculate a different s(t) signal from scratch, and
+        the flip angle and B1 scale, which change the RF pulses.
         Parameters towards the beginning of the list require little to no setup for the
         MRFSim instance or the objects that it wraps.
         """
@@ -303,12 +542,20 @@ class Params:
         # Update Flip Angle index
         self.flip_ind = (self.flip_ind + 1) % np.size(self.flip_vals)
         self.flip = self.flip_vals[self.flip_ind]
-        if self.flip_ind == 0:
+        if self.flip_ind:
+            self.calc_R_T_vals()
+            self.recompute_s = True
+            self.recompute_B = True
+            return None
+
+        # Update B1 index
+        self.B1_ind = (self.B1_ind + 1) % np.size(self.B1_vals)
+        self.B1 = self.B1_vals[self.B1_ind]
+        if self.B1_ind == 0:
             # Once we get here, ther is nothing more to itterate
             raise StopIteration
-        
+
         self.calc_R_T_vals()
-        self.recompute_s = True
         self.recompute_B = True
         return None
     
@@ -341,7 +588,7 @@ class Params:
     def any_to_fit(self):
         """
         This is a helper method that checks if we have any parameters that
-        will be fitted. In other words, this method checks if any of the 9 fitting
+        will be fitted. In other words, this method checks if any of the 11 fitting
         dimensions have length > 1. If yes, then we will loop through at least one
         dimension of parameters and this function will return true, otherwise it will
         return false. It will also set a flag to reflect this so if this method is called
@@ -360,7 +607,8 @@ class Params:
                 (np.size(self.F_vals) > 1) | \
                 (np.size(self.alpha_vals) > 1) | \
                 (np.size(self.BAT_vals) > 1) | \
-                (np.size(self.flip_vals) > 1)
+                (np.size(self.flip_vals) > 1) | \
+                (np.size(self.B1_vals) > 1)
 
         return self.fitting
     
@@ -370,11 +618,14 @@ class Params:
         """
         print("Current Indices: [ CBV:", self.CBV_ind, " , ks:", self.ks_ind, " , kf:",self.kf_ind, \
                 " , T1_f:",self.T1_f_ind, " , T2_f:",self.T2_f_ind, " , T1_s:",self.T1_s_ind, " , F:", \
-                self.F_ind, " , a:", self.alpha_ind, " , BAT:", self.BAT_ind, " , Flip:", self.flip_ind, " ]")
+                self.F_ind, " , a:", self.alpha_ind, " , BAT:", self.BAT_ind, " , Flip:", self.flip_ind, " , B1:", self.B1_ind, " ]")
         
     
     def set_inds(self, inds):
-        if len(inds) != 10:
+        # The indices of older dictionaries don't have the last axes (see dict_manip.default_vals)
+        if len(inds) == len(self.axis_names) - len(default_vals):
+            inds = tuple(inds) + (0,) * len(default_vals)
+        if len(inds) != len(self.axis_names):
             raise ValueError("Number of indices was incorrect")
         
         self.CBV_ind = inds[0]
@@ -387,8 +638,73 @@ class Params:
         self.alpha_ind = inds[7]
         self.BAT_ind = inds[8]
         self.flip_ind = inds[9]
+        self.B1_ind = inds[10]
         
 
+    def get_rf_batch(self):
+        """
+        This method returns the entries that only differ from the current one by their flip
+        angle and B1 scale, so that they can be simulated together (see
+        MRFSim.simulate_rf_batch()). The batch is only formed at the first flip angle and B1
+        scale, it is empty everywhere else (those entries were part of an earlier batch), and
+        it leaves out the entries that are done (see entry_done()).
+
+        Output Values:
+            flips:      (K, ) flip angles of the entries
+            B1s:        (K, ) B1 scales of the entries
+            inds:       Python list of the K indices the entries are stored at (see get_store_idx())
+        """
+        flips, B1s, inds = [], [], []
+        if (self.flip_ind != 0) or (self.B1_ind != 0):
+            return np.array(flips), np.array(B1s), inds
+
+        for self.B1_ind in range(np.size(self.B1_vals)):
+            for self.flip_ind in range(np.size(self.flip_vals)):
+                if not self.entry_done():
+                    flips.append(self.flip_vals[self.flip_ind])
+                    B1s.append(self.B1_vals[self.B1_ind])
+                    inds.append(self.get_store_idx())
+
+        self.flip_ind = 0
+        self.B1_ind = 0
+
+        return np.array(flips, dtype=np.float64), np.array(B1s, dtype=np.float64), inds
+
+
+    def set_point(self, inds):
+        """
+        This method jumps to the entry with the given parameter indices (see get_cur_idx()), so
+        that it can be simulated on its own (see MRFSim.simulate_point()). Every flag is set,
+        since nothing can be assumed about the entry that was simulated before.
+        """
+        iter(self)
+        self.set_inds(inds)
+        self.set_cur_vals()
+        self.calc_R_T_vals()
+
+        self.recompute_s = True
+        self.rescale_s = False
+        self.recompute_B = True
+
+
+    def set_point_vals(self, point):
+        """
+        This method sets the current parameters to arbitrary values, given in the order of
+        axis_names, that do not have to be on the grid (see MRFSim.simulate_vals()). As with
+        set_point(), every flag is set.
+        """
+        if len(point) != len(self.axis_names):
+            raise ValueError(f"Error: Expected {len(self.axis_names)} parameter values, got {len(point)}")
+
+        iter(self)
+        self.CBV, self.ks, self.kf, self.T1_f, self.T2_f, self.T1_s, self.F, self.alpha, self.BAT, self.flip, self.B1 = point
+        self.calc_R_T_vals()
+
+        self.recompute_s = True
+        self.rescale_s = False
+        self.recompute_B = True
+
+
     def get_shape(self):
         if not hasattr(self, "val_shape"):
             self.val_shape = ( \
@@ -401,7 +717,8 @@ class Params:
             np.size(self.F_vals), \
             np.size(self.alpha_vals), \
             np.size(self.BAT_vals), \
-            np.size(self.flip_vals) \
+            np.size(self.flip_vals), \
+            np.size(self.B1_vals) \
             )
         
         return self.val_shape
@@ -418,7 +735,8 @@ class Params:
             self.F_ind, \
             self.alpha_ind, \
             self.BAT_ind, \
-            self.flip_ind \
+            self.flip_ind, \
+            self.B1_ind \
             )
     
     def get_num_combs(self):
@@ -430,3 +748,39 @@ class Params:
     def get_comp_perc(self):
         return np.ravel_multi_index(self.get_cur_idx(), self.get_shape(), order="F") / self.get_num_combs()
 
+    def get_entry_idx(self):
+        """
+        Returns the C-order flat index of the current entry. This is the index used by the
+        completion bitmap in the dictionary file. On a constrained grid, this is the row of the
+        entry in the table of valid points (-1 if the entry is not valid).
+        """
+        flat = np.ravel_multi_index(self.get_cur_idx(), self.get_shape())
+        if not self.is_constrained():
+            return flat
+
+        valid = self.get_valid()
+        row = np.searchsorted(valid, flat)
+        return row if (row < len(valid)) and (valid[row] == flat) else -1
+
+
+    def get_store_idx(self):
+        """
+        Returns the index the current entry is written at (see DictWriter.write()): the parameter
+        indices, or the row in the table of valid points on a constrained grid.
+        """
+        if self.is_constrained():
+            return (self.get_entry_idx(),)
+
+        return self.get_cur_idx()
+
+
+    def entry_done(self):
+        """
+        Returns True if the current entry has already been stored (only possible after resume()),
+        or if it is left out by the constraints (see add_constraint()).
+        """
+        idx = self.get_entry_idx()
+        if idx < 0:
+            return True
+
+        return (self.done is not None) and self.done[idx]
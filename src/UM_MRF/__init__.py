@@ -1,4 +1,10 @@
 from .sim_blocks import *
 from .sim_blocks.SimObj import SimObj
 from .MRFSim import MRFSim
+from .template import SequenceTemplate, SimState
+from .shared import share_template, attach_template
 from .Params import Params
+from .dict_manip import DictReader, DictWriter
+from .match import DictMatcher, SubspaceMatcher
+from .refine import refine_matches
+from .pointset import PointSet
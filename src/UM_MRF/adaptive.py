@@ -0,0 +1,210 @@
+##############################################################################
+#   This file contains the adaptive (error-driven) generation of            #
+#   dictionaries.                                                            #
+#                                                                            #
+#   Uniform grids oversample the regions of parameter space where the       #
+#   fingerprints barely change, and undersample the regions where they      #
+#   change quickly. Here, the grid of the Params object is only the coarse  #
+#   starting point: its cells are simulated at their corners, and a cell is #
+#   split in two along every axis on which two adjacent corners differ by   #
+#   more than tol, recursively (worst cells first), down to max_level       #
+#   halvings of the coarse spacing. The difference between two entries is  #
+#   measured the same way matching does, as 1 - (normalized correlation).   #
+#                                                                            #
+#   New points are placed on a lattice of 2^max_level steps per coarse      #
+#   interval (linear in the values of each axis), so that the corners of    #
+#   neighbouring cells are shared and only simulated once.                  #
+#                                                                            #
+#   The result is a scattered dictionary (see dict_manip.get_dict_shape()): #
+#   a flat list of entries with the table of their parameters, which can    #
+#   be matched like any other dictionary (see match.DictMatcher), with the  #
+#   parameters of the matches given by dict_manip.index_to_vals().          #
+##############################################################################
+
+import numpy as np
+import heapq
+from hashlib import sha256
+from itertools import product
+from .dict_manip import *
+from .dict_cache import seq_hash_name, grid_hash_name
+from .helpers import update_hash
+
+
+
+def entry_distance(x, y):
+    """
+    Returns 1 - |<x, y>| / (|x| |y|), the distance between two entries as seen by matching.
+    """
+    norm = np.linalg.norm(x) * np.linalg.norm(y)
+    if norm == 0:
+        return 0.0 if np.linalg.norm(x) == np.linalg.norm(y) else 1.0
+
+    return 1 - np.abs(np.vdot(x, y)) / norm
+
+
+
+class AdaptiveGrid:
+    """
+    This class refines the grid of a Params object (see the top of this file).
+
+    Input Parameters:
+        simulate:       Function that returns the entry for a point (the values of the 11
+                        parameters, in the order of Params.axis_names), e.g. MRFSim.simulate_vals
+        vals:           Python dict of the parameter value arrays of the coarse grid (see
+                        Params.get_vals()). Axes with a single value are not refined
+        tol:            Largest distance allowed between adjacent corners of a cell
+        max_level:      Largest number of times the coarse spacing is halved
+        max_entries:    Optional limit on the number of entries (refinement stops there)
+
+    Class Variables:
+        axes:           Indices (in Params.axis_names) of the axes that are refined
+        points:         Python dict mapping the lattice coordinates of every simulated point
+                        to its row in entries
+        entries:        Python list of the simulated entries
+        heap:           Cells that still have to be split, worst first
+    """
+
+
+    def __init__(self, simulate, vals, tol=0.01, max_level=3, max_entries=None):
+        self.simulate = simulate
+        self.vals = [np.atleast_1d(np.asarray(vals[n], dtype=np.float64)) for n in val_names]
+        self.tol = tol
+        self.max_level = max_level
+        self.max_entries = np.inf if max_entries is None else max_entries
+
+        self.axes = [a for a, v in enumerate(self.vals) if len(v) > 1]
+        self.steps = 2 ** max_level
+        self.points = {}
+        self.entries = []
+        self.heap = []
+        self.count = 0
+
+
+    def lattice_vals(self, q):
+        """
+        Returns the values of the 11 parameters at the lattice coordinates q (one per refined axis).
+        """
+        point = np.array([v[0] for v in self.vals])
+        for a, qa in zip(self.axes, q):
+            v = self.vals[a]
+            point[a] = np.interp(qa / self.steps, np.arange(len(v)), v)
+
+        return point
+
+
+    def get_entry(self, q):
+        """
+        Returns the entry at the lattice coordinates q, simulating it if it is not known yet.
+        """
+        if q not in self.points:
+            self.points[q] = len(self.entries)
+            self.entries.append(np.asarray(self.simulate(self.lattice_vals(q))))
+
+        return self.entries[self.points[q]]
+
+
+    def add_cell(self, q0, size):
+        """
+        This method simulates the corners of the cell with lower corner q0 and the given size
+        (in lattice steps), and queues it if any of its axes needs to be split.
+        """
+        d = len(self.axes)
+        corners = {o: self.get_entry(tuple(q + s * b for q, s, b in zip(q0, size, o))) for o in product((0, 1), repeat=d)}
+
+        # Largest difference between corners that are adjacent along each axis
+        err = np.zeros(d)
+        for o, x in corners.items():
+            for k in range(d):
+                if o[k] == 0:
+                    err[k] = max(err[k], entry_distance(x, corners[o[:k] + (1,) + o[k + 1:]]))
+
+        split = (err > self.tol) & (np.array(size) > 1)
+        if np.any(split):
+            self.count += 1
+            heapq.heappush(self.heap, (-np.max(err[split]), self.count, q0, size, tuple(split)))
+
+
+    def run(self):
+        """
+        This method refines the grid until every cell is within tol (or the limits are reached).
+
+        Output Values:
+            points:         (n, 11) table of the parameters of the entries
+            entries:        (n, num_samples) array of the entries
+        """
+        # Coarse cells
+        for c in product(*[range(len(self.vals[a]) - 1) for a in self.axes]):
+            self.add_cell(tuple(i * self.steps for i in c), (self.steps,) * len(self.axes))
+
+        # Worst cells first, until everything is within tol
+        while self.heap and (len(self.entries) < self.max_entries):
+            _, _, q0, size, split = heapq.heappop(self.heap)
+
+            half = tuple(s // 2 if sp else s for s, sp in zip(size, split))
+            for o in product(*[(0, 1) if sp else (0,) for sp in split]):
+                self.add_cell(tuple(q + h * b for q, h, b in zip(q0, half, o)), half)
+
+        if len(self.axes) == 0:
+            self.get_entry(())
+
+        # Rows in lattice order, so that neighbours are close to each other
+        lattice = sorted(self.points)
+        points = np.array([self.lattice_vals(q) for q in lattice])
+        entries = np.array([self.entries[self.points[q]] for q in lattice])
+
+        return points, entries
+
+
+    def get_num_uniform(self):
+        """
+        Returns the number of entries of the uniform grid with the finest spacing that was reached.
+        """
+        if len(self.axes) == 0:
+            return 1
+
+        lattice = np.array(list(self.points))
+        num = 1
+        for k, a in enumerate(self.axes):
+            spacing = np.gcd.reduce(np.diff(np.unique(lattice[:, k])))
+            num *= (len(self.vals[a]) - 1) * self.steps // spacing + 1
+
+        return int(num)
+
+
+
+def generate_adaptive_dict(sim, dict_filename, tol=0.01, max_level=3, max_entries=None, backend="hdf5"):
+    """
+    This function generates a scattered dictionary by adaptive refinement of the grid of
+    sim.params (see the top of this file).
+
+    The entries are kept in memory until the refinement is done, and then written in one go,
+    so an interrupted run has to be started again.
+
+    Input Parameters:
+        sim:            The MRFSim instance, whose params hold the coarse grid
+        dict_filename:  Path of the dictionary
+        tol:            Largest distance (1 - correlation) allowed between adjacent entries
+        max_level:      Largest number of times the coarse spacing is halved
+        max_entries:    Optional limit on the number of entries
+        backend:        Either "hdf5" or "memmap" (see init_dict())
+
+    Output Values:
+        The number of entries of the dictionary
+    """
+    grid = AdaptiveGrid(sim.simulate_vals, sim.params.get_vals(), tol, max_level, max_entries)
+    points, entries = grid.run()
+
+    vals = {n: np.unique(points[:, a]) for a, n in enumerate(val_names)}
+    vals[points_name] = points
+
+    h = sha256()
+    update_hash(h, vals)
+    hashes = {seq_hash_name: sim.get_seq_hash(), grid_hash_name: h.hexdigest()}
+
+    init_dict(dict_filename, vals, entries.shape[-1], backend=backend, hashes=hashes)
+    with open_writer(dict_filename, flush_every=np.inf) as w:
+        w.write_block(np.arange(len(entries)), entries)
+
+    print(f"Adaptive dictionary complete: {len(entries)} entries, the uniform grid of the same resolution has {grid.get_num_uniform()}")
+
+    return len(entries)
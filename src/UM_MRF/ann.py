@@ -0,0 +1,302 @@
+##############################################################################
+#   This file contains an approximate nearest-neighbour (ANN) index over    #
+#   the fingerprints of a dictionary, for dictionaries that are too large   #
+#   to be matched exhaustively (even in a subspace, see match.py).          #
+#                                                                            #
+#   The index is an inverted file (IVF) over the SVD coefficients of the    #
+#   entries (see svd.py): the normalized coefficients are partitioned into  #
+#   num_lists clusters by (sign-invariant) spherical k-means, and the        #
+#   entries of each cluster are stored contiguously. A signal is matched    #
+#   by projecting it onto the SVD basis, finding the nprobe clusters whose  #
+#   centroids are the closest to it, and matching it exactly against the    #
+#   entries of these clusters only. nprobe is the recall/speed knob: the    #
+#   larger it is, the closer the results are to exact matching.             #
+#                                                                            #
+#   The index is stored next to the dictionary, in <name>.ivf.h5, with:      #
+#       basis           (rank, num_samples) SVD basis                        #
+#       centroids       (num_lists, rank) unit centroids                     #
+#       offsets         (num_lists + 1,) start of each cluster               #
+#       perm            (N,) flat index of the entries, cluster by cluster   #
+#       coeffs          (N, rank) their coefficients (same order)            #
+#       norm            (N,) the norms of these coefficients                 #
+#   along with the parameter value arrays and the hashes of the dictionary   #
+#   (see dict_cache.py), which are checked when the index is loaded.        #
+##############################################################################
+
+import numpy as np
+import h5py
+import os
+import time
+from .dict_manip import *
+from .match import SubspaceMatcher, TopK, inv_norm, make_test_signals
+from .svd import coeff_name
+
+
+index_suffix = ".ivf.h5"
+centroids_name = "centroids"
+offsets_name = "offsets"
+perm_name = "perm"
+basis_name = "basis"
+
+
+
+def index_path(name):
+    """
+    Returns the path of the ANN index of the dictionary name.
+    """
+    return name.rstrip(os.sep) + index_suffix
+
+
+def assign_lists(units, centroids):
+    """
+    Returns the index of the closest centroid (largest |inner product|) to each unit vector,
+    and the sign of that inner product.
+    """
+    ip = units @ centroids.T
+    best = np.argmax(np.abs(ip), axis=1)
+
+    return best, np.sign(ip[np.arange(len(units)), best])
+
+
+def build_index(name, rank=None, num_lists=None, num_train=100000, iters=20, seed=0, block_size=4096):
+    """
+    This function builds the ANN index of a complete dictionary (see the top of this file).
+
+    Input Parameters:
+        name:           Path of the dictionary (either backend)
+        rank:           Rank of the SVD the index works in (see SubspaceMatcher)
+        num_lists:      Number of clusters (defaults to the square root of the number of entries)
+        num_train:      Number of (random) entries the clusters are trained on
+        iters:          Number of k-means iterations
+        seed:           Seed of the random generator
+        block_size:     Number of entries processed at a time
+    """
+    rng = np.random.default_rng(seed)
+
+    # Makes sure that the SVD (and the coefficients) are there
+    sub = SubspaceMatcher(name, rank, block_size)
+    norm = sub.norm
+    num_entries = len(norm)
+
+    if num_lists is None:
+        num_lists = max(1, int(np.sqrt(num_entries)))
+    num_lists = min(num_lists, num_entries)
+
+    with open_reader(name) as r:
+        if not r.is_complete():
+            raise ValueError(f"Error: Can't index {name}, not every entry has been simulated")
+        hashes = r.get_hashes()
+
+        # All of the (normalized) coefficients. These are rank numbers per entry, which is
+        # what the index holds in memory anyway.
+        units = np.empty((num_entries, sub.rank), dtype=np.float32)
+        for start, coeffs in r.iter_blocks(block_size, channel=coeff_name):
+            units[start:start + len(coeffs)] = coeffs[:, :sub.rank] * inv_norm(norm[start:start + len(coeffs)])[:, None]
+
+    # Spherical k-means (with sign-invariant assignment, since matching uses |inner product|)
+    train = units[rng.choice(num_entries, size=min(num_train, num_entries), replace=False)]
+    centroids = train[rng.choice(len(train), size=num_lists, replace=False)].copy()
+    for _ in range(iters):
+        lists, signs = assign_lists(train, centroids)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, lists, train * signs[:, None])
+        lengths = np.linalg.norm(sums, axis=1)
+
+        # Empty clusters are restarted on random training points
+        empty = lengths == 0
+        sums[empty] = train[rng.choice(len(train), size=np.count_nonzero(empty))]
+        lengths[empty] = np.linalg.norm(sums[empty], axis=1)
+        centroids = (sums / np.where(lengths > 0, lengths, 1)[:, None]).astype(np.float32)
+
+    # Put every entry in its cluster
+    lists = np.empty(num_entries, dtype=np.int64)
+    for start in range(0, num_entries, block_size):
+        lists[start:start + block_size] = assign_lists(units[start:start + block_size], centroids)[0]
+
+    perm = np.argsort(lists, kind="stable")
+    offsets = np.searchsorted(lists[perm], np.arange(num_lists + 1))
+
+    with h5py.File(index_path(name), "w") as d:
+        for n, v in sub.vals.items():
+            d.create_dataset(n, np.shape(v), data=v)
+        for key, val in hashes.items():
+            d.attrs[key] = val
+
+        d.create_dataset(basis_name, data=sub.basis)
+        d.create_dataset(centroids_name, data=centroids)
+        d.create_dataset(offsets_name, data=offsets)
+        d.create_dataset(perm_name, data=perm)
+        d.create_dataset(coeff_name, data=units[perm] * norm[perm, None].astype(np.float32))
+        d.create_dataset(norm_name, data=norm[perm])
+
+
+
+
+class ANNIndex:
+    """
+    This class loads the ANN index of a dictionary (see build_index()) and matches signals with it.
+
+    Example:
+        build_index("dict.h5", rank=16)                 # once
+        ann = ANNIndex("dict.h5")
+        inds, corr, pd = ann.match(signals, nprobe=8)
+        maps = ann.get_maps(inds)
+
+    Input Parameters:
+        name:           Path of the dictionary (the index is read from index_path(name))
+
+    Class Variables:
+        basis:          (rank, num_samples) SVD basis
+        centroids:      (num_lists, rank) unit centroids of the clusters
+        offsets:        (num_lists + 1,) start of each cluster in perm/coeffs/norm
+        perm:           (N,) flat index of the entries, cluster by cluster
+        coeffs:         (N, rank) coefficients of the entries (same order as perm)
+        norm:           (N,) norms of the coefficients
+        vals:           Python dict of the parameter value arrays (see DictReader.get_vals())
+    """
+
+
+    def __init__(self, name):
+        path = index_path(name)
+        if not os.path.exists(path):
+            raise ValueError(f"Error: {name} has not been indexed (see build_index())")
+
+        with open_reader(name) as r:
+            hashes = r.get_hashes()
+
+        with h5py.File(path, "r") as d:
+            if any(d.attrs.get(key) != val for key, val in hashes.items()):
+                raise ValueError(f"Error: The index of {name} is out of date, build it again (see build_index())")
+
+            self.vals = fill_vals({n: d[n][...] for n in val_names + [points_name] if n in d})
+            self.basis = d[basis_name][...]
+            self.centroids = d[centroids_name][...]
+            self.offsets = d[offsets_name][...]
+            self.perm = d[perm_name][...]
+            self.coeffs = d[coeff_name][...]
+            self.norm = d[norm_name][...]
+
+        self.rank, self.num_samples = self.basis.shape
+        self.num_lists = len(self.centroids)
+
+        # Norms in flat index order (for the proton density)
+        self.flat_norm = np.empty_like(self.norm)
+        self.flat_norm[self.perm] = self.norm
+
+
+    def match(self, signals, k=1, nprobe=8, batch_size=4096):
+        """
+        This method matches every signal to (approximately) the k best entries of the dictionary.
+
+        Input Parameters:
+            signals:        (..., num_samples) array of signals, real or complex
+            k:              Number of matches kept for each signal
+            nprobe:         Number of clusters searched for each signal
+            batch_size:     Number of signals processed at a time
+
+        Output Values:
+            inds, corr, pd: (..., k) arrays (see match.py), best match first
+        """
+        signals = np.asarray(signals)
+        if signals.shape[-1] != self.num_samples:
+            raise ValueError(f"Error: Signals have {signals.shape[-1]} samples, the dictionary has {self.num_samples}")
+
+        out_shape = signals.shape[:-1] + (k,)
+        proj = signals.reshape(-1, self.num_samples) @ self.basis.T
+        is_complex = np.iscomplexobj(proj)
+        nprobe = min(nprobe, self.num_lists)
+
+        top = TopK(len(proj), k, np.complex64 if is_complex else np.float32)
+
+        for s0 in range(0, len(proj), batch_size):
+            batch = proj[s0:s0 + batch_size]
+
+            # Closest clusters of each signal
+            scores = np.abs(batch @ self.centroids.T)
+            if nprobe < self.num_lists:
+                probes = np.argpartition(-scores, nprobe - 1, axis=1)[:, :nprobe]
+            else:
+                probes = np.broadcast_to(np.arange(self.num_lists), scores.shape)
+
+            # Group the signals by cluster, and match each group against its cluster
+            sig_ids = np.repeat(np.arange(len(batch)), nprobe)
+            list_ids = probes.ravel()
+            order = np.argsort(list_ids, kind="stable")
+            sig_ids, list_ids = sig_ids[order], list_ids[order]
+            bounds = np.searchsorted(list_ids, np.arange(self.num_lists + 1))
+
+            for l in np.flatnonzero(np.diff(bounds)):
+                a, b = self.offsets[l], self.offsets[l + 1]
+                if a == b:
+                    continue
+
+                rows = sig_ids[bounds[l]:bounds[l + 1]]
+                ip = (batch[rows] @ self.coeffs[a:b].T) * inv_norm(self.norm[a:b])
+                top.update(self.perm[a:b], ip, s0 + rows)
+
+        inds, mag, ips = top.result()
+
+        sig_norm = np.linalg.norm(proj, axis=1)
+        corr = mag / np.where(sig_norm > 0, sig_norm, 1)[:, None]
+        entry_norm = self.flat_norm[np.maximum(inds, 0)]
+        pd = ips / np.where(entry_norm > 0, entry_norm, 1)
+
+        return inds.reshape(out_shape), corr.reshape(out_shape), pd.reshape(out_shape)
+
+
+    def get_maps(self, inds):
+        """
+        Returns parameter maps for the best matches, see DictMatcher.get_maps().
+        """
+        return index_to_vals(self.vals, np.asarray(inds)[..., 0])
+
+
+
+
+def recall_report(name, nprobes=(1, 2, 4, 8, 16, 32), num_signals=1000, noise=0.01, seed=0, tol=1e-6):
+    """
+    This function measures the recall of the ANN index of a dictionary against exact matching
+    in the same subspace (see SubspaceMatcher), for several values of nprobe. The test signals
+    are randomly chosen entries, as represented in the subspace (see match.make_test_signals()).
+
+    Input Parameters:
+        name:           Path of the dictionary (which must have been indexed)
+        nprobes:        Values of nprobe to test
+        num_signals:    Number of test signals
+        noise:          Relative noise level
+        seed:           Seed of the random generator
+        tol:            Relative tolerance on the correlation under which two entries are tied
+                        (neighbouring entries of fine grids can be that close)
+
+    Output Values:
+        Python dict mapping each nprobe to a python dict with
+            recall:         Fraction of signals whose best match is the exact best match (or
+                            an entry that matches them just as well, within tol)
+            time:           Time taken to match all the signals (in seconds)
+            speedup:        Time taken by exact matching over time taken by the index
+    """
+    ann = ANNIndex(name)
+    rng = np.random.default_rng(seed)
+
+    with open_reader(name) as r:
+        truth = np.sort(rng.choice(r.num_entries, size=min(num_signals, r.num_entries), replace=False))
+        coeffs = r.read_entries(truth, channel=coeff_name)[:, :ann.rank]
+
+    signals = make_test_signals(coeffs @ ann.basis, rng, noise)
+
+    t0 = time.time()
+    exact, exact_corr, _ = SubspaceMatcher(name, ann.rank).match(signals)
+    exact_time = time.time() - t0
+
+    report = {}
+    for nprobe in nprobes:
+        t0 = time.time()
+        inds, corr, _ = ann.match(signals, nprobe=nprobe)
+        t = time.time() - t0
+
+        found = (inds[:, 0] == exact[:, 0]) | (corr[:, 0] >= (1 - tol) * exact_corr[:, 0])
+        report[nprobe] = {"recall": float(np.mean(found)), "time": t, "speedup": exact_time / t}
+        print(f"nprobe {nprobe:4d}: recall {100 * report[nprobe]['recall']:6.2f}%, {report[nprobe]['speedup']:.1f}x faster than exact")
+
+    return report
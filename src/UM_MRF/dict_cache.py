@@ -0,0 +1,222 @@
+##########################################################################
+#   This file contains the content-addressed dictionary cache. Every     #
+#   dictionary stores two hashes (see MRFSim.generate_dict()):           #
+#       seq_hash:   the pulse sequence and the non-iterated constants    #
+#       grid_hash:  the arrays of parameter values that were simulated   #
+#   A dictionary with the same seq_hash and grid_hash can be reused as   #
+#   is, and one with only the same seq_hash can provide every entry      #
+#   whose parameters also appear on the new grid.                        #
+##########################################################################
+
+import numpy as np
+import os
+import shutil
+from .dict_manip import *
+
+seq_hash_name = "seq_hash"      # Hash of the pulse sequence and simulation constants
+grid_hash_name = "grid_hash"    # Hash of the arrays of parameter values
+
+
+def backend_of(name):
+    """
+    Returns the backend of an existing dictionary ("memmap" for directories, "hdf5" otherwise).
+    """
+    return "memmap" if os.path.isdir(name) else "hdf5"
+
+
+def copy_dict(src, dst, backend):
+    """
+    This function copies a dictionary to dst, converting it if the backends differ.
+    """
+    if backend != backend_of(src):
+        convert_dict(src, dst, backend)
+    elif backend == "memmap":
+        shutil.copytree(src, dst, dirs_exist_ok=True)
+    else:
+        shutil.copyfile(src, dst)
+
+
+def match_axes(src_vals, dst_vals):
+    """
+    This function finds the parameter values that two grids have in common. For each axis
+    (in the order of val_names) it returns a tuple (dst_inds, src_inds) such that
+    dst_vals[axis][dst_inds] == src_vals[axis][src_inds].
+    """
+    matches = []
+    for n in val_names:
+        src, dst = np.asarray(src_vals[n]), np.asarray(dst_vals[n])
+        d_inds, s_inds = np.nonzero(np.isclose(dst[:, None], src[None, :], rtol=1e-12, atol=0.0))
+
+        # Only keep the first match of each destination value
+        d_inds, first = np.unique(d_inds, return_index=True)
+        matches.append((d_inds, s_inds[first]))
+
+    return matches
+
+
+def copy_entries(src, writer, dst_vals, dst_done=None, block_size=4096):
+    """
+    This function copies every completed entry of the dictionary src whose parameters also
+    appear on the grid dst_vals into an open writer (see open_writer()).
+
+    Input Parameters:
+        src:            Path of the dictionary we copy from
+        writer:         Open writer of the dictionary we copy to
+        dst_vals:       Python dict of the parameter value arrays of the destination
+        dst_done:       Completion mask of the destination, entries that are already done
+                        are not copied (optional)
+        block_size:     Number of entries copied at a time
+
+    Output Values:
+        filled:         Boolean mask (C-order flat index) of the destination entries that
+                        were copied
+    """
+    dst_shape = tuple(np.size(dst_vals[n]) for n in val_names)
+    filled = np.zeros(int(np.prod(dst_shape)), dtype=bool)
+
+    with open_reader(src) as r:
+        src_vals = r.get_vals()
+        if points_name in src_vals:
+            # Scattered dictionaries (see adaptive.py) are not on a grid
+            return filled
+
+        matches = match_axes(src_vals, dst_vals)
+        if any(np.size(d) == 0 for d, _ in matches):
+            # No overlap along at least one axis, so no overlap at all
+            return filled
+
+        # Flat indices of the overlapping entries in both grids (in the same order)
+        dst_flat = np.ravel_multi_index(np.ix_(*[d for d, _ in matches]), dst_shape).ravel()
+        src_flat = np.ravel_multi_index(np.ix_(*[s for _, s in matches]), r.shape).ravel()
+
+        keep = r.done_mask()[src_flat]
+        if dst_done is not None:
+            keep &= ~dst_done[dst_flat]
+        dst_flat, src_flat = dst_flat[keep], src_flat[keep]
+
+        # Copy every per-entry channel the destination has (e.g. the label and control
+        # fingerprints of paired dictionaries). Each block is flushed once all of its
+        # channels are written, so no entry is marked as done before that.
+        src_channels = r.get_channels()
+        channels = [dict_name] + [c for c, width in writer.get_channels().items() if src_channels.get(c) == width]
+
+        flush_every, writer.flush_every = writer.flush_every, np.inf
+        try:
+            for start in range(0, np.size(dst_flat), block_size):
+                block = slice(start, start + block_size)
+                for channel in channels:
+                    writer.write_block(dst_flat[block], r.read_entries(src_flat[block], channel), channel)
+                writer.flush()
+        finally:
+            writer.flush_every = flush_every
+
+    filled[dst_flat] = True
+    return filled
+
+
+
+class DictCache:
+    """
+    This class manages a directory of previously generated dictionaries, indexed by the
+    hashes stored in each of them.
+
+    Class Variables:
+        cache_dir:      The directory holding the cached dictionaries
+    """
+
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+    def path_for(self, hashes, backend):
+        """
+        Returns the path under which a dictionary with the given hashes is cached.
+        """
+        name = hashes[seq_hash_name][:16] + "_" + hashes[grid_hash_name][:16]
+        if backend == "hdf5":
+            name += ".h5"
+
+        return os.path.join(self.cache_dir, name)
+
+
+    def entries(self):
+        """
+        Returns a list of (path, hashes) of every readable dictionary in the cache.
+        """
+        out = []
+        for f in sorted(os.listdir(self.cache_dir)):
+            path = os.path.join(self.cache_dir, f)
+            try:
+                with open_reader(path) as r:
+                    out.append((path, r.get_hashes()))
+            except (OSError, KeyError, ValueError):
+                # Not a dictionary (or a broken one), ignore it
+                continue
+
+        return out
+
+
+    def find_exact(self, hashes):
+        """
+        Returns the path of a complete cached dictionary with the same hashes, or None.
+        """
+        for path, h in self.entries():
+            if h.get(seq_hash_name) == hashes[seq_hash_name] and h.get(grid_hash_name) == hashes[grid_hash_name]:
+                with open_reader(path) as r:
+                    if r.is_complete():
+                        return path
+
+        return None
+
+
+    def find_compatible(self, hashes):
+        """
+        Returns the paths of cached dictionaries of the same sequence, but another grid.
+        """
+        return [path for path, h in self.entries() \
+                if h.get(seq_hash_name) == hashes[seq_hash_name] and h.get(grid_hash_name) != hashes[grid_hash_name]]
+
+
+    def fetch(self, hashes, dst, backend):
+        """
+        This method copies a cached dictionary with the given hashes to dst. Returns True
+        on a cache hit, and False if there was nothing to copy.
+        """
+        path = self.find_exact(hashes)
+        if path is None:
+            return False
+
+        copy_dict(path, dst, backend)
+        print(f"Found this dictionary in the cache\nPATH: {path}")
+        return True
+
+
+    def prefill(self, hashes, writer, dst_vals, dst_done=None):
+        """
+        This method copies every entry that compatible cached dictionaries already contain
+        into an open writer. Returns the updated completion mask of the destination.
+        """
+        done = np.zeros(int(np.prod([np.size(dst_vals[n]) for n in val_names])), dtype=bool)
+        if dst_done is not None:
+            done |= dst_done
+
+        for path in self.find_compatible(hashes):
+            done |= copy_entries(path, writer, dst_vals, dst_done=done)
+
+        num = np.count_nonzero(done) - (0 if dst_done is None else np.count_nonzero(dst_done))
+        if num > 0:
+            print(f"Reused {num} entries from the cache")
+
+        return done
+
+
+    def store(self, src, hashes):
+        """
+        This method adds a complete dictionary to the cache (unless it is already there).
+        """
+        backend = backend_of(src)
+        dst = self.path_for(hashes, backend)
+        if os.path.abspath(dst) != os.path.abspath(src) and not os.path.exists(dst):
+            copy_dict(src, dst, backend)
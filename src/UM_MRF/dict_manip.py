@@ -1,5 +1,6 @@
 import numpy as np
 import h5py
+import os
 
 # Globals - We use these to predefine the names of the fields stored in
 # the dictionary file. (mostly to avoid bugs)
@@ -15,42 +16,132 @@ kf_name = "kf_vals"             # Array of magnetization transfer rates that wer
 CBV_name = "CBV_vals"           # Array of CBV values that were simulated
 BAT_name = "BAT_vals"           # Array of BAT values that were simulated
 flip_name = "flip_angle_vals"   # Array of flip angle values that were simulated
+B1_name = "B1_vals"             # Array of B1+ scales that were simulated
+done_name = "done_bitmap"       # Packed bitmap of completed entries (one bit per entry)
+points_name = "param_points"    # (n, 11) table of the parameters of every entry (scattered dictionaries only)
 
+# Names of the parameter value arrays, in the same order as Params.get_cur_idx()
+val_names = [CBV_name, ks_name, kf_name, T1f_name, T2f_name, T1s_name, F_name, alpha_name, BAT_name, flip_name, B1_name]
 
-def init_dict(name, params, num_samples):
+# Values of the parameters that dictionaries written before they existed were simulated at
+# (see fill_vals()). These are the last axes, so the flat indices of such dictionaries are
+# the same as if the axes were there with a single value.
+default_vals = {B1_name: 1.0}
+
+dict_dtype = np.float32         # Data type of the stored dictionary entries
+aux_name = "aux"                # Group (or sub-directory) holding auxiliary arrays (see DictWriter.aux)
+norm_name = "norm"              # Channel caching the norm of every entry (see match.get_norms())
+label_name = "label"            # Channel of the label fingerprints of paired dictionaries (see MRFSim.generate_dict())
+control_name = "control"        # Channel of the control fingerprints of paired dictionaries
+
+
+def init_dict(name, params, num_samples, backend="hdf5", hashes=None, channels=None, aux=None):
     """
-    This function creates and initializes a file in the HDF5 format that will store parameter values,
-    dictionary entries, and the last-stored parameter indices (in case of crash).
+    This function creates and initializes a dictionary that will store parameter values,
+    dictionary entries, the completion bitmap and the last-stored parameter indices (in case of crash).
+
+    Input Parameters:
+        name:           Path of the dictionary (a file for "hdf5", a directory for "memmap")
+        params:         Instance of the Params class holding the values to be simulated, or a
+                        python dict of parameter value arrays (see Params.get_vals()), which
+                        may hold a table of points (see get_dict_shape())
+        num_samples:    Number of samples in each dictionary entry
+        backend:        Either "hdf5" (default) or "memmap" (see dict_memmap.py)
+        hashes:         Optional python dict of hashes identifying how the dictionary was
+                        generated (see dict_cache.py), stored alongside the entries
+        channels:       Optional python dict {name: width} of extra arrays stored for every
+                        entry, next to the dictionary entries themselves
+        aux:            Optional python dict {name: shape} of auxiliary arrays (see DictWriter.aux)
     """
     if name == None:
         # If this happens, we will not be saving data, so we do nothing.
         return
-    
+
+    vals = params if isinstance(params, dict) else params.get_vals()
+
+    if backend == "hdf5":
+        init_hdf5_dict(name, vals, num_samples, hashes, channels, aux)
+    elif backend == "memmap":
+        from .dict_memmap import init_memmap_dict
+        init_memmap_dict(name, vals, num_samples, hashes, channels, aux)
+    else:
+        raise ValueError(f"Error: Unknown dictionary backend '{backend}' (expected 'hdf5' or 'memmap')")
+
+
+def fill_vals(vals):
+    """
+    This function adds the parameters that are missing from the python dict of parameter values
+    of an older dictionary (see default_vals), and the matching columns of its table of points
+    (if any). vals is updated in place and returned.
+    """
+    for n in val_names:
+        if n not in vals:
+            vals[n] = np.array([default_vals[n]])
+
+    if points_name in vals:
+        points = np.asarray(vals[points_name])
+        missing = val_names[points.shape[1]:]
+        if missing:
+            extra = np.broadcast_to([default_vals[n] for n in missing], (len(points), len(missing)))
+            vals[points_name] = np.concatenate([points, extra], axis=1)
+
+    return vals
+
+
+def get_dict_shape(vals):
+    """
+    This function returns the shape of the dictionary described by the python dict of parameter
+    values vals (see Params.get_vals()). Dictionaries are usually a grid, with one axis per
+    parameter. Scattered dictionaries (see adaptive.py) instead hold an arbitrary list of points,
+    given by the (n, 11) table vals[points_name] (one column per name in val_names), and have a
+    single axis of n entries. In that case, vals[n] holds the distinct values of each parameter.
+    """
+    if points_name in vals:
+        return (len(vals[points_name]),)
+
+    return tuple(np.size(vals[n]) for n in val_names)
+
+
+def init_hdf5_dict(name, vals, num_samples, hashes=None, channels=None, aux=None):
+    """
+    This function creates and initializes a file in the HDF5 format. vals is a python dict
+    mapping each name in val_names to the array of values of that parameter. The hashes
+    (if any) are stored as attributes of the file. See init_dict() for channels and aux.
+    """
+    shape = get_dict_shape(vals)
+
     # Now we will initialize the file containing the dictionary.
-    #try:
-    d = h5py.File(name, "w")
+    # libver="latest" is needed so the file can later be written in SWMR mode (see DictWriter)
+    d = h5py.File(name, "w", libver="latest")
     # Load the physiological parameter values into the file
-    d.create_dataset(T1f_name, np.shape(params.T1_f_vals), data=params.T1_f_vals)
-    d.create_dataset(T2f_name, np.shape(params.T2_f_vals), data=params.T2_f_vals)
-    d.create_dataset(T1s_name, np.shape(params.T1_s_vals), data=params.T1_s_vals)
-    d.create_dataset(alpha_name, np.shape(params.alpha_vals), data=params.alpha_vals)
-    d.create_dataset(F_name, np.shape(params.F_vals), data=params.F_vals)
-    d.create_dataset(ks_name, np.shape(params.ks_vals), data=params.ks_vals)
-    d.create_dataset(kf_name, np.shape(params.kf_vals), data=params.kf_vals)
-    d.create_dataset(CBV_name, np.shape(params.CBV_vals), data=params.CBV_vals)
-    d.create_dataset(BAT_name, np.shape(params.BAT_vals), data=params.BAT_vals)
-    d.create_dataset(flip_name, np.shape(params.flip_vals), data=params.flip_vals)
+    for n in val_names:
+        d.create_dataset(n, np.shape(vals[n]), data=vals[n])
+    if points_name in vals:
+        d.create_dataset(points_name, data=np.asarray(vals[points_name], dtype=np.float64))
 
     # Set asside space for the last-stored parameter indices
-    d.create_dataset(idx_name, np.size(params.get_shape()))
+    d.create_dataset(idx_name, len(shape), dtype=np.float32)
+
+    # Set asside space for the completion bitmap. Bit i (C-order flat index over the
+    # parameter shape) is set once entry i is safely on disk.
+    d.create_dataset(done_name, (bitmap_size(np.prod(shape)),), dtype=np.uint8)
     
     # Set asside space for the actual dictionary
     #dict.create_dataset(dict_name, params.get_shape() + (num_samples,), compression='gzip')
-    d.create_dataset(dict_name, params.get_shape() + (num_samples,))
-    #dict.visititems(lambda name, obj: print(name))
+    d.create_dataset(dict_name, shape + (num_samples,), dtype=dict_dtype)
+
+    # Datasets can't be created once the file is in SWMR mode, so everything else goes in now
+    for key, width in (channels or {}).items():
+        d.create_dataset(key, shape + (width,), dtype=dict_dtype)
+
+    g = d.create_group(aux_name)
+    for key, aux_shape in (aux or {}).items():
+        g.create_dataset(key, aux_shape, dtype=np.float64)
+
+    # Attributes can't be written once the file is in SWMR mode, so they go in now
+    for key, val in (hashes or {}).items():
+        d.attrs[key] = val
     d.close()
-    # except Exception as e:
-    #     raise e
 
 
 
@@ -58,8 +149,746 @@ def init_dict(name, params, num_samples):
 def store_entry(name, param_idx, entry):
     """
     This function stores an entry in the dictionary and updates the last simulated index.
+    The entry is flushed to disk BEFORE its bit is set in the completion bitmap, so a crash
+    can never leave a bit set for an entry that was not fully written.
     """
 
     with h5py.File(name, "r+") as dict:
+        add_done_bitmap(dict)
         dict[dict_name][param_idx + (slice(None),)] = entry
         dict[idx_name][:] = list(param_idx)
+        dict.flush()
+
+        flat_idx = np.ravel_multi_index(param_idx, dict[dict_name].shape[:-1])
+        mark_done(dict, np.array([flat_idx]))
+
+
+def bitmap_size(num_entries):
+    """
+    Number of bytes needed to hold one bit per dictionary entry.
+    """
+    return int(np.ceil(num_entries / 8))
+
+
+def mark_done(d, flat_inds):
+    """
+    This function sets the completion bits of the given entries in an open dictionary file.
+    Only the bytes that actually change are read and rewritten.
+
+    Input Parameters:
+        d:          An open (writable) h5py.File
+        flat_inds:  Array of C-order flat entry indices that have been stored
+    """
+    set_bits(d[done_name], flat_inds)
+    d.flush()
+
+
+def set_bits(bitmap, flat_inds):
+    """
+    This function sets bits in a packed bitmap (an h5py dataset or a numpy array/memmap
+    of uint8). Only the range of bytes that actually changes is read and rewritten.
+    """
+    flat_inds = np.asarray(flat_inds, dtype=np.int64)
+    if np.size(flat_inds) == 0:
+        return
+
+    lo = np.min(flat_inds) // 8
+    hi = np.max(flat_inds) // 8 + 1
+
+    # Unpack the affected byte range, set the new bits, and write it back
+    bits = np.unpackbits(bitmap[lo:hi], bitorder="little")
+    bits[flat_inds - 8 * lo] = 1
+    bitmap[lo:hi] = np.packbits(bits, bitorder="little")
+
+
+def legacy_done(last_idx, shape):
+    """
+    This function builds a completion mask for dictionaries written before the completion
+    bitmap existed. All we know is the last index that was stored, so every entry up to
+    (and including) that index, in iteration order, is assumed to be done. An all-zero index
+    is ambiguous, so in that case we assume nothing was done.
+    """
+    done = np.zeros(int(np.prod(shape)), dtype=bool)
+    last_idx = tuple(np.int32(last_idx))
+    if np.any(last_idx):
+        last = np.ravel_multi_index(last_idx, shape, order="F")
+        done[:last + 1] = True
+
+    # Convert from iteration order to C order
+    return done.reshape(shape, order="F").ravel()
+
+
+def add_done_bitmap(d):
+    """
+    This function adds the completion bitmap to an open (writable) dictionary file written
+    before the bitmap existed, filled in from the last stored index (see legacy_done()).
+    Files that already have one are left as they are.
+    """
+    if done_name in d:
+        return
+
+    done = legacy_done(d[idx_name][:], d[dict_name].shape[:-1])
+    d.create_dataset(done_name, data=np.packbits(done, bitorder="little"))
+
+
+def read_done(d, num_entries):
+    """
+    This function returns a boolean array of length num_entries where element i is True
+    if entry i (C-order flat index) has been stored.
+
+    Input Parameters:
+        d:              An open h5py.File
+        num_entries:    The total number of entries in the dictionary
+    """
+    if done_name not in d:
+        return None
+
+    return np.unpackbits(d[done_name][:], count=num_entries, bitorder="little").astype(bool)
+
+
+
+class DictWriter:
+    """
+    This class holds a persistent handle on a dictionary file for the duration of
+    MRFSim.generate_dict(), instead of opening and closing the file for each entry.
+
+    The file is switched to HDF5 single-writer/multiple-reader (SWMR) mode, so any
+    number of DictReader instances (possibly in other processes) can read the entries
+    that have been completed so far while the dictionary is still being generated. Files
+    created by older versions don't support SWMR, and are written in the normal mode.
+
+    Entries are written as they come in, but their completion bits are only set when
+    flush() is called (every flush_every entries). The entries are flushed to disk
+    before their bits are set, so readers never see a bit for an incomplete entry.
+
+    Class Variables:
+        file:           The open h5py.File (in SWMR mode if the file supports it)
+        flush_every:    Number of entries written between automatic flushes
+        pending:        C-order flat indices of the entries written since the last flush
+    """
+
+
+    def __init__(self, name, flush_every=100):
+        self.file = h5py.File(name, "r+", libver="latest")
+        self.shape = self.file[dict_name].shape[:-1]
+
+        # Datasets can't be created in SWMR mode
+        add_done_bitmap(self.file)
+
+        # SWMR needs a file created with libver="latest" (superblock version 3 or more, see
+        # init_hdf5_dict()). Older files are written in the normal mode.
+        if self.file.id.get_create_plist().get_version()[0] >= 3:
+            self.file.swmr_mode = True
+
+        self.num_samples = self.file[dict_name].shape[-1]
+        self.flush_every = flush_every
+        self.pending = []
+        self.last_idx = None
+        self.aux = {}
+
+
+    def write(self, param_idx, entry, **channels):
+        """
+        This method stores one entry in the dictionary. param_idx is the tuple of
+        parameter indices (see Params.get_cur_idx()). Any keyword arguments are stored
+        in the channel (see init_dict()) of the same name.
+        """
+        # Older dictionaries don't have the last axes (see default_vals)
+        param_idx = tuple(param_idx)[:len(self.shape)]
+
+        if self.num_samples > 0:
+            self.file[dict_name][param_idx + (slice(None),)] = entry
+        for key, val in channels.items():
+            self.file[key][param_idx + (slice(None),)] = val
+
+        self.pending.append(np.ravel_multi_index(param_idx, self.shape))
+        self.last_idx = param_idx
+
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+
+    def write_block(self, flat_inds, entries, channel=dict_name):
+        """
+        This method stores several entries at once. flat_inds are C-order flat indices
+        and entries is a (n, width) array.
+        """
+        dataset = self.file[channel]
+        width = dataset.shape[-1]
+        flat_inds = np.asarray(flat_inds, dtype=np.int64)
+        entries = np.asarray(entries).reshape(-1, width)
+
+        # Each run of consecutive indices is written with a few slices (see range_slices())
+        order, runs = index_runs(flat_inds)
+        for lo, hi in runs:
+            first = flat_inds[order[lo]]
+            for start, sl, box in range_slices(self.shape, first, first + hi - lo):
+                i = lo + start - first
+                dataset[sl] = entries[order[i:i + int(np.prod(box))]].reshape(box + (width,))
+
+        self.pending += list(flat_inds)
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+
+    def set_pending(self, flat_inds, last_idx=None):
+        """
+        This method replaces the entries that are marked as done on the next flush, and the
+        last stored index. This is used when entries are copied with write_block() from a
+        dictionary where only some of them were done (see convert_dict()).
+        """
+        self.pending = list(flat_inds)
+        self.last_idx = last_idx
+
+
+    def flush(self):
+        """
+        This method flushes all pending entries (and the auxiliary arrays) to disk and
+        then marks the entries as done.
+        """
+        if len(self.pending) == 0:
+            return
+
+        if self.last_idx is not None:
+            self.file[idx_name][:] = list(self.last_idx)
+
+        # write_aux() flushes the entries along with the auxiliary arrays, and mark_done()
+        # flushes the bitmap
+        self.write_aux()
+        mark_done(self.file, np.array(self.pending))
+        self.pending = []
+
+
+    def get_channels(self):
+        """
+        Returns a python dict {name: width} of the extra per-entry channels (see DictReader.get_channels()).
+        """
+        return {key: self.file[key].shape[-1] for key in self.file \
+                if isinstance(self.file[key], h5py.Dataset) and key not in val_names + [dict_name, idx_name, done_name, points_name]}
+
+
+    def read_box(self, sl, channel=dict_name):
+        """
+        Returns the entries of the channel (see init_dict()) selected by sl, a tuple of slices
+        (see DictReader.read_box()).
+        """
+        return np.asarray(self.file[channel][tuple(sl)])
+
+
+    def write_box(self, sl, data, channel=dict_name):
+        """
+        This method overwrites the entries of the channel (see init_dict()) selected by sl (see
+        read_box()) with data, and flushes them to disk. It does not change which entries are
+        marked as done.
+        """
+        self.file[channel][tuple(sl)] = data
+        self.file.flush()
+
+
+    def write_aux(self):
+        """
+        This method writes the auxiliary arrays held in self.aux, and flushes the file. self.aux
+        maps the names of auxiliary datasets (see init_dict()) to arrays that are kept up to
+        date by the caller, which are written on every flush, together with the entries they
+        describe.
+        """
+        for key, val in self.aux.items():
+            self.file[aux_name][key][...] = val
+        self.file.flush()
+
+
+    def close(self):
+        self.flush()
+        self.write_aux()
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+class DictReader:
+    """
+    This class provides read access to a dictionary file, including one that is still
+    being generated by a DictWriter. Call refresh() to see the entries that have been
+    completed since the file was opened.
+
+    Example:
+        with DictReader("dict.h5") as r:
+            while not r.is_complete():
+                inds = r.completed_indices()
+                entries = r.read_entries(inds)
+                ...
+                r.refresh()
+    """
+
+
+    def __init__(self, name):
+        try:
+            self.file = h5py.File(name, "r", libver="latest", swmr=True)
+        except (OSError, ValueError):
+            # File was not written in a SWMR compatible format (older dictionaries)
+            self.file = h5py.File(name, "r")
+
+        self.shape = self.file[dict_name].shape[:-1]
+        self.num_samples = self.file[dict_name].shape[-1]
+        self.num_entries = int(np.prod(self.shape))
+
+
+    def refresh(self):
+        """
+        This method updates the view of the file with whatever the writer has flushed.
+        """
+        if self.file.swmr_mode:
+            self.file[dict_name].refresh()
+            self.file[idx_name].refresh()
+            if done_name in self.file:
+                self.file[done_name].refresh()
+            for key in self.get_channels():
+                self.file[key].refresh()
+            for key in self.aux_names():
+                self.file[aux_name][key].refresh()
+
+
+    def done_mask(self):
+        """
+        Returns a boolean array (one element per entry, C-order flat index) that is True
+        for every entry that has been completed.
+        """
+        done = read_done(self.file, self.num_entries)
+        if done is None:
+            done = legacy_done(self.file[idx_name][:], self.shape)
+
+        return done
+
+
+    def completed_indices(self):
+        """
+        Returns the C-order flat indices of all completed entries.
+        """
+        return np.flatnonzero(self.done_mask())
+
+
+    def is_complete(self):
+        return bool(np.all(self.done_mask()))
+
+
+    def get_vals(self):
+        """
+        Returns a dictionary of the parameter value arrays stored in the file (along with the
+        table of points of a scattered dictionary, see get_dict_shape()).
+        """
+        vals = {n: self.file[n][:] for n in val_names if n in self.file}
+        if points_name in self.file:
+            vals[points_name] = self.file[points_name][...]
+
+        return fill_vals(vals)
+
+
+    def get_last_idx(self):
+        """
+        Returns the last stored parameter indices (see Params.get_cur_idx()).
+        """
+        return tuple(int(i) for i in self.file[idx_name][:])
+
+
+    def get_hashes(self):
+        """
+        Returns the python dict of hashes stored in the file (empty if there are none).
+        """
+        return {key: str(val) for key, val in self.file.attrs.items()}
+
+
+    def get_channels(self):
+        """
+        Returns a python dict {name: width} of the extra per-entry channels (see init_dict()).
+        """
+        return {key: self.file[key].shape[-1] for key in self.file \
+                if isinstance(self.file[key], h5py.Dataset) and key not in val_names + [dict_name, idx_name, done_name, points_name]}
+
+
+    def aux_names(self):
+        """
+        Returns the names of the auxiliary arrays stored in the file.
+        """
+        return list(self.file[aux_name].keys()) if aux_name in self.file else []
+
+
+    def read_aux(self, key):
+        """
+        Returns the auxiliary array with the given name, or None if there is no such array.
+        """
+        if key not in self.aux_names():
+            return None
+
+        return self.file[aux_name][key][...]
+
+
+    def read_entries(self, flat_inds, channel=dict_name):
+        """
+        Returns a (n, width) array of the entries at the given C-order flat indices.
+        """
+        dataset = self.file[channel]
+        flat_inds = np.asarray(flat_inds, dtype=np.int64).reshape(-1)
+        out = np.empty((np.size(flat_inds), dataset.shape[-1]))
+
+        if 4 * np.size(flat_inds) >= self.num_entries:
+            # Reading everything a block at a time is faster than many small reads, and never
+            # holds the whole channel
+            order = np.argsort(flat_inds, kind="stable")
+            inds = flat_inds[order]
+            for start, entries in self.iter_blocks(channel=channel):
+                lo, hi = np.searchsorted(inds, [start, start + len(entries)])
+                out[order[lo:hi]] = entries[inds[lo:hi] - start]
+
+            return out
+
+        # Otherwise, each run of consecutive indices is read with a few slices (see
+        # range_slices())
+        order, runs = index_runs(flat_inds)
+        for lo, hi in runs:
+            first = flat_inds[order[lo]]
+            for start, sl, box in range_slices(self.shape, first, first + hi - lo):
+                i = lo + start - first
+                out[order[i:i + int(np.prod(box))]] = np.asarray(dataset[sl]).reshape(-1, out.shape[1])
+
+        return out
+
+
+    def read_box(self, sl, channel=dict_name):
+        """
+        Returns the entries selected by sl, a tuple of slices (one per parameter axis, steps are
+        allowed), as a (n_0, ..., n_9, width) array.
+        """
+        return np.asarray(self.file[channel][tuple(sl)])
+
+
+    def iter_blocks(self, block_size=4096, channel=dict_name):
+        """
+        This generator goes through the whole dictionary (or channel) in order of C-order flat
+        index, yielding (start, entries) where entries is a (n, width) array of the n <= block_size
+        entries starting at flat index start. Every block is read with a single slice of the dataset.
+        """
+        yield from hdf5_blocks(self.file[channel], self.shape, block_size)
+
+
+    def close(self):
+        self.file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+def block_slices(shape, block_size):
+    """
+    This generator splits the C-order flat indices of an array of shape shape into contiguous
+    blocks of at most block_size entries (see DictReader.iter_blocks()), yielding (start, sl)
+    where sl is the index of the block, to be used as dataset[sl]. Each block is a slice over a
+    range of one axis (k) for fixed indices of the axes before it, holding all the entries of
+    the axes after it.
+    """
+    shape = tuple(shape)
+
+    # Find the first axis such that everything after it fits in a block
+    k = len(shape)
+    while (k > 0) and (np.prod(shape[k - 1:]) <= block_size):
+        k -= 1
+
+    if k == 0:
+        yield 0, ()
+        return
+
+    rows = int(np.prod(shape[k:]))
+    step = max(1, block_size // rows)
+    start = 0
+    for prefix in np.ndindex(*shape[:k - 1]):
+        for a in range(0, shape[k - 1], step):
+            b = min(a + step, shape[k - 1])
+            yield start, prefix + (slice(a, b),)
+            start += (b - a) * rows
+
+
+def index_runs(flat_inds):
+    """
+    This function splits the flat indices flat_inds into runs of consecutive indices. It returns
+    order, the permutation that sorts flat_inds, and the list of (lo, hi) bounds of the runs in
+    flat_inds[order] (run i is flat_inds[order[lo:hi]]).
+    """
+    order = np.argsort(flat_inds, kind="stable")
+    breaks = np.flatnonzero(np.diff(flat_inds[order]) != 1) + 1
+    bounds = np.concatenate([[0], breaks, [np.size(flat_inds)]]).astype(np.int64).tolist()
+
+    return order, [(lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+
+
+def range_slices(shape, start, stop):
+    """
+    This generator splits the C-order flat indices start to stop - 1 of an array of shape shape
+    into the fewest boxes that each are a single slice (as in block_slices(), at most two per
+    axis), yielding (start, sl, box) where sl is the index of the box, to be used as
+    dataset[sl], and box is the shape of the box (without the last axis of the dataset).
+    """
+    shape = tuple(int(n) for n in shape)
+    while start < stop:
+        # Grow the box over the last axes while start is at the beginning of one and it fits
+        k = len(shape)
+        rows = 1
+        while (k > 0) and (start % (rows * shape[k - 1]) == 0) and (start + rows * shape[k - 1] <= stop):
+            rows *= shape[k - 1]
+            k -= 1
+
+        if k == 0:
+            yield start, (), shape
+            return
+
+        # Then take as many of those along axis k - 1 as fit
+        idx = np.unravel_index(start // rows, shape[:k])
+        n = min((stop - start) // rows, shape[k - 1] - int(idx[-1]))
+        yield start, tuple(int(i) for i in idx[:-1]) + (slice(int(idx[-1]), int(idx[-1]) + n),), (n,) + shape[k:]
+        start += n * rows
+
+
+def hdf5_blocks(dataset, shape, block_size):
+    """
+    This generator reads dataset (of shape shape + (width,)) a block of contiguous C-order flat
+    indices at a time, see DictReader.iter_blocks() and block_slices().
+    """
+    width = dataset.shape[-1]
+    for start, sl in block_slices(shape, block_size):
+        yield start, np.asarray(dataset[sl]).reshape(-1, width)
+
+
+def map_channel(name, key, width, func, block_size=4096, channel=dict_name):
+    """
+    This function computes a new channel (see init_dict()) of a dictionary that is not being
+    written to, one block at a time, so that neither channel is ever held in memory as a whole.
+
+    Input Parameters:
+        name:           Path of the dictionary (either backend)
+        key:            Name of the new channel (replaced if it already exists)
+        width:          Width of the new channel
+        func:           Function taking a (n, width_in) block of channel and returning the
+                        corresponding (n, width) block of the new channel
+        block_size:     Number of entries processed at a time
+        channel:        Channel the new one is computed from (the entries by default)
+    """
+    if os.path.isdir(name):
+        src = np.load(os.path.join(name, channel + ".npy"), mmap_mode="r")
+        path = os.path.join(name, key)
+        dst = np.lib.format.open_memmap(path + ".tmp.npy", mode="w+", dtype=dict_dtype, shape=src.shape[:-1] + (width,))
+
+        flat_src = src.reshape(-1, src.shape[-1])
+        flat_dst = dst.reshape(-1, width)
+        for start in range(0, len(flat_src), block_size):
+            flat_dst[start:start + block_size] = func(np.asarray(flat_src[start:start + block_size]))
+
+        dst.flush()
+        del dst
+        os.replace(path + ".tmp.npy", path + ".npy")
+        return
+
+    with h5py.File(name, "r+") as d:
+        src = d[channel]
+        shape = src.shape[:-1]
+        if key in d:
+            del d[key]
+        dst = d.create_dataset(key, shape + (width,), dtype=dict_dtype)
+
+        for start, sl in block_slices(shape, block_size):
+            block = np.asarray(src[sl])
+            dst[sl] = np.reshape(func(block.reshape(-1, block.shape[-1])), block.shape[:-1] + (width,))
+
+
+
+
+def index_to_vals(vals, flat_inds):
+    """
+    This function returns the parameter values of the entries at the given C-order flat indices.
+
+    Input Parameters:
+        vals:           Python dict mapping each name in val_names to the values of that
+                        parameter (see DictReader.get_vals())
+        flat_inds:      Array of C-order flat indices
+
+    Output Values:
+        Python dict mapping each name in val_names to an array of the same shape as flat_inds
+    """
+    if points_name in vals:
+        # Scattered dictionary, the parameters of every entry are in the table
+        points = np.asarray(vals[points_name])[np.asarray(flat_inds, dtype=np.int64)]
+        return {n: points[..., a] for a, n in enumerate(val_names)}
+
+    shape = get_dict_shape(vals)
+    inds = np.unravel_index(np.asarray(flat_inds, dtype=np.int64), shape)
+
+    return {n: np.atleast_1d(vals[n])[i] for n, i in zip(val_names, inds)}
+
+
+def open_reader(name):
+    """
+    This function opens a dictionary for reading, whichever backend it was written with.
+    Directories are memory-mapped dictionaries (see dict_memmap.py), files are HDF5.
+    """
+    if os.path.isdir(name):
+        from .dict_memmap import MemmapDictReader
+        return MemmapDictReader(name)
+
+    return DictReader(name)
+
+
+def open_writer(name, flush_every=100):
+    """
+    This function opens an initialized dictionary (see init_dict()) for writing, whichever
+    backend it was created with.
+    """
+    if os.path.isdir(name):
+        from .dict_memmap import MemmapDictWriter
+        return MemmapDictWriter(name, flush_every=flush_every)
+
+    return DictWriter(name, flush_every=flush_every)
+
+
+def add_channel(name, key, data):
+    """
+    This function adds (or replaces) a channel (see init_dict()) of a dictionary that is not
+    being written to. data is a shape + (width,) array. This is how results computed from a
+    complete dictionary (e.g. the norms of the entries) are cached alongside it.
+    """
+    data = np.asarray(data, dtype=dict_dtype)
+
+    if os.path.isdir(name):
+        path = os.path.join(name, key)
+        np.save(path + ".tmp.npy", data)
+        os.replace(path + ".tmp.npy", path + ".npy")
+        return
+
+    with h5py.File(name, "r+") as d:
+        if key in d:
+            del d[key]
+        d.create_dataset(key, data=data)
+
+
+def add_aux(name, key, data):
+    """
+    This function adds (or replaces) an auxiliary array (see init_dict()) of a dictionary that
+    is not being written to.
+    """
+    data = np.asarray(data, dtype=np.float64)
+
+    if os.path.isdir(name):
+        path = os.path.join(name, aux_name, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path + ".tmp.npy", data)
+        os.replace(path + ".tmp.npy", path + ".npy")
+        return
+
+    with h5py.File(name, "r+") as d:
+        g = d.require_group(aux_name)
+        if key in g:
+            del g[key]
+        g.create_dataset(key, data=data)
+
+
+def trim_dict(name, widths, drop_aux=(), block_size=4096):
+    """
+    This function narrows or drops channels (see init_dict()) and drops auxiliary arrays of a
+    dictionary that is not being written to, and gives the space they took back.
+
+    Memory-mapped channels are rewritten one at a time (see map_channel()). HDF5 doesn't give
+    back the space of deleted datasets, so the file is copied (the other datasets as they
+    are, see h5py.Group.copy()) to a temporary file that then replaces it.
+
+    Input Parameters:
+        name:           Path of the dictionary (either backend)
+        widths:         Python dict mapping channel names to the number of values of each entry
+                        that are kept (the first ones), 0 drops the channel
+        drop_aux:       Names of the auxiliary arrays that are dropped
+        block_size:     Number of entries copied at a time
+    """
+    if os.path.isdir(name):
+        for key, width in widths.items():
+            path = os.path.join(name, key + ".npy")
+            if width == 0:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                map_channel(name, key, width, lambda entries: entries[:, :width], block_size, channel=key)
+
+        for key in drop_aux:
+            path = os.path.join(name, aux_name, key + ".npy")
+            if os.path.exists(path):
+                os.remove(path)
+        return
+
+    tmp_name = name + ".trim"
+    with h5py.File(name, "r") as src, h5py.File(tmp_name, "w", libver="latest") as dst:
+        for key, val in src.attrs.items():
+            dst.attrs[key] = val
+
+        for key in src:
+            if key == aux_name:
+                g = dst.create_group(aux_name)
+                for a in src[aux_name]:
+                    if a not in drop_aux:
+                        src.copy(src[aux_name][a], g, a)
+            elif key not in widths:
+                src.copy(src[key], dst, key)
+            elif widths[key] > 0:
+                shape = src[key].shape[:-1]
+                out = dst.create_dataset(key, shape + (widths[key],), dtype=dict_dtype)
+                for start, sl in block_slices(shape, block_size):
+                    out[sl] = src[key][sl][..., :widths[key]]
+
+    os.replace(tmp_name, name)
+
+
+def convert_dict(src, dst, backend, block_size=4096):
+    """
+    This function copies a dictionary (its parameter values, entries, channels, auxiliary
+    arrays, completion bitmap and last stored index) to a new dictionary using the given
+    backend. This can be used to go from HDF5 to a memory-mapped dictionary and back.
+
+    Input Parameters:
+        src:            Path of the existing dictionary
+        dst:            Path of the new dictionary
+        backend:        Backend of the new dictionary ("hdf5" or "memmap")
+        block_size:     Number of entries that are copied at a time
+    """
+    with open_reader(src) as r:
+        vals = r.get_vals()
+        done = r.done_mask()
+        last_idx = r.get_last_idx()
+        hashes = r.get_hashes()
+        channels = r.get_channels()
+        aux = {key: r.read_aux(key) for key in r.aux_names()}
+        aux_shapes = {key: np.shape(val) for key, val in aux.items()}
+
+        if backend == "hdf5":
+            init_hdf5_dict(dst, vals, r.num_samples, hashes, channels, aux_shapes)
+        elif backend == "memmap":
+            from .dict_memmap import init_memmap_dict
+            init_memmap_dict(dst, vals, r.num_samples, hashes, channels, aux_shapes)
+        else:
+            raise ValueError(f"Error: Unknown dictionary backend '{backend}' (expected 'hdf5' or 'memmap')")
+
+        with open_writer(dst, flush_every=np.inf) as w:
+            # Copy the entries a block at a time, so that we never hold the whole dictionary
+            for channel in ([dict_name] if r.num_samples > 0 else []) + list(channels):
+                for start in range(0, r.num_entries, block_size):
+                    inds = np.arange(start, min(start + block_size, r.num_entries))
+                    w.write_block(inds, r.read_entries(inds, channel), channel)
+
+            # Copy the completion state (only the entries that were done are marked as done)
+            w.aux = aux
+            w.set_pending(np.flatnonzero(done), last_idx)
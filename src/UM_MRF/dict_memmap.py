@@ -0,0 +1,368 @@
+##########################################################################
+#   This file contains the memory-mapped dictionary backend. Instead of  #
+#   an HDF5 file, the dictionary is a directory holding:                 #
+#       dictionary.npy      the raw entries (shape..., num_samples)      #
+#       done_bitmap.npy     the packed completion bitmap                 #
+#       params.json         the parameter value arrays and cur_index     #
+#       param_points.npy    the table of points (scattered dictionaries) #
+#       <channel>.npy       any extra per-entry channels                 #
+#       aux/<name>.npy      any auxiliary arrays                         #
+#   The .npy files can be opened with np.load(..., mmap_mode="r") so     #
+#   that matching code gets zero-copy access through the page cache.     #
+##########################################################################
+
+import numpy as np
+import json
+import os
+from .dict_manip import *
+
+sidecar_name = "params.json"    # Name of the JSON sidecar (parameter values and cur_index)
+hashes_name = "hashes"          # Key of the hashes in the sidecar (see dict_cache.py)
+
+
+def init_memmap_dict(name, vals, num_samples, hashes=None, channels=None, aux=None):
+    """
+    This function creates and initializes a memory-mapped dictionary in the directory name.
+    vals is a python dict mapping each name in val_names to the array of values of that parameter.
+    The hashes (if any) are stored in the sidecar. See init_dict() for channels and aux.
+    """
+    shape = get_dict_shape(vals)
+    os.makedirs(name, exist_ok=True)
+
+    if points_name in vals:
+        np.save(os.path.join(name, points_name + ".npy"), np.asarray(vals[points_name], dtype=np.float64))
+
+    # Set asside space for the actual dictionary and the completion bitmap.
+    # open_memmap() writes the .npy header, so these can be opened with np.load().
+    d = np.lib.format.open_memmap(os.path.join(name, dict_name + ".npy"), mode="w+", dtype=dict_dtype, shape=shape + (num_samples,))
+    del d
+    b = np.lib.format.open_memmap(os.path.join(name, done_name + ".npy"), mode="w+", dtype=np.uint8, shape=(bitmap_size(np.prod(shape)),))
+    del b
+
+    for key, width in (channels or {}).items():
+        c = np.lib.format.open_memmap(os.path.join(name, key + ".npy"), mode="w+", dtype=dict_dtype, shape=shape + (width,))
+        del c
+
+    os.makedirs(os.path.join(name, aux_name), exist_ok=True)
+    for key, aux_shape in (aux or {}).items():
+        np.save(os.path.join(name, aux_name, key + ".npy"), np.zeros(aux_shape))
+
+    # The parameter values and the last-stored indices go in the sidecar
+    sidecar = {n: np.asarray(vals[n]).tolist() for n in val_names}
+    sidecar[idx_name] = [0] * len(shape)
+    sidecar[hashes_name] = dict(hashes or {})
+    write_sidecar(name, sidecar)
+
+
+def read_sidecar(name):
+    with open(os.path.join(name, sidecar_name), "r") as f:
+        return json.load(f)
+
+
+def write_sidecar(name, sidecar):
+    """
+    This function rewrites the JSON sidecar atomically (write to a temporary file, then
+    rename it), so a crash can't leave a half written sidecar behind.
+    """
+    path = os.path.join(name, sidecar_name)
+    with open(path + ".tmp", "w") as f:
+        json.dump(sidecar, f)
+    os.replace(path + ".tmp", path)
+
+
+
+def list_channels(name):
+    """
+    Returns the names of the extra per-entry channels of the memory-mapped dictionary name.
+    """
+    return sorted(f[:-4] for f in os.listdir(name) if f.endswith(".npy") and f[:-4] not in (dict_name, done_name, points_name))
+
+
+
+class MemmapDictWriter:
+    """
+    This class is the memory-mapped counterpart of DictWriter (see dict_manip.py), and has
+    the same interface. Entries are written straight into the mapped dictionary.npy, and on
+    flush() the mapping is synced to disk before the completion bits are set.
+    """
+
+
+    def __init__(self, name, flush_every=100):
+        self.name = name
+        self.dict = np.load(os.path.join(name, dict_name + ".npy"), mmap_mode="r+")
+        self.done = np.load(os.path.join(name, done_name + ".npy"), mmap_mode="r+")
+
+        self.channels = {key: np.load(os.path.join(name, key + ".npy"), mmap_mode="r+") for key in list_channels(name)}
+        self.channels[dict_name] = self.dict
+
+        self.shape = self.dict.shape[:-1]
+        self.num_samples = self.dict.shape[-1]
+        self.flush_every = flush_every
+        self.pending = []
+        self.last_idx = None
+        self.aux = {}
+
+
+    def write(self, param_idx, entry, **channels):
+        """
+        This method stores one entry in the dictionary. param_idx is the tuple of
+        parameter indices (see Params.get_cur_idx()). Any keyword arguments are stored
+        in the channel (see init_dict()) of the same name.
+        """
+        # Older dictionaries don't have the last axes (see default_vals)
+        param_idx = tuple(param_idx)[:len(self.shape)]
+
+        if self.num_samples > 0:
+            self.dict[param_idx] = entry
+        for key, val in channels.items():
+            self.channels[key][param_idx] = val
+
+        self.pending.append(np.ravel_multi_index(param_idx, self.shape))
+        self.last_idx = param_idx
+
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+
+    def write_block(self, flat_inds, entries, channel=dict_name):
+        """
+        This method stores several entries at once. flat_inds are C-order flat indices
+        and entries is a (n, width) array.
+        """
+        c = self.channels[channel]
+        c.reshape(-1, c.shape[-1])[flat_inds] = entries
+
+        self.pending += list(flat_inds)
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+
+    def set_pending(self, flat_inds, last_idx=None):
+        """
+        This method replaces the entries that are marked as done on the next flush, and the
+        last stored index (see DictWriter.set_pending()).
+        """
+        self.pending = list(flat_inds)
+        self.last_idx = last_idx
+
+
+    def flush(self):
+        """
+        This method syncs all pending entries (and the auxiliary arrays) to disk and
+        then marks the entries as done.
+        """
+        if len(self.pending) == 0:
+            return
+
+        self.write_aux()
+        for c in self.channels.values():
+            c.flush()
+
+        set_bits(self.done, self.pending)
+        self.done.flush()
+
+        if self.last_idx is not None:
+            sidecar = read_sidecar(self.name)
+            sidecar[idx_name] = [int(i) for i in self.last_idx]
+            write_sidecar(self.name, sidecar)
+
+        self.pending = []
+
+
+    def get_channels(self):
+        """
+        Returns a python dict {name: width} of the extra per-entry channels (see DictReader.get_channels()).
+        """
+        return {key: c.shape[-1] for key, c in self.channels.items() if key != dict_name}
+
+
+    def read_box(self, sl, channel=dict_name):
+        """
+        Returns a copy of the entries of the channel selected by sl (see DictWriter.read_box()).
+        """
+        return np.array(self.channels[channel][tuple(sl)])
+
+
+    def write_box(self, sl, data, channel=dict_name):
+        """
+        This method overwrites the entries of the channel selected by sl with data, and syncs
+        them to disk (see DictWriter.write_box()).
+        """
+        self.channels[channel][tuple(sl)] = data
+        self.channels[channel].flush()
+
+
+    def write_aux(self):
+        """
+        This method writes the auxiliary arrays held in self.aux (see DictWriter.write_aux()).
+        Each one is written to a temporary file that is then renamed, so it is replaced atomically.
+        """
+        for key, val in self.aux.items():
+            path = os.path.join(self.name, aux_name, key)
+            np.save(path + ".tmp.npy", val)
+            os.replace(path + ".tmp.npy", path + ".npy")
+
+
+    def close(self):
+        self.flush()
+        self.write_aux()
+        del self.dict
+        del self.channels
+        del self.done
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+class MemmapDictReader:
+    """
+    This class is the memory-mapped counterpart of DictReader (see dict_manip.py), and has
+    the same interface. entries() gives direct (zero-copy) access to all fingerprints.
+    """
+
+
+    def __init__(self, name):
+        self.name = name
+        self.dict = np.load(os.path.join(name, dict_name + ".npy"), mmap_mode="r")
+        self.sidecar = read_sidecar(name)
+
+        self.shape = self.dict.shape[:-1]
+        self.num_samples = self.dict.shape[-1]
+        self.num_entries = int(np.prod(self.shape))
+
+
+    def refresh(self):
+        """
+        Writes to the mapped dictionary are visible right away, we only need to reload
+        the sidecar.
+        """
+        self.sidecar = read_sidecar(self.name)
+
+
+    def done_mask(self):
+        """
+        Returns a boolean array (one element per entry, C-order flat index) that is True
+        for every entry that has been completed.
+        """
+        done = np.load(os.path.join(self.name, done_name + ".npy"))
+        return np.unpackbits(done, count=self.num_entries, bitorder="little").astype(bool)
+
+
+    def completed_indices(self):
+        """
+        Returns the C-order flat indices of all completed entries.
+        """
+        return np.flatnonzero(self.done_mask())
+
+
+    def is_complete(self):
+        return bool(np.all(self.done_mask()))
+
+
+    def get_vals(self):
+        """
+        Returns a dictionary of the parameter value arrays stored in the sidecar (along with the
+        table of points of a scattered dictionary, see get_dict_shape()).
+        """
+        vals = {n: np.array(self.sidecar[n]) for n in val_names if n in self.sidecar}
+        path = os.path.join(self.name, points_name + ".npy")
+        if os.path.exists(path):
+            vals[points_name] = np.load(path)
+
+        return fill_vals(vals)
+
+
+    def get_last_idx(self):
+        """
+        Returns the last stored parameter indices (see Params.get_cur_idx()).
+        """
+        return tuple(self.sidecar[idx_name])
+
+
+    def get_hashes(self):
+        """
+        Returns the python dict of hashes stored in the sidecar (empty if there are none).
+        """
+        return dict(self.sidecar.get(hashes_name, {}))
+
+
+    def get_channels(self):
+        """
+        Returns a python dict {name: width} of the extra per-entry channels (see init_dict()).
+        """
+        return {key: self.entries(key).shape[-1] for key in list_channels(self.name)}
+
+
+    def aux_names(self):
+        """
+        Returns the names of the auxiliary arrays stored in the dictionary.
+        """
+        path = os.path.join(self.name, aux_name)
+        if not os.path.isdir(path):
+            return []
+
+        return sorted(f[:-4] for f in os.listdir(path) if f.endswith(".npy") and not f.endswith(".tmp.npy"))
+
+
+    def read_aux(self, key):
+        """
+        Returns the auxiliary array with the given name, or None if there is no such array.
+        """
+        if key not in self.aux_names():
+            return None
+
+        return np.load(os.path.join(self.name, aux_name, key + ".npy"))
+
+
+    def entries(self, channel=dict_name):
+        """
+        Returns a read-only (num_entries, width) view of the mapped dictionary (or channel).
+        """
+        if channel == dict_name:
+            c = self.dict
+        else:
+            c = np.load(os.path.join(self.name, channel + ".npy"), mmap_mode="r")
+
+        return c.reshape(-1, c.shape[-1])
+
+
+    def read_box(self, sl, channel=dict_name):
+        """
+        See DictReader.read_box().
+        """
+        c = self.dict if channel == dict_name else np.load(os.path.join(self.name, channel + ".npy"), mmap_mode="r")
+        return np.array(c[tuple(sl)])
+
+
+    def iter_blocks(self, block_size=4096, channel=dict_name):
+        """
+        See DictReader.iter_blocks(). The blocks are views of the mapped file.
+        """
+        entries = self.entries(channel)
+        for start in range(0, self.num_entries, block_size):
+            yield start, entries[start:start + block_size]
+
+
+    def read_entries(self, flat_inds, channel=dict_name):
+        """
+        Returns a (n, width) array of the entries at the given C-order flat indices.
+        """
+        return np.asarray(self.entries(channel)[np.asarray(flat_inds, dtype=np.int64)])
+
+
+    def close(self):
+        del self.dict
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,7 +1,30 @@
+import numpy as np
 from numpy import abs
 
 def isapprox(a, b, atol=1e-9):
     return (abs(a - b) <= atol)
 
 def isnapprox(a, b, atol=1e-9):
-    return (abs(a - b) > atol)
\ No newline at end of file
+    return (abs(a - b) > atol)
+
+def update_hash(h, obj):
+    """
+    Feeds obj into the hashlib object h in a canonical way, so that equal configurations
+    always give equal hashes: python dicts are fed in sorted key order, strings as utf-8,
+    and numbers/arrays as C-contiguous float64 bytes (along with their shape).
+    """
+    if isinstance(obj, dict):
+        for key in sorted(obj):
+            h.update(str(key).encode())
+            update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"[")
+        for o in obj:
+            update_hash(h, o)
+        h.update(b"]")
+    elif isinstance(obj, str):
+        h.update(obj.encode())
+    else:
+        arr = np.ascontiguousarray(obj, dtype=np.float64)
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
@@ -0,0 +1,622 @@
+##############################################################################
+#   This file contains the dictionary matching engine.                       #
+#                                                                            #
+#   Measured fingerprints (signals) are matched to the dictionary entries    #
+#   whose normalized inner product with them is the largest in magnitude.   #
+#   The dictionary is never loaded as a whole: it is streamed a block of     #
+#   entries at a time (see DictReader.iter_blocks()), and every block is     #
+#   multiplied with a batch of signals (a single BLAS call), keeping the     #
+#   running top-k entries of every signal.                                   #
+#                                                                            #
+#   Entries are normalized by scaling the inner products with the inverse   #
+#   of their norms, which are computed once and cached in the dictionary    #
+#   (the "norm" channel, see get_norms()).                                   #
+#                                                                            #
+#   SubspaceMatcher does the same in a low-rank temporal subspace (see      #
+#   svd.py), which reads and multiplies rank numbers per entry instead of    #
+#   num_samples. CoarseToFineMatcher only searches a strided subgrid of the  #
+#   dictionary, then the neighbourhood of the best entry of that subgrid.   #
+#                                                                            #
+#   For every signal s and matched entry d, the matcher returns:             #
+#       inds    C-order flat index of d                                      #
+#       corr    |<d, s>| / (|d| |s|), between 0 and 1                        #
+#       pd      <d, s> / |d|^2, the proton density (s ~= pd * d)             #
+##############################################################################
+
+import numpy as np
+import time
+from .dict_manip import *
+from .dict_cache import seq_hash_name
+from .Params import Params
+from .svd import compute_svd, coeff_name, basis_name, stats_name as svd_stats_name, RANK, FINALIZED, ENERGY, sv_name
+
+
+
+class TopK:
+    """
+    This class keeps the k best entries (largest inner product magnitude) of a set of signals,
+    as blocks of inner products come in.
+
+    Input Parameters:
+        num_signals:    Number of signals
+        k:              Number of entries kept for each signal
+        dtype:          Data type of the inner products
+
+    Class Variables:
+        inds:           (num_signals, k) flat indices of the best entries (-1 if none yet)
+        mag:            (num_signals, k) magnitudes of their inner products
+        ips:            (num_signals, k) their inner products
+    """
+
+
+    def __init__(self, num_signals, k, dtype=np.float32):
+        self.k = k
+        self.inds = np.full((num_signals, k), -1, dtype=np.int64)
+        self.mag = np.full((num_signals, k), -np.inf)
+        self.ips = np.zeros((num_signals, k), dtype=dtype)
+
+
+    def update(self, entry_inds, ip, rows=slice(None)):
+        """
+        This method merges a block of inner products into the running top-k.
+
+        Input Parameters:
+            entry_inds:     (n,) flat indices of the entries in the block
+            ip:             (m, n) inner products of m of the signals with the entries
+            rows:           Which m signals (a slice or an array of indices)
+        """
+        mag = np.abs(ip)
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(len(self.mag)))
+        entry_inds = np.asarray(entry_inds)
+
+        if self.k == 1:
+            # Fast path: a single pass over the block
+            i = np.argmax(mag, axis=1)
+            sigs = np.arange(len(mag))
+            m = mag[sigs, i]
+
+            better = m > self.mag[rows, 0]
+            self.mag[rows[better], 0] = m[better]
+            self.inds[rows[better], 0] = entry_inds[i[better]]
+            self.ips[rows[better], 0] = ip[sigs[better], i[better]]
+            return
+
+        # Only the signals for which something in the block beats their current k-th best matter
+        sigs = np.flatnonzero(np.any(mag > self.mag[rows].min(axis=1)[:, None], axis=1))
+        if len(sigs) == 0:
+            return
+        mag, ip, rows = mag[sigs], ip[sigs], rows[sigs]
+
+        # Best k of the block, for each signal
+        n = ip.shape[1]
+        if n > self.k:
+            cand = np.argpartition(-mag, self.k - 1, axis=1)[:, :self.k]
+        else:
+            cand = np.broadcast_to(np.arange(n), mag.shape)
+
+        all_mag = np.concatenate([self.mag[rows], np.take_along_axis(mag, cand, 1)], axis=1)
+        all_inds = np.concatenate([self.inds[rows], entry_inds[cand]], axis=1)
+        all_ips = np.concatenate([self.ips[rows], np.take_along_axis(ip, cand, 1)], axis=1)
+
+        # Best k of the block and of what we had before
+        keep = np.argpartition(-all_mag, self.k - 1, axis=1)[:, :self.k]
+        self.mag[rows] = np.take_along_axis(all_mag, keep, 1)
+        self.inds[rows] = np.take_along_axis(all_inds, keep, 1)
+        self.ips[rows] = np.take_along_axis(all_ips, keep, 1)
+
+
+    def result(self):
+        """
+        Returns (inds, mag, ips), each of shape (num_signals, k), sorted from best to worst.
+        """
+        order = np.argsort(-self.mag, axis=1)
+
+        return np.take_along_axis(self.inds, order, 1), np.take_along_axis(self.mag, order, 1), np.take_along_axis(self.ips, order, 1)
+
+
+
+
+def dense_products(sig, entries):
+    """
+    Returns the (num_signals, n) inner products sig @ entries.T of a batch of signals with a
+    block of n entries, in the data type of sig (see match_blocks()).
+    """
+    return sig @ np.asarray(entries, dtype=sig.dtype).T
+
+
+def match_blocks(signals, blocks, norm, k=1, batch_size=4096, dtype=np.float32, products=dense_products):
+    """
+    This function matches signals to the entries of a dictionary, given one block at a time.
+
+    Input Parameters:
+        signals:        (num_signals, width) array of signals (can be complex)
+        blocks:         Iterable of (start, entries, scale), where entries is a (n, width) block
+                        of entries starting at flat index start, and scale (n,) is multiplied with
+                        their inner products to normalize them (or None if they already are)
+        norm:           (N,) norm of every entry of the dictionary (used for the proton density)
+        k:              Number of matches kept for each signal
+        batch_size:     Number of signals multiplied with a block at a time
+        dtype:          Real data type the products are computed in (np.float32 or np.float64)
+        products:       Function returning the inner products of a batch of signals (already
+                        in dtype) with a block of entries (see dense_products()). This lets the
+                        entries be stored in another form (see quantize.py)
+
+    Output Values:
+        inds, corr, pd: (num_signals, k) arrays (see the top of this file), best match first
+    """
+    signals = np.atleast_2d(signals)
+    is_complex = np.iscomplexobj(signals)
+
+    # Complex signals are matched as [real; imag], so that the products stay real (BLAS sgemm)
+    if is_complex:
+        sig = np.concatenate([signals.real, signals.imag], axis=0).astype(dtype)
+    else:
+        sig = signals.astype(dtype)
+    num_signals = len(signals)
+
+    top = TopK(num_signals, k, np.result_type(dtype, np.complex64) if is_complex else dtype)
+
+    for start, entries, scale in blocks:
+        entry_inds = np.arange(start, start + len(entries))
+
+        for s0 in range(0, num_signals, batch_size):
+            s1 = min(s0 + batch_size, num_signals)
+            # (signals, entries), so that the top-k runs along contiguous rows
+            if is_complex:
+                ip = products(sig[np.r_[s0:s1, num_signals + s0:num_signals + s1]], entries)
+                ip = ip[:s1 - s0] + 1j * ip[s1 - s0:]
+            else:
+                ip = products(sig[s0:s1], entries)
+
+            if scale is not None:
+                ip *= np.asarray(scale, dtype=dtype)
+
+            top.update(entry_inds, ip, slice(s0, s1))
+
+    inds, mag, ips = top.result()
+
+    sig_norm = np.linalg.norm(signals, axis=1)
+    corr = mag / np.where(sig_norm > 0, sig_norm, 1)[:, None]
+    entry_norm = norm[np.maximum(inds, 0)]
+    pd = ips / np.where(entry_norm > 0, entry_norm, 1)
+
+    return inds, corr, pd
+
+
+def make_test_signals(entries, rng, noise=0.01):
+    """
+    Returns test signals made out of dictionary entries: each one is scaled by a random proton
+    density and white gaussian noise is added (noise is its standard deviation relative to the
+    RMS of each signal). This is used by the accuracy reports of the approximate matchers.
+    """
+    signals = np.asarray(entries, dtype=np.float64) * rng.uniform(0.5, 2, size=(len(entries), 1))
+    rms = np.sqrt(np.mean(signals**2, axis=1, keepdims=True))
+
+    return signals + noise * rms * rng.standard_normal(signals.shape)
+
+
+def inv_norm(norm):
+    """
+    Returns 1 / norm, with 0 for entries whose norm is 0 (entries that were not simulated).
+    """
+    return np.where(norm > 0, 1 / np.where(norm > 0, norm, 1), 0).astype(np.float32)
+
+
+def get_norms(name, block_size=4096, cache=True):
+    """
+    This function returns the (N,) norms of the entries of a dictionary. They are read from the
+    "norm" channel if it exists. Otherwise they are computed (one pass over the dictionary) and,
+    if the dictionary is complete and cache is True, cached in that channel for next time.
+    """
+    with open_reader(name) as r:
+        if r.num_samples == 0:
+            raise ValueError(f"Error: {name} does not store the entries (see svd_only)")
+
+        if norm_name in r.get_channels():
+            return r.read_entries(np.arange(r.num_entries), channel=norm_name)[:, 0]
+
+        norm = np.empty(r.num_entries)
+        for start, entries in r.iter_blocks(block_size):
+            norm[start:start + len(entries)] = np.linalg.norm(np.asarray(entries, dtype=np.float64), axis=1)
+
+        complete = r.is_complete()
+        shape = r.shape
+
+    if complete and cache:
+        add_channel(name, norm_name, norm.reshape(tuple(shape) + (1,)))
+
+    return norm
+
+
+
+
+class DictMatcher:
+    """
+    This class matches measured fingerprints against a dictionary (see the top of this file).
+
+    Example:
+        m = DictMatcher("dict.h5")
+        inds, corr, pd = m.match(signals)       # signals is (..., num_samples)
+        maps = m.get_maps(inds)                 # maps[T1f_name] is a T1 map, etc
+
+    Input Parameters:
+        name:           Path of the dictionary (either backend)
+        block_size:     Number of entries read at a time
+        batch_size:     Number of signals multiplied with a block at a time
+        read_only:      Never write to the dictionary (the norms are not cached, see get_norms()),
+                        e.g. when several processes open it at once (see volume.py)
+
+    Class Variables:
+        vals:           Python dict of the parameter value arrays (see DictReader.get_vals())
+        norm:           (N,) norm of every entry
+    """
+
+
+    def __init__(self, name, block_size=4096, batch_size=4096, read_only=False):
+        self.name = name
+        self.block_size = block_size
+        self.batch_size = batch_size
+
+        with open_reader(name) as r:
+            self.vals = r.get_vals()
+            self.shape = r.shape
+            self.num_samples = r.num_samples
+
+        self.norm = get_norms(name, block_size, cache=not read_only)
+
+
+    def blocks(self):
+        """
+        This generator streams the dictionary, see match_blocks().
+        """
+        with open_reader(self.name) as r:
+            for start, entries in r.iter_blocks(self.block_size):
+                yield start, entries, inv_norm(self.norm[start:start + len(entries)])
+
+
+    def match(self, signals, k=1):
+        """
+        This method matches every signal to the k best entries of the dictionary.
+
+        Input Parameters:
+            signals:        (..., num_samples) array of signals (e.g. an image with the samples
+                            along the last axis), real or complex
+            k:              Number of matches kept for each signal
+
+        Output Values:
+            inds, corr, pd: (..., k) arrays (see the top of this file), best match first
+        """
+        signals = np.asarray(signals)
+        if signals.shape[-1] != self.num_samples:
+            raise ValueError(f"Error: Signals have {signals.shape[-1]} samples, the dictionary has {self.num_samples}")
+
+        out_shape = signals.shape[:-1] + (k,)
+        signals = self.project(signals.reshape(-1, self.num_samples))
+        inds, corr, pd = match_blocks(signals, self.blocks(), self.norm, k, self.batch_size)
+
+        return inds.reshape(out_shape), corr.reshape(out_shape), pd.reshape(out_shape)
+
+
+    def project(self, signals):
+        """
+        Returns the signals as they are matched against the blocks (see SubspaceMatcher).
+        """
+        return signals
+
+
+    def get_maps(self, inds):
+        """
+        This method maps matched entries back to parameter values.
+
+        Input Parameters:
+            inds:           Array of flat indices, as returned by match() (only the best
+                            match, inds[..., 0], is used)
+
+        Output Values:
+            Python dict mapping each name in val_names (T1f_name, T2f_name, ...) to a parameter
+            map of shape inds.shape[:-1]
+        """
+        return index_to_vals(self.vals, np.asarray(inds)[..., 0])
+
+
+
+
+class SubspaceMatcher(DictMatcher):
+    """
+    This class matches measured fingerprints in a low-rank temporal subspace: both the
+    dictionary and the signals are projected onto the leading rank singular vectors of the
+    dictionary (see svd.py), and matched there. Each entry is then rank numbers instead of
+    num_samples, which makes matching that much faster, and the results are the same as
+    full-length matching (DictMatcher) up to the truncation error (1 - retention).
+
+    The SVD is loaded from the dictionary if it has one with at least rank singular vectors
+    (e.g. generate_dict(svd_rank=K), which also works for svd_only dictionaries), otherwise
+    it is computed (see svd.compute_svd()) and stored in the dictionary for next time.
+
+    Input Parameters:
+        name:           Path of the dictionary (either backend)
+        rank:           Rank of the subspace (defaults to the rank of the stored SVD)
+        block_size:     Number of entries read at a time
+        batch_size:     Number of signals multiplied with a block at a time
+        read_only:      Never write to the dictionary, the SVD must have been stored already
+
+    Class Variables:
+        basis:          (rank, num_samples) temporal basis
+        retention:      Fraction of the energy of the dictionary kept in the subspace
+        norm:           (N,) norm of the projection of every entry
+    """
+
+
+    def __init__(self, name, rank=None, block_size=4096, batch_size=4096, read_only=False):
+        self.name = name
+        self.block_size = block_size
+        self.batch_size = batch_size
+
+        with open_reader(name) as r:
+            self.vals = r.get_vals()
+            self.shape = r.shape
+            stats = r.read_aux(svd_stats_name)
+            width = r.get_channels().get(coeff_name, 0)
+
+        has_svd = (stats is not None) and stats[FINALIZED]
+        if rank is None:
+            if not has_svd:
+                raise ValueError(f"Error: {name} does not have an SVD, a rank is needed to compute one")
+            rank = int(stats[RANK])
+
+        if (not has_svd) or (width < rank):
+            if read_only:
+                raise ValueError(f"Error: {name} does not have an SVD of rank {rank}, and it can't be computed by a read-only matcher")
+            compute_svd(name, rank, block_size)
+
+        with open_reader(name) as r:
+            basis = r.read_aux(basis_name)
+            sv = r.read_aux(sv_name)
+            stats = r.read_aux(svd_stats_name)
+
+            # Norms of the projected entries (this only reads rank numbers per entry)
+            self.norm = np.empty(r.num_entries)
+            for start, coeffs in r.iter_blocks(block_size, channel=coeff_name):
+                self.norm[start:start + len(coeffs)] = np.linalg.norm(np.asarray(coeffs[:, :rank], dtype=np.float64), axis=1)
+
+        self.rank = rank
+        self.basis = basis[:rank]
+        self.num_samples = self.basis.shape[1]
+        self.retention = 1.0 if stats[ENERGY] == 0 else float(np.sum(sv[:rank]**2) / stats[ENERGY])
+
+
+    def blocks(self):
+        """
+        This generator streams the coefficients of the dictionary, see match_blocks().
+        """
+        with open_reader(self.name) as r:
+            for start, coeffs in r.iter_blocks(self.block_size, channel=coeff_name):
+                yield start, coeffs[:, :self.rank], inv_norm(self.norm[start:start + len(coeffs)])
+
+
+    def project(self, signals):
+        """
+        Returns the coefficients of the signals in the subspace.
+        """
+        return signals @ self.basis.T
+
+
+
+
+class CoarseToFineMatcher(DictMatcher):
+    """
+    This class matches measured fingerprints hierarchically, which relies on the entries
+    being smooth functions of the parameters. Each signal is first matched against a coarse
+    subgrid of the dictionary (every stride-th value of each axis), then against every entry
+    of the full grid within radius (along each axis) of its num_seeds best coarse entries.
+    Several seeds make it much less likely to miss the best entry when the correlation has
+    long ridges across the grid (e.g. between T1 and T2).
+
+    Entries that are not in the dictionary yet (not marked as done) can be simulated on demand:
+    if sim is given, every coarse entry and every entry of the neighbourhoods that are searched
+    is simulated the first time it is needed, and written to the dictionary for next time. A
+    dictionary can then be initialized empty (see dict_manip.init_dict()) and only the entries
+    that the data actually needs are ever simulated.
+
+    Input Parameters:
+        name:           Path of the dictionary (either backend)
+        stride:         Stride of the coarse subgrid, either a number (for every axis) or a python
+                        dict mapping axis names (see Params.axis_names) to strides (1 if missing).
+                        By default, only the axes along which entries are smooth are strided
+        radius:         Radius of the neighbourhoods (same format, defaults to stride)
+        num_seeds:      Number of coarse entries whose neighbourhood is searched, for every signal
+        sim:            Optional instance of MRFSim used to simulate missing entries. Its parameter
+                        values are replaced by the ones of the dictionary
+        block_size:     Number of coarse entries multiplied with the signals at a time
+        batch_size:     Number of signals multiplied with a block at a time
+        read_only:      Never write to the dictionary, which rules out sim
+
+    Class Variables:
+        coarse:         (n, num_samples) entries of the coarse subgrid
+        coarse_inds:    (n,) their flat indices
+        done:           (N,) mask of the entries that are in the dictionary
+    """
+
+
+    def __init__(self, name, stride={"T1_f": 2, "T2_f": 2, "BAT": 2}, radius=None, num_seeds=3, sim=None, block_size=4096, batch_size=4096, read_only=False):
+        if read_only and (sim is not None):
+            raise ValueError("Error: A read-only matcher can't simulate missing entries (sim)")
+
+        self.name = name
+        self.num_seeds = num_seeds
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.sim = sim
+
+        with open_reader(name) as r:
+            self.vals = r.get_vals()
+            self.shape = tuple(r.shape)
+            self.num_samples = r.num_samples
+            self.done = r.done_mask()
+            hashes = r.get_hashes()
+
+        if self.num_samples == 0:
+            raise ValueError(f"Error: {name} does not store the entries (see svd_only)")
+        if points_name in self.vals:
+            raise ValueError(f"Error: {name} is a scattered dictionary, it has no grid to search coarse to fine")
+
+        if sim is not None:
+            sim.params.set_vals(self.vals)
+            if hashes.get(seq_hash_name, sim.get_seq_hash()) != sim.get_seq_hash():
+                raise ValueError("Error: The dictionary was generated with a different pulse sequence or simulation constants")
+
+        self.strides = self.per_axis(stride, 1)
+        self.radius = self.strides if radius is None else self.per_axis(radius, 0)
+
+        # Norms of the entries that have been read so far (NaN for the others)
+        self.norm = np.full(int(np.prod(self.shape)), np.nan)
+
+        # The coarse subgrid
+        coarse_sl = tuple(slice(0, n, s) for n, s in zip(self.shape, self.strides))
+        self.coarse_inds = self.box_inds(coarse_sl)
+        self.fill(self.coarse_inds)
+
+        with open_reader(name) as r:
+            self.coarse = r.read_box(coarse_sl).reshape(-1, self.num_samples)
+        self.norm[self.coarse_inds] = np.linalg.norm(np.asarray(self.coarse, dtype=np.float64), axis=1)
+
+
+    def per_axis(self, val, default):
+        """
+        Returns a tuple with one value per parameter axis, see the stride and radius inputs.
+        Axes that only have one value always get 1 (stride) or 0 (radius).
+        """
+        if isinstance(val, dict):
+            unknown = set(val) - set(Params.axis_names)
+            if unknown:
+                raise ValueError(f"Error: Unknown axis names {sorted(unknown)} (expected one of {Params.axis_names})")
+            vals = [val.get(a, default) for a in Params.axis_names]
+        else:
+            vals = [val] * len(self.shape)
+
+        return tuple(int(v) if n > 1 else default for v, n in zip(vals, self.shape))
+
+
+    def box_inds(self, sl):
+        """
+        Returns the flat indices of the entries selected by sl (see DictReader.read_box()), in
+        the order read_box() returns them.
+        """
+        axes = [np.arange(n)[s] for n, s in zip(self.shape, sl)]
+        return np.ravel_multi_index(np.meshgrid(*axes, indexing="ij"), self.shape).ravel()
+
+
+    def fill(self, flat_inds):
+        """
+        This method simulates (with self.sim) and stores the given entries that are not in the
+        dictionary yet. Without a simulator, missing entries are left as they are (all zeros),
+        so they never match anything.
+        """
+        missing = np.unique(flat_inds[~self.done[flat_inds]])
+        if (self.sim is None) or (len(missing) == 0):
+            return
+
+        print(f"Simulating {len(missing)} missing entries")
+        with open_writer(self.name) as w:
+            for i in missing:
+                idx = np.unravel_index(i, self.shape)
+                w.write(tuple(int(j) for j in idx), self.sim.simulate_point(idx))
+
+        self.done[missing] = True
+
+
+    def match(self, signals, k=1):
+        """
+        This method matches every signal to the k best entries of the neighbourhood of its best
+        coarse entry (see the description of the class).
+
+        Input Parameters:
+            signals:        (..., num_samples) array of signals, real or complex
+            k:              Number of matches kept for each signal
+
+        Output Values:
+            inds, corr, pd: (..., k) arrays (see the top of this file), best match first
+        """
+        signals = np.asarray(signals)
+        if signals.shape[-1] != self.num_samples:
+            raise ValueError(f"Error: Signals have {signals.shape[-1]} samples, the dictionary has {self.num_samples}")
+
+        out_shape = signals.shape[:-1] + (k,)
+        sig = signals.reshape(-1, self.num_samples)
+
+        # Coarse search
+        coarse_norm = self.norm[self.coarse_inds]
+        blocks = ((start, self.coarse[start:start + self.block_size], inv_norm(coarse_norm[start:start + self.block_size]))
+                  for start in range(0, len(self.coarse), self.block_size))
+        seeds, _, _ = match_blocks(sig, blocks, coarse_norm, min(self.num_seeds, len(self.coarse)), self.batch_size)
+
+        # Neighbourhood of each coarse entry that was matched (seed_rows[j] is the signal of seeds[j])
+        seed_rows = np.repeat(np.arange(len(sig)), seeds.shape[1])
+        seeds = self.coarse_inds[seeds.ravel()]
+        cells, groups = np.unique(seeds, return_inverse=True)
+        order = np.argsort(groups, kind="stable")
+        bounds = np.searchsorted(groups[order], np.arange(len(cells) + 1))
+
+        boxes = []
+        for c in cells:
+            idx = np.unravel_index(c, self.shape)
+            boxes.append(tuple(slice(max(i - r, 0), min(i + r + 1, n)) for i, r, n in zip(idx, self.radius, self.shape)))
+        self.fill(np.concatenate([self.box_inds(sl) for sl in boxes]))
+
+        # Fine search
+        is_complex = np.iscomplexobj(sig)
+        top = TopK(len(sig), k, np.complex64 if is_complex else np.float32)
+        with open_reader(self.name) as r:
+            for c, sl in enumerate(boxes):
+                rows = seed_rows[order[bounds[c]:bounds[c + 1]]]
+                inds = self.box_inds(sl)
+                entries = r.read_box(sl).reshape(-1, self.num_samples).astype(np.float32)
+                self.norm[inds] = np.linalg.norm(np.asarray(entries, dtype=np.float64), axis=1)
+
+                ip = (sig[rows] @ entries.T) * inv_norm(self.norm[inds])
+                if k > 1:
+                    # Neighbourhoods can overlap, the entries that were already seen can't come in twice
+                    ip[(top.inds[rows][:, None, :] == inds[None, :, None]).any(axis=2)] = 0
+                top.update(inds, ip, rows)
+
+        inds, mag, ips = top.result()
+
+        sig_norm = np.linalg.norm(sig, axis=1)
+        corr = mag / np.where(sig_norm > 0, sig_norm, 1)[:, None]
+        entry_norm = np.nan_to_num(self.norm[np.maximum(inds, 0)])
+        pd = ips / np.where(entry_norm > 0, entry_norm, 1)
+
+        return inds.reshape(out_shape), corr.reshape(out_shape), pd.reshape(out_shape)
+
+
+    def report(self, num_signals=1000, noise=0.01, seed=0, tol=1e-6):
+        """
+        This method measures how often the hierarchical search gives a different result than
+        the exhaustive one (DictMatcher), on test signals made out of random entries of the
+        dictionary (see make_test_signals()). The dictionary has to be complete.
+
+        Output Values:
+            Python dict with
+                mismatch:       Fraction of signals whose best match differs from the exhaustive
+                                one (ignoring entries that are tied within tol, see ann.recall_report())
+                speedup:        Time taken by exhaustive matching over time taken by this matcher
+        """
+        rng = np.random.default_rng(seed)
+        with open_reader(self.name) as r:
+            if not r.is_complete():
+                raise ValueError(f"Error: Exhaustive matching needs a complete dictionary")
+            truth = np.sort(rng.choice(r.num_entries, size=min(num_signals, r.num_entries), replace=False))
+            signals = make_test_signals(r.read_entries(truth), rng, noise)
+
+        t0 = time.time()
+        exact, exact_corr, _ = DictMatcher(self.name, self.block_size, self.batch_size).match(signals)
+        t1 = time.time()
+        inds, corr, _ = self.match(signals)
+        t2 = time.time()
+
+        same = (inds[:, 0] == exact[:, 0]) | (corr[:, 0] >= (1 - tol) * exact_corr[:, 0])
+        report = {"mismatch": float(np.mean(~same)), "speedup": (t1 - t0) / (t2 - t1)}
+        print(f"Coarse-to-fine: {100 * report['mismatch']:.2f}% of matches differ from exhaustive search, {report['speedup']:.1f}x faster")
+
+        return report
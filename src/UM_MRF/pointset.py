@@ -0,0 +1,327 @@
+##############################################################################
+#   This file contains the PointSet class, a Params object that holds an   #
+#   arbitrary list of parameter points instead of a grid (for training and #
+#   validation sets), either given explicitly or sampled from ranges by    #
+#   Latin hypercube or Sobol sampling.                                       #
+#                                                                            #
+#   Changing some parameters is a lot more expensive than changing others   #
+#   (see Params.__next__()): a new flip angle means recomputing the         #
+#   effective B field, a new BAT recomputing s(t), a new F or alpha         #
+#   rescaling it. The points are therefore sorted in the same nesting as    #
+#   the grid loop (B1, flip, then BAT, alpha, F, T1_s, T2_f, T1_f, kf, ks   #
+#   and CBV), so that MRFSim.generate_dict() only redoes the expensive setup    #
+#   once per group of points that share these values. Random samples are   #
+#   only grouped if the expensive axes take a few values, which is what the #
+#   levels input of the samplers is for.                                    #
+#                                                                            #
+#   Dictionaries generated from a PointSet are scattered dictionaries (see  #
+#   dict_manip.get_dict_shape()), whose entries are in the sorted order.    #
+##############################################################################
+
+import numpy as np
+from .Params import Params
+from .dict_manip import *
+
+
+# Axes whose change triggers each setup step (see PointSet.__next__())
+B_axes = ("flip", "B1")
+s_axes = ("BAT",)
+scale_axes = ("F", "alpha")
+
+
+
+class PointSet(Params):
+    """
+    This class holds an arbitrary set of parameter points (see the top of this file). It can be
+    used in place of a Params object anywhere, for example:
+
+        p = PointSet.latin_hypercube({"T1_f": (300, 3000), "T2_f": (30, 300), "flip": (5, 40), ...},
+                                     10000, levels={"flip": 8}, lam=0.9, zvel=0, zpos_init=0, M0_f=1, M0_s=0.1)
+        ps = MRFSim(p)
+        ...
+        ps.generate_dict("train.h5")
+
+    Input Parameters:
+        points:     Either a (n, 11) array (columns in the order of Params.axis_names), or a
+                    python dict mapping every name in Params.axis_names to an array of n
+                    values (or a single value shared by all points). Axes with a default
+                    value (see dict_manip.default_vals, e.g. B1) may be left out
+        lam, zvel, zpos_init, M0_f, M0_s:
+                    Simulation constants, see Params.__init__()
+
+    Class Variables:
+        points:     (n, 11) table of the points, in the order they are simulated
+        order:      (n,) position of each of these points in the points that were given
+        point_ind:  Index of the current point
+    """
+
+
+    def __init__(self, points, lam, zvel, zpos_init, M0_f, M0_s):
+        table = self.to_table(points)
+
+        order = np.lexsort(table.T)
+        self.points = table[order]
+        self.order = order
+
+        u = self.unique_vals(self.points)
+        Params.__init__(self, u["T1_f"], u["T2_f"], u["T1_s"], u["ks"], u["kf"], u["F"], lam, zvel, zpos_init,
+                        u["CBV"], u["BAT"], M0_f, M0_s, u["flip"], u["alpha"], u["B1"])
+        self.point_ind = 0
+        self.set_cur_vals()
+        self.calc_R_T_vals()
+
+
+    @staticmethod
+    def to_table(points):
+        """
+        Returns the (n, 11) table of the given points (see the inputs of the class).
+        """
+        defaults = {a: default_vals[n] for a, n in zip(Params.axis_names, val_names) if n in default_vals}
+
+        if isinstance(points, dict):
+            points = {**defaults, **points}
+            missing = [a for a in Params.axis_names if a not in points]
+            if missing:
+                raise ValueError(f"Error: Missing values for the axes {missing}")
+
+            n = max(np.size(points[a]) for a in Params.axis_names)
+            cols = []
+            for a in Params.axis_names:
+                v = np.atleast_1d(np.asarray(points[a], dtype=np.float64))
+                if np.size(v) not in (1, n):
+                    raise ValueError(f"Error: Axis {a} has {np.size(v)} values, expected 1 or {n}")
+                cols.append(np.broadcast_to(v, (n,)))
+            table = np.stack(cols, axis=1)
+        else:
+            table = np.asarray(points, dtype=np.float64)
+            if (table.ndim == 2) and (table.shape[1] == len(Params.axis_names) - len(defaults)):
+                # The last columns (the axes with a default value) were left out
+                table = np.concatenate([table, np.broadcast_to(list(defaults.values()), (len(table), len(defaults)))], axis=1)
+
+        if (table.ndim != 2) or (table.shape[1] != len(Params.axis_names)) or (len(table) == 0):
+            raise ValueError(f"Error: Expected a (n, {len(Params.axis_names)}) table of points, got shape {table.shape}")
+
+        return np.array(table)
+
+
+    @staticmethod
+    def unique_vals(points):
+        """
+        Returns a python dict mapping every name in Params.axis_names to its distinct values.
+        """
+        return {a: np.unique(points[:, i]) for i, a in enumerate(Params.axis_names)}
+
+
+    @classmethod
+    def latin_hypercube(cls, ranges, num_points, lam, zvel, zpos_init, M0_f, M0_s, levels={}, seed=None):
+        """
+        This method samples a PointSet by Latin hypercube sampling.
+
+        Input Parameters:
+            ranges:         Python dict mapping every name in Params.axis_names to either a
+                            (low, high) tuple, or a single value for the axes that are fixed
+                            (the axes with a default value, e.g. B1, may be left out)
+            num_points:     Number of points
+            levels:         Python dict mapping some of the axes to a number of levels. These axes
+                            only take that many (evenly spaced) values, so that the points can be
+                            grouped (see the top of this file), e.g. {"flip": 8, "BAT": 16}
+            seed:           Seed of the random generator
+            lam, zvel, zpos_init, M0_f, M0_s:
+                            Simulation constants, see Params.__init__()
+        """
+        rng = np.random.default_rng(seed)
+        sampled = cls.sampled_axes(ranges)
+
+        # One stratum per point along each axis, in a random order
+        u = (np.argsort(rng.random((num_points, len(sampled))), axis=0) + rng.random((num_points, len(sampled)))) / num_points
+
+        return cls(cls.scale_samples(ranges, sampled, u, levels), lam, zvel, zpos_init, M0_f, M0_s)
+
+
+    @classmethod
+    def sobol(cls, ranges, num_points, lam, zvel, zpos_init, M0_f, M0_s, levels={}, seed=None):
+        """
+        This method samples a PointSet from a (scrambled) Sobol sequence, see latin_hypercube()
+        for the inputs. This needs scipy. Sobol sequences are best balanced when num_points is a
+        power of 2.
+        """
+        try:
+            from scipy.stats import qmc
+        except ImportError:
+            raise ValueError("Error: Sobol sampling needs scipy (pip install scipy)")
+
+        sampled = cls.sampled_axes(ranges)
+        u = qmc.Sobol(d=len(sampled), scramble=True, seed=seed).random(num_points)
+
+        return cls(cls.scale_samples(ranges, sampled, u, levels), lam, zvel, zpos_init, M0_f, M0_s)
+
+
+    @staticmethod
+    def sampled_axes(ranges):
+        """
+        Returns the names of the axes that are sampled (given as a range) in ranges.
+        """
+        missing = [a for a, n in zip(Params.axis_names, val_names) if (a not in ranges) and (n not in default_vals)]
+        if missing:
+            raise ValueError(f"Error: Missing ranges for the axes {missing}")
+
+        return [a for a in Params.axis_names if np.size(ranges.get(a)) == 2]
+
+
+    @staticmethod
+    def scale_samples(ranges, sampled, u, levels):
+        """
+        Returns the python dict of points for samples u in [0, 1) along the sampled axes.
+        """
+        unknown = set(levels) - set(sampled)
+        if unknown:
+            raise ValueError(f"Error: Levels were given for axes that are not sampled: {sorted(unknown)}")
+
+        points = {a: ranges[a] for a in Params.axis_names if (a not in sampled) and (a in ranges)}
+        for i, a in enumerate(sampled):
+            low, high = ranges[a]
+            x = u[:, i]
+            if a in levels:
+                # Centers of levels[a] evenly spaced bins
+                x = (np.floor(x * levels[a]) + 0.5) / levels[a]
+            points[a] = low + x * (high - low)
+
+        return points
+
+
+    def __iter__(self):
+        """
+        See Params.__iter__(), the points are gone through in the order of self.points.
+        """
+        if not self.needs_setup:
+            return self
+
+        self.recompute_s = True
+        self.rescale_s = False
+        self.recompute_B = False
+
+        self.point_ind = 0
+        self.set_cur_vals()
+        self.calc_R_T_vals()
+        self.needs_setup = False
+
+        return self
+
+
+    def __next__(self):
+        """
+        This method moves on to the next point, and sets the flags of the setup steps that the
+        values that changed require (see Params.__next__()).
+        """
+        if self.point_ind + 1 >= len(self.points):
+            raise StopIteration
+
+        prev = self.points[self.point_ind]
+        self.point_ind += 1
+        cur = self.points[self.point_ind]
+        changed = {a for a, p, c in zip(self.axis_names, prev, cur) if p != c}
+
+        self.set_cur_vals()
+        self.calc_R_T_vals()
+
+        if changed & set(B_axes):
+            self.recompute_s = True
+            self.recompute_B = True
+        elif changed & set(s_axes):
+            self.recompute_s = True
+        elif changed & set(scale_axes):
+            self.rescale_s = True
+
+        return None
+
+
+    def count_setups(self):
+        """
+        Returns the number of times the B field is recomputed, s(t) is recomputed and s(t) is
+        rescaled (in that order) when going through all the points.
+        """
+        changed = self.points[1:] != self.points[:-1]
+        col = {a: i for i, a in enumerate(self.axis_names)}
+        B = np.any(changed[:, [col[a] for a in B_axes]], axis=1)
+        s = np.any(changed[:, [col[a] for a in s_axes]], axis=1) & ~B
+        scale = np.any(changed[:, [col[a] for a in scale_axes]], axis=1) & ~B & ~s
+
+        return 1 + int(np.count_nonzero(B)), 1 + int(np.count_nonzero(B | s)), int(np.count_nonzero(scale))
+
+
+    def set_cur_vals(self):
+        """
+        Helper method that sets the current parameter values from the current point.
+        """
+        self.CBV, self.ks, self.kf, self.T1_f, self.T2_f, self.T1_s, self.F, self.alpha, self.BAT, self.flip, self.B1 = self.points[self.point_ind]
+
+
+    def get_vals(self):
+        """
+        Returns the distinct values of each axis, along with the table of points (see
+        dict_manip.get_dict_shape()).
+        """
+        vals = dict(zip(val_names, self.unique_vals(self.points).values()))
+        vals[points_name] = self.points
+
+        return vals
+
+
+    def set_vals(self, vals):
+        """
+        Replaces the points with the table held in vals (see get_vals()), as it is (the points of
+        a dictionary are already sorted).
+        """
+        if points_name not in vals:
+            raise ValueError("Error: A PointSet can only be loaded from a scattered dictionary")
+
+        self.points = self.to_table(vals[points_name])
+        self.order = np.arange(len(self.points))
+        for a, v in self.unique_vals(self.points).items():
+            setattr(self, a + "_vals", v)
+
+        self.clear_cache()
+        self.needs_setup = True
+
+
+    def get_rf_batch(self):
+        raise ValueError("Error: The entries of a PointSet can't be batched by flip angle and B1 scale, use a grid")
+
+
+    def extend_vals(self, **new_vals):
+        raise ValueError("Error: A PointSet has no axes to extend, create a new one with the extra points")
+
+
+    def add_constraint(self, constraint):
+        raise ValueError("Error: Select the points of a PointSet before creating it")
+
+
+    def set_mask(self, mask):
+        raise ValueError("Error: Select the points of a PointSet before creating it")
+
+
+    def seek_first_missing(self):
+        self.point_ind = int(np.argmin(self.done))
+
+
+    def any_to_fit(self):
+        return len(self.points) > 1
+
+
+    def print_inds(self):
+        print(f"Current Point: {self.point_ind} of {len(self.points)}")
+
+
+    def set_inds(self, inds):
+        if len(inds) != 1:
+            raise ValueError("Number of indices was incorrect")
+
+        self.point_ind = int(inds[0])
+
+
+    def get_shape(self):
+        return (len(self.points),)
+
+
+    def get_cur_idx(self):
+        return (self.point_ind,)
@@ -0,0 +1,279 @@
+##############################################################################
+#   This file contains the export of a dictionary to a compact, quantized   #
+#   file, and the matching routines that work directly on it.                #
+#                                                                            #
+#   Matching a signal against a dictionary is bound by the memory           #
+#   bandwidth (every sample of every entry is read once per block of        #
+#   signals), so storing fewer bytes per sample makes it faster. Every      #
+#   entry is normalized (its norm is kept), then stored as either:          #
+#       float16     2 bytes per sample                                       #
+#       int8        1 byte per sample, with a per-entry scale such that      #
+#                   entry / norm ~= scale * stored                           #
+#                                                                            #
+#   The quantized file is a plain HDF5 file holding the parameter value     #
+#   arrays (same names as in dict_manip.py) and, for the N entries in       #
+#   C-order flat index:                                                      #
+#       dictionary      (N, num_samples) quantized normalized entries        #
+#       norm            (N,) norm of each original entry                     #
+#       scale           (N,) per-entry scale (all ones for float16)          #
+#                                                                            #
+#   There is no BLAS for int8 or float16, so the entries are converted to    #
+#   float32 for the products. For small batches of signals, this is done a   #
+#   sub-block small enough to stay in the cache at a time (see               #
+#   dequant_products()): the float32 copy never goes out to memory, only     #
+#   the quantized entries are read from it. quantization_report() measures   #
+#   the time of a match against the original entries in float32, with both #
+#   held in memory, so that only the bytes per sample differ.              #
+##############################################################################
+
+import numpy as np
+import h5py
+import time
+from .dict_manip import *
+from .match import match_blocks, make_test_signals
+
+
+scale_name = "scale"
+quant_attr = "quantization"
+
+cache_bytes = 256 * 1024    # Size of the float32 sub-blocks of entries (see dequant_products())
+
+# Data types each quantization is stored as
+quant_dtypes = {"float16": np.float16, "int8": np.int8}
+
+
+
+def quantize_entries(entries, quantization):
+    """
+    This function normalizes and quantizes a block of entries.
+
+    Input Parameters:
+        entries:        (n, num_samples) array of dictionary entries
+        quantization:   Either "float16" or "int8"
+
+    Output Values:
+        q:              (n, num_samples) quantized normalized entries
+        norm:           (n,) norm of each entry
+        scale:          (n,) scale of each entry (entry / norm ~= scale * q)
+    """
+    entries = np.asarray(entries, dtype=np.float64)
+    norm = np.linalg.norm(entries, axis=1)
+
+    # Entries that are all zeros stay all zeros
+    unit = entries / np.where(norm > 0, norm, 1)[:, None]
+
+    if quantization == "float16":
+        return unit.astype(np.float16), norm, np.ones(len(entries))
+    elif quantization == "int8":
+        peak = np.max(np.abs(unit), axis=1)
+        scale = np.where(peak > 0, peak, 1) / 127
+        q = np.round(unit / scale[:, None]).astype(np.int8)
+        return q, norm, scale
+    else:
+        raise ValueError(f"Error: Unknown quantization '{quantization}' (expected 'float16' or 'int8')")
+
+
+def export_quantized(src, dst, quantization="int8", block_size=4096):
+    """
+    This function writes a compact, quantized copy of a complete dictionary (see the top of this file).
+
+    Input Parameters:
+        src:            Path of the dictionary (either backend)
+        dst:            Path of the quantized HDF5 file
+        quantization:   Either "float16" or "int8"
+        block_size:     Number of entries quantized at a time
+    """
+    if quantization not in quant_dtypes:
+        raise ValueError(f"Error: Unknown quantization '{quantization}' (expected 'float16' or 'int8')")
+
+    with open_reader(src) as r:
+        if not r.is_complete():
+            raise ValueError(f"Error: Can't export {src}, not every entry has been simulated")
+        if r.num_samples == 0:
+            raise ValueError(f"Error: Can't export {src}, it does not store the entries (see svd_only)")
+
+        with h5py.File(dst, "w") as d:
+            for n, v in r.get_vals().items():
+                d.create_dataset(n, np.shape(v), data=v)
+
+            d.attrs[quant_attr] = quantization
+            q_set = d.create_dataset(dict_name, (r.num_entries, r.num_samples), dtype=quant_dtypes[quantization])
+            norm_set = d.create_dataset(norm_name, (r.num_entries,), dtype=np.float64)
+            scale_set = d.create_dataset(scale_name, (r.num_entries,), dtype=np.float32)
+
+            for start, entries in r.iter_blocks(block_size):
+                q, norm, scale = quantize_entries(entries, quantization)
+                q_set[start:start + len(q)] = q
+                norm_set[start:start + len(q)] = norm
+                scale_set[start:start + len(q)] = scale
+
+
+
+def dequant_products(sig, q):
+    """
+    Returns the (num_signals, n) float32 inner products of a batch of float32 signals sig with a
+    block of n quantized entries q (see match.match_blocks()). The entries are converted to
+    float32 a sub-block of cache_bytes at a time, into the same buffer, and multiplied right
+    away, so that the conversion stays in the cache.
+    """
+    sub = max(1, min(len(q), cache_bytes // (4 * q.shape[1])))
+    if 4 * len(sig) >= sub:
+        # With that many signals, the products are bound by the arithmetic rather than by
+        # reading the entries, and BLAS is faster on the whole block
+        return sig @ q.astype(np.float32).T
+
+    buf = np.empty((sub, q.shape[1]), dtype=np.float32)
+    ip = np.empty((len(sig), len(q)), dtype=np.float32)
+
+    for a in range(0, len(q), sub):
+        b = min(a + sub, len(q))
+        np.copyto(buf[:b - a], q[a:b], casting="unsafe")
+        ip[:, a:b] = sig @ buf[:b - a].T
+
+    return ip
+
+
+
+class QuantizedDict:
+    """
+    This class loads a quantized dictionary (see export_quantized()) in memory and matches
+    signals against it.
+
+    Input Parameters:
+        name:           Path of the quantized file
+
+    Class Variables:
+        quantization:   Either "float16" or "int8"
+        entries:        (N, num_samples) quantized normalized entries
+        norm:           (N,) norm of each original entry
+        scale:          (N,) per-entry scale
+        vals:           Python dict of the parameter value arrays (see DictReader.get_vals())
+    """
+
+
+    def __init__(self, name):
+        with h5py.File(name, "r") as d:
+            self.quantization = d.attrs[quant_attr]
+            self.entries = d[dict_name][...]
+            self.norm = d[norm_name][...]
+            self.scale = d[scale_name][...].astype(np.float32)
+            self.vals = fill_vals({n: d[n][...] for n in val_names + [points_name] if n in d})
+
+        self.num_entries, self.num_samples = self.entries.shape
+
+
+    def nbytes(self):
+        """
+        Returns the number of bytes read from the entries for every match.
+        """
+        return self.entries.nbytes + self.scale.nbytes
+
+
+    def iter_blocks(self, block_size=4096):
+        """
+        This generator yields (start, q, scale) for consecutive blocks of the quantized entries,
+        where q is a view of the quantized entries, which are the normalized entries once
+        multiplied by scale.
+        """
+        for start in range(0, self.num_entries, block_size):
+            yield start, self.entries[start:start + block_size], self.scale[start:start + block_size]
+
+
+    def match(self, signals, k=1, block_size=4096):
+        """
+        This method matches every signal to the k best entries (see match.py), working directly
+        on the quantized entries.
+
+        Input Parameters:
+            signals:        (num_signals, num_samples) array of signals (can be complex)
+            k:              Number of matches kept for each signal
+            block_size:     Number of entries matched at a time (they are converted back to
+                            float32 in smaller sub-blocks, see dequant_products())
+
+        Output Values:
+            inds, corr, pd: (num_signals, k) arrays (see match.py), best match first
+        """
+        return match_blocks(signals, self.iter_blocks(block_size), self.norm, k, products=dequant_products)
+
+
+    def get_params(self, inds):
+        """
+        Returns the parameter values of the entries at the given flat indices (see dict_manip.index_to_vals()).
+        """
+        return index_to_vals(self.vals, inds)
+
+
+
+
+def quantization_report(src, qname, num_signals=1000, noise=0.01, seed=0, block_size=4096):
+    """
+    This function measures how well matching against a quantized dictionary agrees with
+    exact matching (in float64) against the original one, on test signals made out of randomly
+    chosen entries of the original dictionary (see match.make_test_signals()), and how long
+    the match takes compared to the same match against the original entries in float32. The
+    quantized dictionary is held in memory (see QuantizedDict), so the original entries are
+    loaded as well, and neither time includes reading from disk.
+
+    Input Parameters:
+        src:            Path of the original dictionary
+        qname:          Path of its quantized export (see export_quantized())
+        num_signals:    Number of test signals
+        noise:          Relative noise level
+        seed:           Seed of the random generator
+        block_size:     Number of entries matched at a time
+
+    Output Values:
+        Python dict with
+            agreement:      Fraction of signals matched to the same entry by both
+            max_corr_error: Largest difference between the two normalized inner products
+            param_errors:   Python dict of the mean absolute difference of every parameter
+                            between the two matches
+            time:           Time of the match against the quantized dictionary [s]
+            ref_time:       Time of the same match against the original entries in float32 [s]
+            speedup:        ref_time / time
+    """
+    q = QuantizedDict(qname)
+    rng = np.random.default_rng(seed)
+    inv = np.where(q.norm > 0, 1 / np.where(q.norm > 0, q.norm, 1), 0)
+
+    with open_reader(src) as r:
+        truth = np.sort(rng.choice(r.num_entries, size=min(num_signals, r.num_entries), replace=False))
+        signals = make_test_signals(r.read_entries(truth), rng, noise)
+
+        entries = np.empty((r.num_entries, r.num_samples), dtype=dict_dtype)
+        for start, block in r.iter_blocks(block_size):
+            entries[start:start + len(block)] = block
+
+    def blocks():
+        for start in range(0, len(entries), block_size):
+            yield start, entries[start:start + block_size], inv[start:start + block_size]
+
+    # Reference: the original entries, in float64
+    ref_inds, ref_corr, _ = match_blocks(signals, blocks(), q.norm, dtype=np.float64)
+
+    start = time.time()
+    match_blocks(signals, blocks(), q.norm)
+    ref_time = time.time() - start
+
+    start = time.time()
+    inds, corr, _ = q.match(signals, block_size=block_size)
+    q_time = time.time() - start
+
+    ref_inds, ref_corr, inds, corr = ref_inds[:, 0], ref_corr[:, 0], inds[:, 0], corr[:, 0]
+
+    ref_vals = q.get_params(ref_inds)
+    q_vals = q.get_params(inds)
+
+    report = {
+        "agreement": float(np.mean(inds == ref_inds)),
+        "max_corr_error": float(np.max(np.abs(corr - ref_corr))),
+        "param_errors": {n: float(np.mean(np.abs(q_vals[n] - ref_vals[n]))) for n in val_names},
+        "time": q_time,
+        "ref_time": ref_time,
+        "speedup": ref_time / q_time,
+    }
+
+    print(f"Quantization ({q.quantization}): {100 * report['agreement']:.2f}% of matches agree, "
+          f"max correlation error {report['max_corr_error']:.2e}, {q_time:.3f} s ({report['speedup']:.2f}x float32)")
+
+    return report
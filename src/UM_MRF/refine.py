@@ -0,0 +1,278 @@
+##############################################################################
+#   This file contains the sub-grid refinement of dictionary matches.        #
+#                                                                            #
+#   Matching quantizes the parameter estimates to the grid of the            #
+#   dictionary. The entries (and so their correlation with a signal) are    #
+#   smooth functions of the parameters, so a local model fit to the best    #
+#   entry and to its grid neighbours gives a continuous estimate of the     #
+#   parameters without simulating anything. Two models are available:      #
+#                                                                            #
+#       "quadratic"     The entries around the best one are interpolated by #
+#                       a (tensor-product) quadratic function of the        #
+#                       parameters through the neighbours, and the          #
+#                       parameters that maximize the correlation of that    #
+#                       model with the signal are found by Gauss-Newton     #
+#                       iterations                                          #
+#       "parabola"      A parabola is fit to the correlations of the signal #
+#                       with the best entry and its two neighbours, along   #
+#                       each axis separately. Cheaper, but much less        #
+#                       accurate (the correlation is far from parabolic     #
+#                       over a grid step on coarse grids)                    #
+#                                                                            #
+#   The neighbours are either the whole 3^d box around the best entry       #
+#   (which captures the cross terms between axes, e.g. the ridge between   #
+#   T1 and T2) or, when more than box_axes axes are refined, the 2d + 1     #
+#   entries of the star along the axes, where d is the number of refined    #
+#   axes. Coordinates are scaled by the local grid spacing, so uneven grids #
+#   are fine, and the estimates never leave the box of neighbours.          #
+##############################################################################
+
+import numpy as np
+from itertools import product
+from .dict_manip import *
+from .Params import Params
+
+
+refine_models = ("quadratic", "parabola")
+
+
+
+def get_stencil(idx, shape, refined, box):
+    """
+    Returns the multi-indices of the neighbours of the entry idx along the refined axes, either
+    the whole box (box=True) or the star along the axes, clipped to the grid. The entry itself
+    comes first.
+    """
+    steps = [[0] + [s for s in (-1, 1) if 0 <= idx[a] + s < shape[a]] for a in refined]
+
+    if box:
+        offsets = list(product(*steps))
+    else:
+        offsets = [(0,) * len(refined)]
+        for k in range(len(refined)):
+            for s in steps[k][1:]:
+                offsets.append(tuple(s if j == k else 0 for j in range(len(refined))))
+
+    points = []
+    for o in offsets:
+        p = list(idx)
+        for a, s in zip(refined, o):
+            p[a] += s
+        points.append(tuple(p))
+
+    return points
+
+
+def get_terms(sizes, box):
+    """
+    Returns the monomials of the model as (num_terms, d) arrays of exponents, given the number of
+    distinct coordinates along each axis (3, or 2 at the edges of the grid). For a box these are
+    the products of the powers up to 2 (tensor-product quadratic), for a star the powers of each
+    axis alone, so that in both cases the model interpolates the neighbours exactly.
+    """
+    if box:
+        return np.array(list(product(*[range(n) for n in sizes])), dtype=int).reshape(-1, len(sizes))
+
+    terms = [np.zeros(len(sizes), dtype=int)]
+    for k, n in enumerate(sizes):
+        for e in range(1, n):
+            terms.append(np.eye(len(sizes), dtype=int)[k] * e)
+
+    return np.array(terms)
+
+
+def eval_terms(terms, u):
+    """
+    Returns the values (m, num_terms) and the derivatives (m, num_terms, d) of the monomials at
+    the (m, d) points u.
+    """
+    F = np.prod(u[:, None, :] ** terms[None], axis=2)
+
+    dF = np.empty(F.shape + (u.shape[1],))
+    for k in range(u.shape[1]):
+        lowered = terms.copy()
+        lowered[:, k] = np.maximum(lowered[:, k] - 1, 0)
+        dF[:, :, k] = terms[None, :, k] * np.prod(u[:, None, :] ** lowered[None], axis=2)
+
+    return F, dF
+
+
+def parabola_vertex(u, c):
+    """
+    Returns the position of the maximum of the parabola through the 3 points (u[i], c[i]), or
+    u[argmax(c)] if the parabola has no maximum. The result is clipped to [min(u), max(u)].
+    """
+    a, b, _ = np.polyfit(u, c, 2)
+    if a >= 0:
+        return u[np.argmax(c)]
+
+    return np.clip(-b / (2 * a), np.min(u), np.max(u))
+
+
+def fit_quadratic(U, entries, terms, signals, iters, tol):
+    """
+    This function fits the quadratic model of the entries (see the top of this file) to every
+    signal by Gauss-Newton iterations, starting from the best entry (u = 0).
+
+    Input Parameters:
+        U:              (n, d) scaled coordinates of the neighbours
+        entries:        (n, num_samples) their entries
+        terms:          Monomials of the model (see get_terms())
+        signals:        (m, num_samples) signals
+        iters:          Maximum number of iterations
+        tol:            The iterations stop when no coordinate moves by more than tol
+
+    Output Values:
+        u:              (m, d) scaled coordinates of the maxima
+        corr:           (m,) correlation of the signals with the model at u
+    """
+    F, _ = eval_terms(terms, U)
+    coef = np.linalg.lstsq(F, entries, rcond=None)[0]
+    lo, hi = U.min(axis=0), U.max(axis=0)
+
+    def model_corr(u):
+        D = eval_terms(terms, u)[0] @ coef
+        D_norm = np.linalg.norm(D, axis=1)
+        return np.abs(np.sum(D.conj() * signals, axis=1)) / np.where(D_norm > 0, D_norm, np.inf)
+
+    u = np.zeros((len(signals), U.shape[1]))
+    corr = model_corr(u)
+    for _ in range(iters):
+        F, dF = eval_terms(terms, u)
+
+        # Linearized around u, s ~= a (D + sum_k du_k dD/du_k), solved for a and b = a du
+        M = np.concatenate([(F @ coef)[:, None], np.einsum("mtk,tn->mkn", dF, coef)], axis=1)
+        G = np.einsum("mkn,mln->mkl", M.conj(), M)
+        b = np.einsum("mkn,mn->mk", M.conj(), signals)
+        x = (np.linalg.pinv(G) @ b[..., None])[..., 0]
+        step = np.real(x[:, 1:] / np.where(x[:, 0] != 0, x[:, 0], np.inf)[:, None])
+
+        # Steps that would lower the correlation are halved (and dropped after a few tries)
+        moved = np.zeros(len(u))
+        for _ in range(4):
+            u_new = np.clip(u + step, lo, hi)
+            corr_new = model_corr(u_new)
+            better = corr_new >= corr
+            moved[better] = np.max(np.abs(u_new - u), axis=1)[better]
+            u[better], corr[better] = u_new[better], corr_new[better]
+            step[better] = 0
+            step /= 2
+            if np.all(better):
+                break
+
+        if np.all(moved < tol):
+            break
+
+    return u, corr
+
+
+def refine_matches(name, signals, inds, axes=None, model="quadratic", box_axes=4, iters=10, tol=1e-4):
+    """
+    This function refines the matches of signals to a dictionary (see the top of this file).
+
+    Example:
+        m = DictMatcher("dict.h5")
+        inds, corr, pd = m.match(signals)
+        maps = refine_matches("dict.h5", signals, inds)
+
+    Input Parameters:
+        name:           Path of the dictionary (either backend)
+        signals:        (..., num_samples) array of signals, real or complex
+        inds:           Flat indices of their best entries, as returned by a matcher (only the
+                        best match, inds[..., 0], is used)
+        axes:           Names of the axes to refine (see Params.axis_names), defaults to every
+                        axis that has more than one value
+        model:          One of refine_models
+        box_axes:       Largest number of refined axes for which the whole box of neighbours is
+                        used (3^d entries), the star along the axes is used above that
+        iters:          Maximum number of Gauss-Newton iterations ("quadratic" model)
+        tol:            Convergence tolerance of the iterations, in grid steps
+
+    Output Values:
+        Python dict mapping each name in val_names to a parameter map of shape inds.shape[:-1]
+        (the grid values for the axes that are not refined), and "corr" to the correlation of
+        the signals with the model at the refined parameters ("quadratic") or with the best
+        entry ("parabola")
+    """
+    if model not in refine_models:
+        raise ValueError(f"Error: Unknown refinement model '{model}' (expected one of {refine_models})")
+
+    with open_reader(name) as r:
+        vals = {n: np.atleast_1d(v) for n, v in r.get_vals().items()}
+        shape = tuple(r.shape)
+        num_samples = r.num_samples
+
+    if points_name in vals:
+        raise ValueError(f"Error: {name} is a scattered dictionary, its entries have no grid neighbours")
+
+    signals = np.asarray(signals)
+    if signals.shape[-1] != num_samples:
+        raise ValueError(f"Error: Signals have {signals.shape[-1]} samples, the dictionary has {num_samples}")
+
+    best = np.asarray(inds)[..., 0]
+    out_shape = best.shape
+    sig = signals.reshape(-1, num_samples)
+    best = best.ravel()
+
+    if axes is None:
+        axes = [a for a, n in zip(Params.axis_names, shape) if n > 1]
+    unknown = set(axes) - set(Params.axis_names)
+    if unknown:
+        raise ValueError(f"Error: Unknown axis names {sorted(unknown)} (expected one of {Params.axis_names})")
+    refined = [a for a in range(len(shape)) if (Params.axis_names[a] in axes) and (shape[a] > 1)]
+    if len(refined) == 0:
+        raise ValueError(f"Error: None of the axes {list(axes)} has more than one value in {name}")
+    box = len(refined) <= box_axes
+
+    # Start from the grid values
+    maps = {n: np.asarray(v, dtype=np.float64).copy() for n, v in index_to_vals(vals, best).items()}
+    corr = np.zeros(len(best))
+
+    sig_norm = np.linalg.norm(sig, axis=1)
+    sig_norm = np.where(sig_norm > 0, sig_norm, 1)
+
+    # Signals are refined together when they have the same best entry
+    cells, groups = np.unique(best, return_inverse=True)
+    order = np.argsort(groups, kind="stable")
+    bounds = np.searchsorted(groups[order], np.arange(len(cells) + 1))
+
+    with open_reader(name) as r:
+        for c, cell in enumerate(cells):
+            rows = order[bounds[c]:bounds[c + 1]]
+            idx = np.unravel_index(cell, shape)
+
+            points = get_stencil(idx, shape, refined, box)
+            entries = r.read_entries(np.ravel_multi_index(tuple(np.array(points).T), shape))
+            entries = entries.astype(np.complex128 if np.iscomplexobj(entries) else np.float64)
+
+            # Coordinates of the neighbours, in units of the local grid spacing of each axis
+            scale = np.ones(len(refined))
+            for k, a in enumerate(refined):
+                x = vals[val_names[a]]
+                lo, hi = max(idx[a] - 1, 0), min(idx[a] + 1, shape[a] - 1)
+                scale[k] = (x[hi] - x[lo]) / 2 if x[hi] != x[lo] else 1
+            U = np.array([[(vals[val_names[a]][p[a]] - vals[val_names[a]][idx[a]]) / scale[k]
+                           for k, a in enumerate(refined)] for p in points]).reshape(len(points), len(refined))
+
+            if model == "quadratic":
+                sizes = [len(np.unique(U[:, k])) for k in range(len(refined))]
+                terms = get_terms(sizes, box)
+                u, corr[rows] = fit_quadratic(U, entries, terms, sig[rows] / sig_norm[rows, None], iters, tol)
+            else:
+                e_norm = np.linalg.norm(entries, axis=1)
+                cc = np.abs(sig[rows].conj() @ entries.T) / np.where(e_norm > 0, e_norm, np.inf) / sig_norm[rows, None]
+                corr[rows] = cc[:, 0]
+
+                u = np.zeros((len(rows), len(refined)))
+                for k in range(len(refined)):
+                    on_line = np.all(np.delete(U, k, axis=1) == 0, axis=1)
+                    if np.count_nonzero(on_line) == 3:
+                        u[:, k] = [parabola_vertex(U[on_line, k], cc[j, on_line]) for j in range(len(rows))]
+
+            for k, a in enumerate(refined):
+                maps[val_names[a]][rows] = vals[val_names[a]][idx[a]] + u[:, k] * scale[k]
+
+    maps = {n: v.reshape(out_shape) for n, v in maps.items()}
+    maps["corr"] = corr.reshape(out_shape)
+
+    return maps
@@ -0,0 +1,208 @@
+##############################################################################
+#   This file contains the sharing of sequence templates (see template.py)   #
+#   between worker processes.                                                #
+#                                                                            #
+#   Pickling a template (or an MRFSim) to every worker copies the fields of  #
+#   every block into every worker. Instead, share_template() writes the      #
+#   arrays of a template once, into one memory-mapped file (in /dev/shm,     #
+#   i.e. shared memory, where there is one), and returns a handle: the path  #
+#   of the file and a copy of the template where every array is replaced by  #
+#   its place in the file. The handle is a few KB, whatever the size of the  #
+#   sequence. A worker gets the template back with attach_template(), which  #
+#   maps the file read-only, so every array of the template is a zero-copy   #
+#   view of the same pages, shared by all of the workers.                    #
+#                                                                            #
+#   Arrays that are views of the same array (e.g. the fields of the blocks   #
+#   and of the compiled sequence, which are all views of the timeline, see   #
+#   timeline.py) are written once, and stay views of each other.            #
+##############################################################################
+
+import numpy as np
+import os
+import tempfile
+from copy import copy
+from .template import SequenceTemplate
+from .sim_blocks.SimObj import SimObj
+
+align = 64      # Alignment of the arrays in the file [bytes]
+
+
+
+class SharedArray:
+    """
+    This class stands in for an array of a shared template (see the top of this file): it
+    holds where the array is in the file.
+    """
+
+
+    def __init__(self, offset, shape, dtype, strides):
+        self.offset = offset
+        self.shape = shape
+        self.dtype = dtype
+        self.strides = strides
+
+
+    def attach(self, buf):
+        """
+        Returns the array, as a view of buf (the mapped file).
+        """
+        return np.ndarray(self.shape, self.dtype, buffer=buf, offset=self.offset, strides=self.strides)
+
+
+
+def map_arrays(obj, func, memo):
+    """
+    Returns a copy of obj where every numpy array (or SharedArray) is replaced by func(array).
+    obj can be any combination of python dicts, lists, tuples, SequenceTemplate and SimObj
+    instances, and objects that are found several times are copied once (memo maps their id
+    to the copy).
+    """
+    if isinstance(obj, (np.ndarray, SharedArray)):
+        return func(obj)
+
+    if id(obj) in memo:
+        return memo[id(obj)]
+
+    if isinstance(obj, dict):
+        new = memo[id(obj)] = {}
+        new.update((key, map_arrays(val, func, memo)) for key, val in obj.items())
+    elif isinstance(obj, list):
+        new = memo[id(obj)] = []
+        new.extend(map_arrays(val, func, memo) for val in obj)
+    elif isinstance(obj, tuple):
+        new = memo[id(obj)] = tuple(map_arrays(val, func, memo) for val in obj)
+    elif isinstance(obj, (SequenceTemplate, SimObj)):
+        new = memo[id(obj)] = copy(obj)
+        for name, val in vars(obj).items():
+            setattr(new, name, map_arrays(val, func, memo))
+    else:
+        new = obj
+
+    return new
+
+
+
+def get_root(arr):
+    """
+    Returns the array that owns the memory arr is a view of, or None if that memory is not
+    contiguous.
+    """
+    root = arr
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+
+    if root.flags.c_contiguous or root.flags.f_contiguous:
+        return root
+
+    return None
+
+
+
+class SharedTemplate:
+    """
+    This class publishes a SequenceTemplate in a memory-mapped file (see the top of this file).
+    The file is removed by close() (or at the end of a with statement). Workers that already
+    attached keep their mapping.
+
+    Input Parameters:
+        template:   The SequenceTemplate to share
+        dirname:    Optional directory of the file (/dev/shm where there is one, the temporary
+                    directory otherwise)
+
+    Class Variables:
+        path:       Path of the file
+        layout:     Copy of the template where every array is replaced by a SharedArray
+    """
+
+
+    def __init__(self, template, dirname=None):
+        if dirname is None:
+            dirname = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+        # Place the memory of every array once
+        roots = {}
+        size = 0
+        def place(arr):
+            nonlocal size
+            if arr.dtype.hasobject:
+                # Can't be shared, goes in the layout as it is
+                return arr
+
+            root = get_root(arr)
+            key = id(arr if root is None else root)
+            if key not in roots:
+                if root is None:
+                    # Written on its own, as a contiguous copy
+                    root = np.ascontiguousarray(arr)
+                roots[key] = (root, size)
+                size += -(-root.nbytes // align) * align
+
+            root, offset = roots[key]
+            if get_root(arr) is None:
+                return SharedArray(offset, root.shape, root.dtype, root.strides)
+
+            return SharedArray(offset + arr.ctypes.data - root.ctypes.data, arr.shape, arr.dtype, arr.strides)
+
+        self.layout = map_arrays(template, place, {})
+
+        fd, self.path = tempfile.mkstemp(prefix="um_mrf_template_", suffix=".bin", dir=dirname)
+        os.close(fd)
+
+        # An empty file can't be mapped
+        buf = np.memmap(self.path, dtype=np.uint8, mode="w+", shape=(max(size, 1),))
+        for root, offset in roots.values():
+            data = root if root.flags.c_contiguous else root.T
+            buf[offset:offset + root.nbytes] = np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+        buf.flush()
+        del buf
+
+
+    def get_handle(self):
+        """
+        Returns what a worker needs to attach to the template (see attach_template()). It is
+        small, so it can be passed to every worker (e.g. as an argument of a pool initializer).
+        """
+        return self.path, self.layout
+
+
+    def close(self):
+        """
+        Removes the file. Workers that attached before keep their mapping.
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+def share_template(template, dirname=None):
+    """
+    This function publishes a SequenceTemplate for worker processes (see SharedTemplate), e.g.
+
+        with share_template(sim.get_template()) as shared:
+            with Pool(64, initializer=init_worker, initargs=(shared.get_handle(),)) as pool:
+                ...
+
+    where init_worker() calls attach_template() on the handle and keeps the template.
+    """
+    return SharedTemplate(template, dirname)
+
+
+
+def attach_template(handle):
+    """
+    This function returns the SequenceTemplate of a handle (see SharedTemplate.get_handle()),
+    whose arrays are read-only views of the shared file. The file only has to exist while
+    attaching.
+    """
+    path, layout = handle
+    buf = np.memmap(path, dtype=np.uint8, mode="r")
+
+    return map_arrays(layout, lambda arr: arr.attach(buf) if isinstance(arr, SharedArray) else arr, {})
@@ -13,6 +13,9 @@ class BIR8(SimObj):
     eTE = 22
     crush_length = 750 
 
+    # Not simulated step by step (see run_ljn())
+    can_fuse = False
+
 
     def __init__(self, T, dt, dynamic_time=False, crusher_times=np.array([]), sample_times=np.array([]), avg_samples=True):
         """
@@ -47,13 +50,44 @@ class BIR8(SimObj):
         pass
 
     
+    def describe(self):
+        """
+        Extends SimObj's definition of describe() with the constants used in run_ljn().
+        """
+        desc = super().describe()
+        desc["eTE"] = self.eTE
+        desc["crush_length"] = self.crush_length
+        return desc
+
+    
+    def run_ljn_batch(self, p, M_start, rf_scales, s=None):
+        """
+        This method overrides SimObj's definition of run_ljn_batch(). This block does not play
+        any RF, and the magnetization is the same at every timepoint (see run_ljn()), so it is
+        computed for the whole batch at once. Nothing is written to the block (run_ljn() reuses
+        self.M), so a read-only block can run it (see template.py).
+        """
+        M_start = np.atleast_2d(M_start)
+
+        M_end = np.zeros((len(M_start), 4))
+        M_end[:, 2] = M_start[:, 2] * np.exp(-self.eTE / p.T2_f)
+        M_end[:, 2] *= -np.exp(-self.crush_length / p.T1_f)
+        M_end[:, 2] += 1
+
+        M_samples = np.repeat(M_end[:, None, :], len(self.sample_inds), axis=1)
+
+        return M_samples, M_end
+
+
     def run_ljn(self, p, M_start=...):
         # NOTE: THIS IS TEMPORARY...
         #       ALTHOUGH THIS WILL NOT FAIL WHEN FITTING ASL PARAMS,
         #       IT WILL NOT ACURATELY SIMULATE THE EFFECTS OF A BOLUS
 
         
-        self.M = np.zeros((self.ntime, 4))
+        # The output buffer is only allocated once (every element is set below)
+        if (getattr(self, "M", None) is None) or (self.M.shape != (self.ntime, 4)):
+            self.M = np.zeros((self.ntime, 4))
 
         # T2 decay
         self.M[:, 2] = M_start[2] * np.exp(-self.eTE / p.T2_f)
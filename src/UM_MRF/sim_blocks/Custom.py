@@ -8,6 +8,8 @@
 from .SimObj import SimObj
 from numpy import size, shape
 import numpy as np
+from hashlib import sha256
+from ..helpers import update_hash
 
 
 class Custom(SimObj):
@@ -48,16 +50,21 @@ class Custom(SimObj):
 
         self.B = B
         self.s = s
+        self.waveform = np.asarray(B)
+
+        # B and s may be modified later on (see SimObj.optimize_time()), so we hash the
+        # waveforms now, while they are still the ones we were given.
+        h = sha256()
+        update_hash(h, [B, s])
+        self.waveform_hash = h.hexdigest()
 
 
     def set_rf(self, params):
         """
-        This method overrides SimObj's definition of set_rf(). The RF pulses should already be
-        incorporated into this object's B field array, therefor there is nothing to do.
-
-        This method essentially does nothing.
+        This method overrides SimObj's definition of set_rf(). The RF pulses are part of the
+        given B field, so we add it as a whole (see SimObj.compute_B()).
         """
-        pass
+        super().set_rf(self.waveform)
 
 
     def set_gradients(self):
@@ -69,4 +76,13 @@ class Custom(SimObj):
         """
         pass
 
-    
\ No newline at end of file
+    
+
+
+    def describe(self):
+        """
+        Extends SimObj's definition of describe() with the hash of the given waveforms.
+        """
+        desc = super().describe()
+        desc["waveforms"] = self.waveform_hash
+        return desc
@@ -30,6 +30,7 @@ class GRE(SimObj):
     perfect absorption.
     """
     absorption = 1.0  
+    B_depends = ("flip", "B1")
 
 
     def  __init__(self, PW, ETL, delay, ESP, dt, dynamic_time=False, crusher_times=np.array([]), sample_times=np.array([]), avg_samples=True):
@@ -68,6 +69,14 @@ class GRE(SimObj):
         super().set_rf(rf)
 
 
+    def get_rf_scale(self, flip, B1):
+        """
+        This method overrides SimObj's definition of get_rf_scale(). The RF pulsetrain is
+        proportional to the flip angle (see gre_pulsetrain()).
+        """
+        return flip * B1
+
+
     def set_gradients(self):
         """
         This method overrides SimObj's definition of set_gradients(). At the moment
@@ -79,19 +88,6 @@ class GRE(SimObj):
         pass
 
 
-    def set_flip(self, params):
-        """
-        This method lets you change the flip angle and RF phase of this block. It re-calls
-        the method that sets the RF series.
-        """
-
-        # Reset the Effective B-Field
-        self.B = np.zeros((self.ntime, 3))
-
-        self.set_rf(params)
-        self.set_gradients()    # Currently does nothing
-
-
 # 117 mG * 1 ms = 180 degree flip
 def gre_pulsetrain(PW, ESP, ETL, delay, T, dt, flip, phase=0):
     ntime = np.int32(np.ceil(T / dt))
@@ -6,6 +6,7 @@
 
 import numpy as np
 #from .simulators.np_blochsim_ljn import np_blochsim_ljn
+from ..simulators.np_blochsim_ljn import np_blochsim_ljn_batch
 from UM_Blochsim import blochsim_ljn, blochsim_ljn_dyntime
 from ..Params import Params
 from ..helpers import *
@@ -31,6 +32,9 @@ class SimObj:
                             the pCASL(SimObj) child class specifically, we use a large
                             positive value instead.
         M_start_default:    Default Starting Magnetization Vector [0 0 1 1]
+        can_fuse:           True if the block is simulated step by step by the LJN simulator, so
+                            that it can be part of a fused sequence (see MRFSim.compile_sequence()).
+                            Children that simulate themselves in another way set it to False.
 
     Crucial Methods:
         __init__():         Creates a new instance of the SimObj class.
@@ -40,6 +44,16 @@ class SimObj:
     absorption = 1.0
     saturation = 0
     M_start_default = np.array([0.0, 0.0, 1.0, 1.0])
+    can_fuse = True
+
+    # Attributes of the Params object that each field of the block depends on (see
+    # update_fields()). Children override these, e.g. a GRE block's B(t) depends on the flip
+    # angle. Every RF pulse is scaled by B1 (see compute_B()). The shape of s(t) only depends
+    # on BAT through the bolus queue, so it is only a dependency of the blocks that play at or
+    # after a labeling block.
+    B_depends = ("B1",)
+    s_shape_depends = ("BAT",)
+    s_depends = ("F", "lam", "alpha", "M0_f", "BAT", "T1_b")
 
 
     def __new__(cls, *args, **kwargs):
@@ -93,6 +107,9 @@ class SimObj:
         # Initialize B(t) and s(t) arrays
         self.B = np.zeros((self.ntime, 3))          # (ntime, 3) array of B vectors [T] (initally set to 0s)
         self.s = np.zeros((self.ntime, ))           # (ntime, ) array of arterial magnetization values (initially set to 0s)
+        self.keep = None                            # Timepoints kept by optimize_time() (None for all of them)
+        self.inputs = None                          # Values the fields were computed for (see update_fields())
+        self.updated = True                         # Whether the last update_fields() changed anything
 
         # Input validation: Make sure the sample points are within the block
         if np.any((sample_times >= self.T) | (sample_times < 0.0)):
@@ -166,9 +183,46 @@ class SimObj:
 
     def set_flip(self, params):
         """
-        This is the default case for a child object's definition of set_flip. It does nothing
+        This method recomputes the effective B field for the current parameters (e.g. a new flip
+        angle), see compute_B().
+        """
+        self.B = self.compute_B(params)
+
+
+    def compute_B(self, params):
+        """
+        This method computes the effective B field of the block from scratch, at the full time
+        resolution (gradients and RF pulses, see set_gradients() and set_rf()). The RF field
+        (the transverse components) is scaled by params.B1.
+
+        Output Values:
+            The (ntime, 3) array of B vectors [T], which is also left in self.B
+        """
+        self.B = np.zeros((int(np.ceil(self.T / self.dt)), 3))
+
+        self.set_gradients()
+        self.set_rf(params)
+        self.B[:, 0:2] *= params.B1
+
+        return self.B
+
+
+    def get_rf_scale(self, flip, B1):
+        """
+        Returns the factor (up to a constant) that the RF field of the block is proportional to,
+        for the given flip angles and B1 scales (arrays or numbers). The RF of most blocks only
+        depends on B1, children whose pulses are set by the flip angle override this. This is
+        what lets several flip angles be simulated at once (see run_ljn_batch()).
+        """
+        return B1 * np.ones_like(flip)
+
+
+    def adds_bolus(self):
+        """
+        Returns True if this block labels a bolus of blood (adds it to the queue of set_s_shape()).
+        Only labeling pCASL blocks do.
         """
-        pass
+        return False
 
 
     def set_s_shape(self, time_queue, BAT):
@@ -209,17 +263,20 @@ class SimObj:
               - (params.F * 2 * params.alpha * params.M0_f / params.lam) * \
                 np.exp(-params.BAT / params.T1_b) * 
         """
+        # s_shape is always kept at the full time resolution (see optimize_time())
+        time = np.arange(int(np.ceil(self.T / self.dt))) * self.dt
+
         # If the queue is empty, return, nothing to do.
         if len(time_queue) == 0:
-            self.s_shape = 0.0 * self.time
+            self.s_shape = 0.0 * time
             return ([])
         elif time_queue[0][0] < self.T:
             # Pulse plays during this block iff the start time of the pulse is less
             # than the durration of the block
-            self.s_shape = ((self.time >= time_queue[0][0]) & (self.time < time_queue[0][1]))
+            self.s_shape = ((time >= time_queue[0][0]) & (time < time_queue[0][1]))
         else:
             # There are no pulses playing in this block
-            self.s_shape = 0.0 * self.time
+            self.s_shape = 0.0 * time
 
 
         # Update start and end times
@@ -240,8 +297,11 @@ class SimObj:
     def scale_s(self, F, lam, alpha, M0_f, BAT, T1_b):
         if not hasattr(self, "s_shape"):
             raise ValueError("SimObj doesnt have the s_shape")
-        
-        self.s = - (2 * F * alpha * M0_f / lam) * np.exp(-BAT / T1_b) * self.s_shape
+
+        # Only the timepoints that optimize_time() kept
+        s_shape = self.s_shape if self.keep is None else self.s_shape[self.keep]
+
+        self.s = - (2 * F * alpha * M0_f / lam) * np.exp(-BAT / T1_b) * s_shape
    
 
     def run_np_ljn(self, params, M_start=M_start_default):
@@ -257,6 +317,32 @@ class SimObj:
         #self.M = np_blochsim_ljn(self.B, self.s, params, self.dt, self.ntime, M_start, crusher_inds=crusher_inds, absorption=self.absorption, s_sat=self.saturation, timer=False)
 
 
+    def describe(self):
+        """
+        This method returns a python dict of everything that defines this block (its type,
+        timing, sampling, crushers and pool interaction constants). It is used to compute a
+        hash of the pulse sequence (see MRFSim.get_seq_hash()), so two blocks that would
+        produce the same simulation must give the same description.
+
+        Children that hold extra configuration (or arbitrary waveforms) extend this.
+        """
+        return {
+            "type": type(self).__name__,
+            "T": self.T,
+            "dt": self.dt,
+            "PW": self.PW,
+            "ETL": self.ETL,
+            "delay": self.delay,
+            "ESP": self.ESP,
+            "dynamic_time": self.dynamic_time,
+            "avg_samples": self.avg_samples,
+            "absorption": self.absorption,
+            "saturation": self.saturation,
+            "sample_times": self.sample_times,
+            "crusher_times": self.crusher_times,
+        }
+
+
     def reset_fields(self):
         # Reset time arrays and values to non-optimized
         self.ntime = int(np.ceil(self.T / self.dt))      # Number of time samples
@@ -265,9 +351,152 @@ class SimObj:
         # Initialize B(t) and s(t) arrays
         self.B = np.zeros((self.ntime, 3))          # (ntime, 3) array of B vectors [T] (initally set to 0s)
         self.s = np.zeros((self.ntime, ))           # (ntime, ) array of arterial magnetization values (initially set to 0s)
+        self.keep = None
+
+        # The fields no longer match what update_fields() last computed
+        self.inputs = None
+
+
+    def get_depends(self):
+        """
+        Returns a python dict mapping each field of the block ("B", "s_shape", "s" and the time
+        grid, "time") to the names of the Params attributes it depends on. The time grid is
+        built from the change points of B(t) and of the shape of s(t) (see optimize_time()).
+        """
+        return {
+            "B": self.B_depends,
+            "s_shape": self.s_shape_depends,
+            "s": self.s_depends,
+            "time": tuple(dict.fromkeys(self.B_depends + self.s_shape_depends)),
+        }
+
+
+    def update_fields(self, params, time_queue, labeled=True, force=False):
+        """
+        This method brings B(t), s(t) and the time grid of the block up to date with the current
+        values of params, recomputing only the fields whose inputs changed since the last call:
+
+            B(t)        when one of B_depends changed (see compute_B())
+            s_shape     when one of s_shape_depends changed, for labeled blocks only
+            time grid   when B(t) or the shape of s(t) actually changed (see optimize_time())
+            s(t)        when one of s_depends changed, or the time grid did
+
+        The full resolution B(t) is kept in self.B_full (and the shape of s(t) always is at full
+        resolution), so the time grid can be rebuilt without recomputing the other field.
+
+        Input Parameters:
+            params:         The Params object holding the current parameter values
+            time_queue:     Queue of incoming boluses (see set_s_shape())
+            labeled:        False if no labeling block plays before this one (or is this one),
+                            in which case s(t) is 0 whatever the parameters
+            force:          Recompute everything
+
+        Output Values:
+            The queue of boluses for the next block (see set_s_shape())
+
+        self.updated is left True if any field was recomputed.
+        """
+        retime = False
+        self.updated = False
+        if force or (self.inputs is None):
+            self.reset_fields()
+            self.inputs = {}
+            retime = True
+
+        key = tuple(getattr(params, n) for n in self.B_depends)
+        if key != self.inputs.get("B"):
+            prev, B = getattr(self, "B_full", None), self.B
+            self.B_full = self.compute_B(params)
+            self.inputs["B"] = key
+            self.updated = True
+
+            # e.g. a block without RF pulses does not change with B1, in which case the field
+            # on the current time grid is kept
+            if (not retime) and (prev is not None) and np.array_equal(prev, self.B_full):
+                self.B = B
+            else:
+                retime = True
+
+        key = tuple(getattr(params, n) for n in self.s_shape_depends) if labeled else ()
+        if key != self.inputs.get("s_shape"):
+            prev = getattr(self, "s_shape", None)
+            self.queue_out = self.set_s_shape(list(time_queue), params.BAT)
+            self.inputs["s_shape"] = key
+            self.updated = True
+
+            # The same rect in this block (e.g. the bolus has passed) does not change the grid
+            retime = retime or (prev is None) or not np.array_equal(prev, self.s_shape)
+
+        if retime:
+            self.ntime = int(np.ceil(self.T / self.dt))
+            self.time = np.arange(self.ntime) * self.dt
+            self.B = self.B_full
+            self.s = np.zeros((self.ntime, ))
+            self.keep = None
+            self.optimize_time()
+            self.inputs.pop("s", None)
+
+        key = tuple(getattr(params, n) for n in self.s_depends) if labeled else ()
+        if key != self.inputs.get("s"):
+            self.scale_s(params.F, params.lam, params.alpha, params.M0_f, params.BAT, params.T1_b)
+            self.inputs["s"] = key
+            self.updated = True
+
+        return self.queue_out
+
+
+    def get_dts(self):
+        """
+        Returns the (ntime, ) timesteps of the block [ms], dts[t] being the step from t - 1 to t
+        (dts[0] is not used). These are all dt, unless the time grid is dynamic.
+        """
+        if self.dynamic_time:
+            return np.diff(self.time, prepend=self.time[0])
+        else:
+            return np.full(self.ntime, self.dt)
 
     
-    def sample(self, CBV):
+    def run_ljn_batch(self, p: Params, M_start, rf_scales, s=None):
+        """
+        This method simulates the block for a batch of RF scales at once (see
+        simulators/np_blochsim_ljn.py): member k of the batch sees the RF field of self.B
+        multiplied by rf_scales[k].
+
+        Input Parameters:
+            p:              The Params object holding the current parameter values
+            M_start:        (K, 4) starting magnetization of each member of the batch
+            rf_scales:      (K, ) factors of the RF field
+            s:              Optional (K, ntime) arterial magnetization seen by each member of
+                            the batch (self.s for all of them by default)
+
+        Output Values:
+            M_samples:      (K, len(self.sample_inds), 4) magnetization at the sample times
+            M_end:          (K, 4) magnetization at the end of the block
+        """
+        out_inds = np.append(self.sample_inds, self.ntime - 1)
+        M = np_blochsim_ljn_batch(self.B, self.s if s is None else s, M_start, self.get_dts(), rf_scales, p.R1f_app, p.R2f_app, p.R1s_app, p.ks, p.kf, p.f, p.M0_f, p.M0_s,
+                                  out_inds, crusher_inds=self.crusher_inds, absorp=self.absorption, s_sat=self.saturation)
+
+        return M[:, :-1], M[:, -1]
+
+
+    def sample_batch(self, M_samples, CBV, s=None):
+        """
+        This method is the batched version of sample(): it returns the (K, num_samples) samples
+        of the block from the magnetization at the sample times given by run_ljn_batch() (s is
+        the same as there).
+        """
+        s = np.atleast_2d(self.s if s is None else s)
+        sample_array = np.linalg.norm(M_samples[..., 0:2], axis=2) * (1 - CBV) \
+                    + s[:, self.sample_inds] * CBV
+
+        if self.avg_samples:
+            return np.mean(sample_array, axis=1, keepdims=True)
+        else:
+            return sample_array
+
+
+    def sample(self, CBV, out=None):
         """
         This function obtains samples from the simulated magnetization and returns them. This
         method will be called from the MRFSim object where the samples will be stored and added
@@ -287,6 +516,8 @@ class SimObj:
 
         Input:
             CBV:    Cerebral Blood Volume. The fraction of blood in a voxel.
+            out:    Optional (num_samples, ) array the samples are written to (see
+                    MRFSim.run_one_np()), instead of a new one.
 
         Output:
             An (n, ) numpy array of samples from this block, where n is the number of sample times.
@@ -301,13 +532,18 @@ class SimObj:
         sample_array = np.linalg.norm(self.M[self.sample_inds, 0:2], axis=1) * (1 - CBV) \
                     + self.s[self.sample_inds] * CBV
 
+        if out is None:
+            out = np.empty(self.num_samples)
+
         # Now we return an array of the actual samples.
         if self.avg_samples:
             # Here we average together all samples from this block
-            return np.array([np.mean(sample_array)])
+            out[0] = np.mean(sample_array)
         else:
             # Don't average, return the samples themselves.
-            return sample_array
+            out[:] = sample_array
+
+        return out
     
 
     def optimize_time(self):
@@ -319,9 +555,11 @@ class SimObj:
         self.ntime = int(np.ceil(self.T / self.dt))      # Number of time samples
         self.time = np.arange(self.ntime) * self.dt        # Vector of Timepoints [ms]
 
-        # Get B and s change times
+        # Get B and s change times (from the shape of s(t), so that the grid does not
+        # depend on how s(t) is scaled, see scale_s())
+        s_shape = np.asarray(self.s_shape if hasattr(self, "s_shape") else self.s, dtype=np.float64)
         B_change_arr = isnapprox(self.B[1:, :], self.B[0:-1, :])
-        s_change_arr = isnapprox(self.s[1:], self.s[0:-1])
+        s_change_arr = isnapprox(s_shape[1:], s_shape[0:-1])
 
         # Get crusher and sample points
         crush_arr = np.zeros((self.ntime - 1, ), dtype=bool)
@@ -347,9 +585,11 @@ class SimObj:
         self.crusher_inds = np.searchsorted(self.time, self.crusher_times, side="left")
         self.sample_inds = np.searchsorted(self.time, self.sample_times, side="left")
 
-        # We finally clip the B and S arrays down to their final sizes
+        # We finally clip the B and S arrays down to their final sizes (s_shape stays at full
+        # resolution, scale_s() picks the kept timepoints)
         self.B = self.B[change_arr]
         self.s = self.s[change_arr]
+        self.keep = change_arr
 
 
 
@@ -94,6 +94,23 @@ class pCASL(SimObj):
         return super().set_s_shape(time_queue, BAT)
 
 
+    def adds_bolus(self):
+        """
+        This method overrides SimObj's definition of adds_bolus(). Labeling pulsetrains add a
+        bolus to the queue (see set_s_shape()), control pulsetrains don't.
+        """
+        return not self.control
+
+
+    def describe(self):
+        """
+        Extends SimObj's definition of describe() with the label/control flag.
+        """
+        desc = super().describe()
+        desc["control"] = self.control
+        return desc
+
+
 def pcasl_rf_gen(flip, ntime, dt, pw, TR, d_psi, psi_0, control=False):
     # This will be one RF pulse
     block = np.zeros(np.int64(np.ceil(TR / dt)))
@@ -224,3 +224,150 @@ def np_blochsim_ljn(B, s, p, dt, n_time, M_start, absorption, s_sat=0.0, crusher
 
     return M
 
+
+
+def np_blochsim_ljn_batch(B, s, M_start, dts, rf_scales, R1f, R2f, R1s, ks, kf, f, M0_f, M0_s, out_inds, crusher_inds=np.array([]), absorp=1.0, s_sat=0.0):
+    """
+    This function runs the LJN simulation (see np_blochsim_ljn()) for a batch of K RF scales at
+    once: member k of the batch sees the effective B field with its transverse (RF) components
+    multiplied by rf_scales[k], and everything else (relaxation, exchange) is shared. s(t) is
+    either shared too or given for each member (e.g. the label and control versions of a
+    sequence, which only differ by s(t)). This is how several flip angles and B1+ scales, or
+    label and control, are simulated in one pass.
+
+    Every step is an affine map of the magnetization, M[t] = P_t M[t - 1] + q_t, where only
+    P_t depends on the RF scale and only q_t on s(t). Consecutive steps with the same B, s,
+    timestep (and RF scale, absorption and saturation) have the same map, so a run of n of them
+    is applied at once as the n-th power of the map (by repeated squaring). Only the
+    magnetization at out_inds is returned, so the cost depends on the number of changes in the
+    sequence, not on its number of timepoints.
+
+    The RF scales, absorption and saturation can change from one step to the next, so a whole
+    pulse sequence can be simulated by one call on the concatenated arrays of its blocks (see
+    MRFSim.compile_sequence()). A step with dts[t] = 0, absorp[t] = 0 and s_sat[t] = 0 leaves
+    the magnetization as it is, which is how one block is joined to the next.
+
+    This function only reads its inputs and writes to arrays of its own, so several threads can
+    call it at once (see MRFSim.run_threaded()). NumPy releases the GIL inside its array loops
+    (the elementwise math on the batch, the norms and the matrix products of the powers), but
+    not in the python loop over the runs of identical steps, so threads only overlap for the
+    time spent in those loops: the larger the batch (K), the better they scale. The C
+    simulators of UM_Blochsim (see SimObj.run_ljn()) are not used by the threads, they write to
+    the blocks. test/test_13.py measures the speedup.
+
+    Parameters:
+        B:              The (n_time, 3) array of effective B field values (for a scale of 1)
+        s:              The (n_time, ) array of arterial magnetization values, or a (K, n_time)
+                        array with the values seen by each member of the batch
+        M_start:        The (K, 4) initial magnetization vectors M[0, :]
+        dts:            The (n_time, ) timesteps [ms], dts[t] being the step from t - 1 to t
+                        (dts[0] is not used)
+        rf_scales:      The (K, ) factors of the RF field, or a (K, n_time) array of them
+        R1f, R2f, R1s:  Apparent relaxation rates [1 / ms]
+        ks, kf, f:      Exchange rates [1 / ms] and pool size ratio M0_s / M0_f
+        M0_f, M0_s:     Equilibrium magnetizations of the two pools
+        out_inds:       Indices of the timepoints to return
+        crusher_inds:   Indices of the timepoints after which the transverse magnetization is crushed
+        absorp:         The coefficient that governs the absorption of the semisolid pool, or a
+                        (n_time, ) array of them
+        s_sat:          The saturation constant of the semisolid pool (see np_ljn_setp()), or a
+                        (n_time, ) array of them
+
+    Output:
+        M:              The (K, len(out_inds), 4) array of magnetization vectors at out_inds
+    """
+    n_time = np.shape(B)[0]
+    rf_scales = np.asarray(rf_scales, dtype=np.float64)
+    K = len(rf_scales)
+    rf_scales = np.broadcast_to(rf_scales.reshape(K, -1), (K, n_time))
+    out_inds = np.asarray(out_inds, dtype=int)
+    s = np.broadcast_to(s, (K, n_time))
+    absorp = np.broadcast_to(np.asarray(absorp, dtype=np.float64), (n_time, ))
+    s_sat = np.broadcast_to(np.asarray(s_sat, dtype=np.float64), (n_time, ))
+
+    # Steps after which the run has to stop (outputs, crushers, last step, and any change of
+    # the map at the next step)
+    stops = np.zeros(n_time, dtype=bool)
+    stops[out_inds] = True
+    stops[np.asarray(crusher_inds, dtype=int)] = True
+    stops[-1] = True
+    stops[1:-1] |= np.any(B[2:] != B[1:-1], axis=1) | np.any(s[:, 2:] != s[:, 1:-1], axis=0) | (dts[2:] != dts[1:-1]) \
+                 | np.any(rf_scales[:, 2:] != rf_scales[:, 1:-1], axis=0) | (absorp[2:] != absorp[1:-1]) | (s_sat[2:] != s_sat[1:-1])
+    crushed = np.zeros(n_time, dtype=bool)
+    crushed[np.asarray(crusher_inds, dtype=int)] = True
+    crushed[0] = False
+
+    # Pseudo-steady-state denominators (see np_ljn_setp())
+    T1f = 1 / R1f
+    T1s = 1 / R1s
+    denom = 1 + T1f * kf + T1s * ks
+
+    ACE_cache = {}
+    M = np.concatenate([np.asarray(M_start, dtype=np.float64).reshape(K, 4), np.ones((K, 1))], axis=1)
+    saved = {0: M[:, 0:4].copy()}
+
+    t = 1
+    for end in np.flatnonzero(stops[1:]) + 1:
+        n = end - t + 1
+        dt = dts[t]
+
+        # A(t) C(t) E(t) only depends on the timestep
+        if dt not in ACE_cache:
+            A = np.identity(4)
+            A_expval = np.exp(-(1 + f) * ks * dt)
+            A[2, 2] = (1 + f * A_expval) / (1 + f)
+            A[3, 2] = (f - f * A_expval) / (1 + f)
+            A[2, 3] = (1 - A_expval) / (1 + f)
+            A[3, 3] = (f + A_expval) / (1 + f)
+            CE = np.diag([np.exp(-dt * R2f), np.exp(-dt * R2f), np.exp(-dt * R1f), np.exp(-dt * R1s)])
+            ACE_cache[dt] = A @ CE
+        ACE = ACE_cache[dt]
+
+        # Rotation (and semisolid absorption) of every member of the batch
+        Bk = np.repeat(B[t][None, :], K, axis=0)
+        Bk[:, 0:2] *= rf_scales[:, t][:, None]
+        B_mag = np.linalg.norm(Bk, axis=1)
+        u = Bk / np.where(B_mag > 0, B_mag, 1)[:, None]
+        theta = gam * B_mag * dt
+        cos_t, sin_t = np.cos(theta), np.sin(theta)
+        ux, uy, uz = u[:, 0], u[:, 1], u[:, 2]
+        omc = 1 - cos_t
+
+        R = np.zeros((K, 4, 4))
+        R[:, 0, 0] = cos_t + ux**2 * omc
+        R[:, 0, 1] = ux*uy*omc - uz*sin_t
+        R[:, 0, 2] = ux*uz*omc + uy*sin_t
+        R[:, 1, 0] = uy*ux*omc + uz*sin_t
+        R[:, 1, 1] = cos_t + uy**2 * omc
+        R[:, 1, 2] = uy*uz*omc - ux*sin_t
+        R[:, 2, 0] = uz*ux*omc - uy*sin_t
+        R[:, 2, 1] = uz*uy*omc + ux*sin_t
+        R[:, 2, 2] = cos_t + uz**2 * omc
+        R[:, 3, 3] = np.exp(-np.pi * (gam * B_mag)**2 * absorp[t])
+        if not is_approx(s_sat[t], 0):
+            R[:, 3, 3] *= np.exp(-np.pi * s_sat[t])
+
+        D = np.zeros((K, 4))
+        D[:, 2] = (1 + T1s * ks) * (M0_f + s[:, t] * T1f) + T1f * ks * M0_s
+        D[:, 3] = (T1s * ks) * (M0_f + s[:, t] * T1f) + (1 + T1f * ks) * M0_s
+        D = D / denom
+
+        # Augmented affine map [[ACE R, (I - ACE) D], [0, 1]], applied n times
+        T = np.zeros((K, 5, 5))
+        T[:, 0:4, 0:4] = ACE @ R
+        T[:, 0:4, 4] = D @ (np.identity(4) - ACE).T
+        T[:, 4, 4] = 1
+        while n > 0:
+            if n & 1:
+                M = np.einsum("kij,kj->ki", T, M)
+            n >>= 1
+            if n > 0:
+                T = T @ T
+
+        if crushed[end]:
+            M[:, 0:2] = 0
+
+        saved[end] = M[:, 0:4].copy()
+        t = end + 1
+
+    return np.stack([saved[i] for i in out_inds], axis=1)
@@ -0,0 +1,419 @@
+##############################################################################
+#   This file contains the streaming SVD used to compress a dictionary       #
+#   while it is being generated (see MRFSim.generate_dict()).                #
+#                                                                            #
+#   Instead of storing every fingerprint (num_samples values per entry),     #
+#   each entry is projected onto a small temporal basis as soon as it is     #
+#   simulated and only its coefficients are stored, in the "svd_coeffs"      #
+#   channel of the dictionary (see dict_manip.init_dict()).                  #
+#                                                                            #
+#   The basis is grown on the fly: whenever an entry is not well described   #
+#   by the current basis, the part that is missing (after Gram-Schmidt) is   #
+#   added as a new basis vector. Along the way, the Gram matrix of the       #
+#   coefficients is accumulated, so that its eigen-decomposition gives the   #
+#   singular vectors of everything seen so far.                              #
+#                                                                            #
+#   Once the working basis is full (max_rank vectors), it is compressed      #
+#   back down to the rank leading singular vectors, which starts a new       #
+#   "epoch". The coefficients that were already stored are not rewritten,   #
+#   instead we keep, for every epoch, the matrix that takes coefficients     #
+#   from that epoch to the current basis. At the end, the basis is rotated   #
+#   into the singular vectors of the whole dictionary, and every stored      #
+#   coefficient is brought to it (a single pass over the coefficients).      #
+#   The first rank columns of the coefficients (and rows of the basis) are   #
+#   then the rank-K SVD. Whatever gets dropped along the way is counted in   #
+#   the lost energy, so the reported energy retention is exact. Once the     #
+#   dictionary is closed, the coefficients are cut down to those rank        #
+#   columns, and the state that was only needed to get there is dropped      #
+#   (see StreamingSVD.compact()).                                            #
+#                                                                            #
+#   All of the state lives in the dictionary's auxiliary arrays, so a run    #
+#   can be resumed (see Params.resume()). That includes the final pass: the  #
+#   coefficients are brought to the singular vectors a block at a time, and  #
+#   each new block is saved (along with how far we got) before it replaces  #
+#   the old one, so a block is never transformed twice.                      #
+##############################################################################
+
+import numpy as np
+from .dict_manip import open_reader, add_aux, map_channel, block_slices, trim_dict
+
+
+coeff_name = "svd_coeffs"
+epoch_name = "svd_epoch"
+work_basis_name = "svd_work_basis"
+gram_name = "svd_gram"
+transforms_name = "svd_transforms"
+stats_name = "svd_stats"
+basis_name = "svd_basis"
+sv_name = "svd_sv"
+progress_name = "svd_finalize"
+journal_name = "svd_journal"
+
+# Indices into the stats array
+RANK, USED, ENERGY, LOST, EPOCH, FINALIZED = range(6)
+
+# Indices into the progress array of finalize()
+ROTATED, DONE, JOURNAL_START, JOURNAL_LEN = range(4)
+
+finalize_block = 4096       # Number of coefficients brought to the singular vectors at a time
+
+
+
+class StreamingSVD:
+    """
+    This class holds the state of the streaming SVD of a dictionary that is being generated.
+
+    Input Parameters:
+        num_samples:    Number of samples in each (uncompressed) dictionary entry
+        rank:           Number of singular vectors kept in the end (K)
+        max_rank:       Maximum size of the working basis (defaults to 2 * rank). A larger
+                        working basis loses less energy, but makes each stored entry larger
+                        until the dictionary is complete (see compact())
+        max_epochs:     Maximum number of times the working basis is compressed. Once it is
+                        reached, entries are simply projected onto the (full) working basis
+        tol:            An entry adds a new basis vector if the norm of what is left of it
+                        after projection is larger than tol times its own norm
+
+    Class Variables:
+        basis:          (max_rank, num_samples) working basis, the first num_used rows are orthonormal
+        gram:           (max_rank, max_rank) sum of the outer products of all coefficients (in the
+                        current basis)
+        transforms:     (max_epochs, max_rank, max_rank) transforms[e] @ c takes the coefficients c
+                        of an entry stored during epoch e to the current basis
+        stats:          [rank, num_used, total energy, lost energy, epoch, finalized]
+        sv:             Singular values (once finalized)
+        progress:       [rotated, done, journal start, journal length] state of finalize()
+        journal:        (finalize_block, max_rank) last block of coefficients written by finalize()
+    """
+
+
+    def __init__(self, num_samples, rank, max_rank=None, max_epochs=64, tol=1e-6):
+        if max_rank is None:
+            max_rank = 2 * rank
+
+        if (rank < 1) or (max_rank < rank):
+            raise ValueError(f"Error: Invalid SVD rank {rank} (max_rank {max_rank})")
+
+        if num_samples < max_rank:
+            raise ValueError(f"Error: SVD max_rank ({max_rank}) is larger than the number of samples ({num_samples})")
+
+        self.num_samples = num_samples
+        self.rank = rank
+        self.max_rank = max_rank
+        self.max_epochs = max_epochs
+        self.tol = tol
+
+        self.basis = np.zeros((max_rank, num_samples))
+        self.gram = np.zeros((max_rank, max_rank))
+        self.transforms = np.zeros((max_epochs, max_rank, max_rank))
+        self.transforms[0] = np.identity(max_rank)
+        self.stats = np.zeros(6)
+        self.stats[RANK] = rank
+        self.sv = np.zeros(max_rank)
+        self.progress = np.zeros(4)
+        self.journal = np.zeros((finalize_block, max_rank))
+
+
+    def get_channels(self):
+        """
+        Returns the channels needed in the dictionary while it is generated (see
+        dict_manip.init_dict() and compact()).
+        """
+        return {coeff_name: self.max_rank, epoch_name: 1}
+
+
+    def get_aux(self):
+        """
+        Returns the python dict {name: array} of the state that has to be saved along with
+        the entries. The arrays are updated in place, so this can be handed to DictWriter.aux.
+        """
+        return {work_basis_name: self.basis, gram_name: self.gram, transforms_name: self.transforms, stats_name: self.stats}
+
+
+    def get_aux_shapes(self):
+        """
+        Returns the shapes of the auxiliary arrays (see dict_manip.init_dict()).
+        """
+        aux = {key: np.shape(val) for key, val in self.get_aux().items()}
+        aux[basis_name] = (self.max_rank, self.num_samples)
+        aux[sv_name] = (self.max_rank,)
+        aux[progress_name] = np.shape(self.progress)
+        aux[journal_name] = np.shape(self.journal)
+
+        return aux
+
+
+    def load(self, name):
+        """
+        This method reloads the state saved in the dictionary name, in order to resume it.
+        """
+        reader = open_reader(name)
+        try:
+            if stats_name not in reader.aux_names():
+                raise ValueError(f"Error: {name} was not generated with a streaming SVD")
+
+            stats = reader.read_aux(stats_name)
+            if stats[FINALIZED] and (transforms_name not in reader.aux_names()):
+                # Finalized and compacted (see compact()), only the result is left
+                if stats[RANK] != self.rank:
+                    raise ValueError(f"Error: The SVD of {name} does not have rank {self.rank}")
+                self.stats[...] = stats
+                sv = reader.read_aux(sv_name)
+                self.sv[:len(sv)] = sv
+                return
+
+            if (np.shape(reader.read_aux(transforms_name)) != np.shape(self.transforms)) or (stats[RANK] != self.rank):
+                raise ValueError(f"Error: The SVD of {name} does not have rank {self.rank} (max_rank {self.max_rank}, max_epochs {self.max_epochs})")
+
+            self.basis[...] = reader.read_aux(work_basis_name)
+            self.gram[...] = reader.read_aux(gram_name)
+            self.transforms[...] = reader.read_aux(transforms_name)
+            self.stats[...] = stats
+            if progress_name in reader.aux_names():
+                self.progress[...] = reader.read_aux(progress_name)
+                self.journal[...] = reader.read_aux(journal_name)
+            if stats[FINALIZED] or self.progress[ROTATED]:
+                self.sv[...] = reader.read_aux(sv_name)
+        finally:
+            reader.close()
+
+
+    def add(self, entry):
+        """
+        This method projects one entry onto the working basis (growing it if needed) and updates
+        the running sums. Returns the python dict of channels to be stored for this entry.
+        """
+        entry = np.asarray(entry, dtype=np.float64)
+
+        if (self.stats[USED] == self.max_rank) and (self.stats[EPOCH] + 1 < self.max_epochs):
+            self.compress()
+
+        used = int(self.stats[USED])
+
+        coeffs = np.zeros(self.max_rank)
+        coeffs[:used] = self.basis[:used] @ entry
+        resid = entry - coeffs[:used] @ self.basis[:used]
+
+        # Second pass of Gram-Schmidt, to keep the basis orthonormal in finite precision
+        corr = self.basis[:used] @ resid
+        coeffs[:used] += corr
+        resid -= corr @ self.basis[:used]
+
+        r = np.linalg.norm(resid)
+        energy = entry @ entry
+
+        if (r > self.tol * np.sqrt(energy)) and (used < self.max_rank):
+            self.basis[used] = resid / r
+            coeffs[used] = r
+            self.stats[USED] += 1
+        else:
+            self.stats[LOST] += r**2
+
+        self.gram += np.outer(coeffs, coeffs)
+        self.stats[ENERGY] += energy
+
+        return {coeff_name: coeffs, epoch_name: self.stats[EPOCH]}
+
+
+    def rotate(self):
+        """
+        This method rotates the working basis (and everything expressed in it) into the singular
+        vectors of the entries seen so far, sorted by decreasing singular value. Returns the
+        eigenvalues of the Gram matrix (the squared singular values).
+        """
+        # eigh() sorts in ascending order, we want the largest first
+        eigvals, V = np.linalg.eigh(self.gram)
+        eigvals, V = np.clip(eigvals[::-1], 0, None), V[:, ::-1]
+
+        self.basis[...] = V.T @ self.basis
+        self.gram[...] = np.diag(eigvals)
+
+        epoch = int(self.stats[EPOCH])
+        self.transforms[:epoch + 1] = V.T @ self.transforms[:epoch + 1]
+
+        return eigvals
+
+
+    def compress(self):
+        """
+        This method compresses the (full) working basis down to its rank leading singular vectors
+        and starts a new epoch.
+        """
+        eigvals = self.rotate()
+
+        self.basis[self.rank:] = 0
+        self.gram[self.rank:, :] = 0
+        self.gram[:, self.rank:] = 0
+        self.stats[LOST] += np.sum(eigvals[self.rank:])
+
+        epoch = int(self.stats[EPOCH])
+        self.transforms[:epoch + 1, self.rank:, :] = 0
+        self.transforms[epoch + 1] = np.identity(self.max_rank)
+
+        self.stats[USED] = self.rank
+        self.stats[EPOCH] += 1
+
+
+    def finalize(self, writer):
+        """
+        This method is called once every entry has been added. It computes the singular vectors
+        and values of the dictionary, brings the coefficients held by writer to them (a block
+        at a time), and stores the basis and singular values. It can be called again after a
+        crash, and picks up where it stopped (see the top of this file). Returns the fraction
+        of the energy kept by the rank-K SVD.
+        """
+        if not self.stats[FINALIZED]:
+            if not self.progress[ROTATED]:
+                self.sv[...] = np.sqrt(self.rotate())
+                self.progress[ROTATED] = 1
+
+            # The rotated basis is saved along with the progress
+            writer.aux.update({basis_name: self.basis, sv_name: self.sv, progress_name: self.progress, journal_name: self.journal})
+            writer.write_aux()
+
+            for start, sl in block_slices(writer.shape, finalize_block):
+                if start < self.progress[DONE]:
+                    continue
+
+                block = writer.read_box(sl, coeff_name)
+                coeffs = block.reshape(-1, self.max_rank).astype(np.float64)
+                n = len(coeffs)
+
+                if (self.progress[JOURNAL_START] == start) and (self.progress[JOURNAL_LEN] == n):
+                    # We stopped while writing this block, the new coefficients were saved
+                    coeffs = self.journal[:n]
+                else:
+                    epochs = writer.read_box(sl, epoch_name).reshape(-1).astype(int)
+                    for e in np.unique(epochs):
+                        coeffs[epochs == e] = coeffs[epochs == e] @ self.transforms[e].T
+
+                    # Save the new coefficients before they replace the old ones
+                    self.journal[:n] = coeffs
+                    self.progress[[JOURNAL_START, JOURNAL_LEN]] = start, n
+                    writer.write_aux()
+
+                writer.write_box(sl, coeffs.reshape(block.shape), coeff_name)
+                self.progress[DONE] = start + n
+
+            self.stats[FINALIZED] = 1
+            writer.write_aux()
+
+        retention = self.get_retention()
+        print(f"SVD rank {self.rank}: {100 * retention:.4f}% of the energy retained")
+
+        return retention
+
+
+    def compact(self, name):
+        """
+        This method is called once the SVD is finalized and the dictionary name is closed. Only
+        the first rank coefficients of every entry (and the first rank basis vectors and singular
+        values) are kept, and the epochs, working basis, transforms and journal, which were only
+        needed to get there, are dropped (see dict_manip.trim_dict()). It can be called again
+        after a crash.
+        """
+        drop_aux = [work_basis_name, gram_name, transforms_name, progress_name, journal_name]
+
+        with open_reader(name) as r:
+            channels = r.get_channels()
+            aux = r.aux_names()
+            basis = r.read_aux(basis_name)
+            sv = r.read_aux(sv_name)
+
+        if (channels[coeff_name] > self.rank) or (epoch_name in channels) or any(key in aux for key in drop_aux):
+            trim_dict(name, {coeff_name: self.rank, epoch_name: 0}, drop_aux)
+
+        if len(basis) > self.rank:
+            add_aux(name, basis_name, basis[:self.rank])
+            add_aux(name, sv_name, sv[:self.rank])
+
+
+    def get_retention(self):
+        """
+        Returns the fraction of the energy of the dictionary kept by the rank-K SVD.
+        """
+        if self.stats[ENERGY] == 0:
+            return 1.0
+
+        return float(np.sum(self.sv[:self.rank]**2) / self.stats[ENERGY])
+
+
+
+
+def load_svd(name, rank=None):
+    """
+    This function reads the SVD of a dictionary generated with MRFSim.generate_dict(svd_rank=K).
+
+    Input Parameters:
+        name:           Path of the dictionary
+        rank:           Number of singular vectors to return (defaults to the K it was generated with)
+
+    Output Values:
+        basis:          (rank, num_samples) temporal basis, with orthonormal rows
+        coeffs:         (num_entries, rank) coefficients of every entry (C-order flat index),
+                        so that the entries are approximately coeffs @ basis
+        sv:             (rank,) singular values
+        retention:      Fraction of the energy of the dictionary kept by the returned rank
+    """
+    reader = open_reader(name)
+    try:
+        stats = reader.read_aux(stats_name)
+        if stats is None:
+            raise ValueError(f"Error: {name} was not generated with a streaming SVD")
+        if not stats[FINALIZED]:
+            raise ValueError(f"Error: The SVD of {name} has not been finalized (is it complete?)")
+
+        if rank is None:
+            rank = int(stats[RANK])
+        if rank > reader.get_channels()[coeff_name]:
+            raise ValueError(f"Error: {name} only stores the coefficients of a rank {reader.get_channels()[coeff_name]} SVD")
+
+        basis = reader.read_aux(basis_name)[:rank]
+        sv = reader.read_aux(sv_name)[:rank]
+        coeffs = reader.read_entries(np.arange(reader.num_entries), channel=coeff_name)[:, :rank]
+    finally:
+        reader.close()
+
+    retention = 1.0 if stats[ENERGY] == 0 else float(np.sum(sv**2) / stats[ENERGY])
+
+    return basis, coeffs, sv, retention
+
+
+def compute_svd(name, rank, block_size=4096):
+    """
+    This function computes the rank-K SVD of an existing (complete) dictionary and stores it
+    the same way MRFSim.generate_dict(svd_rank=K) does, so that it can be read with load_svd().
+    This takes two passes over the dictionary: one to accumulate the (num_samples, num_samples)
+    Gram matrix of the entries, and one to project them onto its leading eigenvectors.
+
+    Input Parameters:
+        name:           Path of the dictionary (either backend)
+        rank:           Number of singular vectors to keep (K)
+        block_size:     Number of entries processed at a time
+    """
+    with open_reader(name) as r:
+        if r.num_samples == 0:
+            raise ValueError(f"Error: {name} does not store the entries (see svd_only)")
+        if not r.is_complete():
+            raise ValueError(f"Error: Can't compute the SVD of {name}, not every entry has been simulated")
+        if rank > r.num_samples:
+            raise ValueError(f"Error: SVD rank ({rank}) is larger than the number of samples ({r.num_samples})")
+
+        gram = np.zeros((r.num_samples, r.num_samples))
+        for _, entries in r.iter_blocks(block_size):
+            entries = np.asarray(entries, dtype=np.float64)
+            gram += entries.T @ entries
+
+    # eigh() sorts in ascending order, we want the largest first
+    eigvals, V = np.linalg.eigh(gram)
+    eigvals, V = np.clip(eigvals[::-1], 0, None), V[:, ::-1]
+    basis = V[:, :rank].T
+
+    map_channel(name, coeff_name, rank, lambda entries: entries @ basis.T, block_size)
+
+    stats = np.zeros(6)
+    stats[[RANK, USED, ENERGY, FINALIZED]] = [rank, rank, np.trace(gram), 1]
+
+    add_aux(name, basis_name, basis)
+    add_aux(name, sv_name, np.sqrt(eigvals[:rank]))
+    add_aux(name, stats_name, stats)
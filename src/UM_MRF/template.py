@@ -0,0 +1,297 @@
+##############################################################################
+#   This file contains the SequenceTemplate and SimState classes, which      #
+#   split a prepared pulse sequence from the state of a simulation.          #
+#                                                                            #
+#   An MRFSim (and every SimObj in it) changes as it runs: the fields are    #
+#   recomputed for the current parameters, and the magnetization, the        #
+#   samples and the Params iterator are overwritten by every run. A          #
+#   SequenceTemplate is a read-only snapshot of the compiled sequence (see   #
+#   MRFSim.compile_sequence()): the fields, time steps, sample and crusher   #
+#   indices of every block. Its arrays are read-only views, so it is never   #
+#   written to, and any number of SimState objects (one per thread, say)     #
+#   can run against the same template at once without copying it. A         #
+#   SimState only holds what changes from one run to the next: the current  #
+#   parameter values, the starting magnetization and the samples.            #
+#                                                                            #
+#   The fields of a template are computed for the parameters of the MRFSim   #
+#   when it was built. The flip angle and B1 only scale the RF field (see    #
+#   SimObj.get_rf_scale()), so they can be anything at run time. The other   #
+#   parameters the fields depend on (e.g. BAT, see SimObj.get_depends())     #
+#   must be the ones of the template.                                        #
+##############################################################################
+
+import numpy as np
+from copy import copy
+from .Params import Params
+from .simulators.np_blochsim_ljn import np_blochsim_ljn_batch
+
+# Parameters that are the same for every entry of a dictionary (see Params.__init__())
+const_names = ("lam", "M0_f", "M0_s", "f", "T1_b")
+
+
+
+def read_only(arr):
+    """
+    Returns a read-only view of arr (no copy is made).
+    """
+    view = np.asarray(arr).view()
+    view.flags.writeable = False
+    return view
+
+
+
+def freeze_block(sim):
+    """
+    Returns a copy of the SimObj sim whose arrays are read-only views of the arrays of sim, so
+    that the copy shares its fields with sim but can't change them.
+    """
+    block = copy(sim)
+    for name, val in vars(sim).items():
+        if isinstance(val, np.ndarray):
+            setattr(block, name, read_only(val))
+
+    return block
+
+
+
+class SequenceTemplate:
+    """
+    This class is a read-only compiled pulse sequence (see the top of this file).
+
+    Input Parameters:
+        sim:        The MRFSim instance, set up and with its fields up to date for the current
+                    parameters of sim.params (see MRFSim.get_template())
+        M_start:    Starting magnetization of every run
+
+    Class Variables:
+        parts:          The compiled sequence (see MRFSim.compile_sequence()), with read-only
+                        arrays. The parts that are not fused hold a read-only copy of their
+                        block in "block"
+        blocks:         Read-only copies of every block (see freeze_block())
+        num_sim:        Number of blocks
+        num_samples:    Number of samples of a run
+        sample_offsets: Index in the samples of the first sample of each block
+        sample_times:   Times of the samples w.r. to the start of the sequence [ms]
+        point:          Values of the parameters (in the order of Params.axis_names) the fields
+                        were computed for
+        consts:         Python dict of the simulation constants of sim.params (see const_names)
+        field_vals:     Python dict of the parameters the fields depend on, other than the flip
+                        angle and B1, and their values
+        rf_refs:        (num_sim, ) factor of the RF field of each block (see get_rf_scales())
+    """
+
+
+    def __init__(self, sim, M_start):
+        p = sim.params
+        self.M_start = read_only(np.array(M_start, dtype=np.float64))
+
+        # Compiling points the blocks at the timeline (see MRFSim.get_timeline()), so they are
+        # copied after, and share their fields with the compiled sequence
+        parts = sim.compile_sequence()
+
+        self.blocks = [freeze_block(s) for s in sim.sims]
+        self.num_sim = sim.num_sim
+        self.num_samples = sim.num_samples
+        self.sample_offsets = read_only(sim.sample_offsets)
+        self.sample_times = read_only(sim.sample_times)
+
+        self.parts = []
+        for part in parts:
+            part = {key: read_only(val) if isinstance(val, np.ndarray) else val for key, val in part.items()}
+            if not part["fused"]:
+                part["block"] = self.blocks[part["start"]]
+            self.parts.append(part)
+
+        self.point = tuple(getattr(p, n) for n in Params.axis_names)
+        self.consts = {n: getattr(p, n) for n in const_names}
+
+        names = dict.fromkeys(n for s in sim.sims for dep in s.get_depends().values() for n in dep)
+        self.field_vals = {n: getattr(p, n) for n in names if n not in ("flip", "B1")}
+
+        self.flip, self.B1 = p.flip, p.B1
+        self.rf_refs = read_only(np.array([block.get_rf_scale(p.flip, p.B1) for block in self.blocks], dtype=np.float64))
+
+
+    def new_state(self, M_start=None):
+        """
+        Returns a new SimState that runs this template, starting at the parameters of the
+        template (see SimState).
+        """
+        return SimState(self, M_start)
+
+
+    def get_rf_scales(self, flips, B1s):
+        """
+        Returns the (K, num_sim) factors the RF field of each block has to be multiplied by for
+        each of the K flip angles and B1 scales given (see SimObj.get_rf_scale()).
+        """
+        flips = np.atleast_1d(np.asarray(flips, dtype=np.float64))
+        B1s = np.atleast_1d(np.asarray(B1s, dtype=np.float64))
+
+        rf_scales = np.zeros((len(flips), self.num_sim))
+        for i, (block, ref) in enumerate(zip(self.blocks, self.rf_refs)):
+            scale = block.get_rf_scale(flips, B1s)
+            if ref != 0:
+                rf_scales[:, i] = scale / ref
+            elif np.any(scale != 0):
+                raise ValueError(f"Error: The RF field of block {i} ({type(block).__name__}) is 0 in the template, so it can't be scaled. Build the template at a non-zero flip angle and B1")
+
+        return rf_scales
+
+
+    def check_vals(self, p):
+        """
+        This method raises an error if the parameters p (a Params or SimState object) do not
+        match the fields of the template (see the top of this file).
+        """
+        for name, val in self.field_vals.items():
+            if getattr(p, name) != val:
+                raise ValueError(f"Error: The sequence template was compiled for {name} = {val}, got {getattr(p, name)}")
+
+
+    def run(self, p, rf_scales, paired=False, M_start=None):
+        """
+        This method simulates the template for the parameters p and a batch of RF scales, with
+        one call of the batched LJN simulator per fused part (see simulators/np_blochsim_ljn.py).
+        Nothing is written to the template, so it can run several times at once.
+
+        Input Parameters:
+            p:          The Params or SimState object holding the parameter values
+            rf_scales:  (K, num_sim) factors of the RF field of each block (see get_rf_scales())
+            paired:     Also run the control version of the sequence (see
+                        MRFSim.simulate_paired())
+            M_start:    Optional starting magnetization (self.M_start by default)
+
+        Output Values:
+            The (K, num_samples) samples, or the label and the control samples if paired
+        """
+        self.check_vals(p)
+
+        rf_scales = np.asarray(rf_scales, dtype=np.float64)
+        K = len(rf_scales)
+
+        bolus = None
+        if paired:
+            # The control members of the batch see no bolus
+            rf_scales = np.concatenate([rf_scales, rf_scales])
+            bolus = np.repeat([1.0, 0.0], K)[:, None]
+
+        M = np.tile(self.M_start if M_start is None else M_start, (len(rf_scales), 1))
+        samples = np.zeros((len(rf_scales), self.num_samples))
+        for part in self.parts:
+            start, stop = part["start"], part["stop"]
+
+            if not part["fused"]:
+                block = part["block"]
+                s = None if bolus is None else bolus * block.s[None, :]
+                M_samples, M = block.run_ljn_batch(p, M, rf_scales[:, start], s)
+                if block.num_samples != 0:
+                    col = self.sample_offsets[start]
+                    samples[:, col:col + block.num_samples] = block.sample_batch(M_samples, p.CBV, s)
+                continue
+
+            s = part["s"] if bolus is None else bolus * part["s"][None, :]
+            rf = np.repeat(rf_scales[:, start:stop], part["block_lengths"], axis=1)
+            out_inds = np.append(part["sample_inds"], len(part["dts"]) - 1)
+
+            M_out = np_blochsim_ljn_batch(part["B"], s, M, part["dts"], rf, p.R1f_app, p.R2f_app, p.R1s_app, p.ks, p.kf, p.f, p.M0_f, p.M0_s,
+                                          out_inds, crusher_inds=part["crusher_inds"], absorp=part["absorp"], s_sat=part["s_sat"])
+            M = M_out[:, -1]
+
+            # See SimObj.sample()
+            vals = np.linalg.norm(M_out[:, :-1, 0:2], axis=2) * (1 - p.CBV) + np.atleast_2d(s)[:, part["sample_inds"]] * p.CBV
+            np.add.at(samples, (slice(None), part["sample_cols"]), vals * part["sample_weights"])
+
+        return (samples[:K], samples[K:]) if paired else samples
+
+
+
+class SimState:
+    """
+    This class holds the state of one simulation of a SequenceTemplate (see the top of this
+    file). It stands in for the Params object of the simulators, so it holds the current
+    parameter values under the same names.
+
+    Input Parameters:
+        template:   The SequenceTemplate to run
+        M_start:    Optional starting magnetization (the one of the template by default)
+
+    Class Variables:
+        template:   The SequenceTemplate
+        M_start:    Starting magnetization of every run
+        samples:    The (num_samples, ) samples of the last run (see run()), overwritten by the
+                    next one
+        CBV, ks, kf, T1_f, T2_f, T1_s, F, alpha, BAT, flip, B1:
+                    The current parameter values (see Params.axis_names)
+        R1f_app, R2f_app, R1s_app:
+                    The apparent relaxation rates (see calc_R_T_vals())
+        lam, M0_f, M0_s, f, T1_b:
+                    The simulation constants of the template (see const_names)
+    """
+
+
+    def __init__(self, template, M_start=None):
+        self.template = template
+        self.M_start = template.M_start if M_start is None else np.array(M_start, dtype=np.float64)
+        self.samples = np.zeros(template.num_samples)
+
+        for name, val in template.consts.items():
+            setattr(self, name, val)
+
+        self.set_point_vals(template.point)
+
+
+    def set_point_vals(self, point):
+        """
+        This method sets the current parameter values, given in the order of Params.axis_names
+        (see Params.set_point_vals()).
+        """
+        if len(point) != len(Params.axis_names):
+            raise ValueError(f"Error: Expected {len(Params.axis_names)} parameter values, got {len(point)}")
+
+        for name, val in zip(Params.axis_names, point):
+            setattr(self, name, val)
+
+        self.calc_R_T_vals()
+
+
+    def set_params(self, params):
+        """
+        This method copies the current parameter values of a Params object.
+        """
+        self.set_point_vals([getattr(params, n) for n in Params.axis_names])
+
+
+    def calc_R_T_vals(self):
+        """
+        Computes the apparent relaxation rates of the current parameters, the same way as
+        Params.calc_R_T_vals().
+        """
+        self.R1f_app = (self.F / self.lam) + (1 / self.T1_f)
+        self.R2f_app = (self.F / self.lam) + (1 / self.T2_f)
+        self.R1s_app = (1 / self.T1_s)
+
+
+    def run(self, paired=False):
+        """
+        This method simulates the template for the current parameter values, and returns the
+        (num_samples, ) samples (self.samples, overwritten by the next run), or the label and
+        control samples if paired (see MRFSim.simulate_paired()).
+        """
+        rf_scales = self.template.get_rf_scales(self.flip, self.B1)
+        if paired:
+            label, control = self.template.run(self, rf_scales, True, self.M_start)
+            return label[0], control[0]
+
+        self.samples[:] = self.template.run(self, rf_scales, False, self.M_start)[0]
+
+        return self.samples
+
+
+    def run_rf_batch(self, flips, B1s, paired=False):
+        """
+        This method simulates the template for the current parameter values and a batch of flip
+        angles and B1 scales at once, and returns the (K, num_samples) samples (or the label and
+        control samples if paired, see MRFSim.simulate_rf_batch()).
+        """
+        return self.template.run(self, self.template.get_rf_scales(flips, B1s), paired, self.M_start)
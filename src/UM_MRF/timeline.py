@@ -0,0 +1,96 @@
+##############################################################################
+#   This file contains the SequenceTimeline class, which holds the fields    #
+#   of a whole pulse sequence in contiguous arrays.                          #
+#                                                                            #
+#   Each block (SimObj) of an MRFSim keeps its own time grid, B(t), s(t)     #
+#   and M(t). Whole-sequence arrays (for plotting, or to be simulated in     #
+#   one go, see MRFSim.compile_sequence()) are built once, with one buffer   #
+#   per quantity, and each block is pointed at its slice of the buffers      #
+#   (a view, not a copy). The offsets of the blocks give the slice of any    #
+#   block in any of the buffers.                                             #
+#                                                                            #
+#   A timeline only describes the fields it was built from: MRFSim drops it  #
+#   whenever the blocks or their fields change (see MRFSim.get_timeline()).  #
+##############################################################################
+
+import numpy as np
+
+
+
+class SequenceTimeline:
+    """
+    This class holds the fields of every block of a pulse sequence in contiguous arrays (see
+    the top of this file).
+
+    Input Parameters:
+        sims:       Python list of the SimObj instances of the sequence, in order
+
+    Class Variables:
+        sims:       The blocks
+        offsets:    (num_sim + 1, ) index of the first timepoint of each block in the buffers,
+                    followed by the total number of timepoints
+        starts:     (num_sim, ) start time of each block w.r. to the sequence [ms]
+        time:       (n, ) time of every timepoint w.r. to the sequence [ms]
+        B:          (n, 3) effective B field [T]
+        s:          (n, ) arterial magnetization
+        M:          (n, 4) simulated magnetization (see gather_M())
+    """
+
+
+    def __init__(self, sims):
+        self.sims = list(sims)
+
+        lengths = np.array([sim.ntime for sim in self.sims], dtype=int)
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(int)
+        self.starts = np.concatenate([[0.0], np.cumsum([sim.T for sim in self.sims], dtype=np.float64)])[:len(self.sims)]
+
+        self.time = np.concatenate([np.zeros(0)] + [sim.time + t0 for sim, t0 in zip(self.sims, self.starts)])
+        self.B = np.concatenate([np.zeros((0, 3))] + [sim.B for sim in self.sims])
+        self.s = np.concatenate([np.zeros(0)] + [sim.s for sim in self.sims])
+        self.M = np.zeros((self.offsets[-1], 4))
+
+        # The blocks now see their slice of the buffers
+        for i, sim in enumerate(self.sims):
+            sim.B = self.block_view(self.B, i)
+            sim.s = self.block_view(self.s, i)
+
+
+    def block_view(self, arr, i):
+        """
+        Returns the slice (a view) of block i in the buffer arr.
+        """
+        return arr[self.offsets[i]:self.offsets[i + 1]]
+
+
+    def block_range(self, start, stop):
+        """
+        Returns the slice of the timepoints of the blocks start to stop - 1.
+        """
+        return slice(self.offsets[start], self.offsets[stop])
+
+
+    def get_sample_times(self):
+        """
+        Returns the times (w.r. to the sequence) of the samples of every block, with one time
+        per block that averages its samples (the first one, see SimObj.sample()).
+        """
+        times = [np.zeros(0)]
+        for sim, t0 in zip(self.sims, self.starts):
+            if np.size(sim.sample_times) != 0:
+                times.append((sim.sample_times[:1] if sim.avg_samples else sim.sample_times) + t0)
+
+        return np.concatenate(times)
+
+
+    def gather_M(self):
+        """
+        This method copies the magnetization of the last run of every block (see
+        MRFSim.run_all_np()) into self.M, points the blocks at their slice of it, and returns
+        it. The magnetization changes with every run, so it is gathered again every time.
+        """
+        for i, sim in enumerate(self.sims):
+            M = self.block_view(self.M, i)
+            M[...] = sim.M
+            sim.M = M
+
+        return self.M
@@ -0,0 +1,335 @@
+##############################################################################
+#   This file contains the pipeline that turns a whole 4-D image series     #
+#   (x, y, z, time) into parameter maps.                                    #
+#                                                                            #
+#   The series is memory-mapped (never loaded as a whole), the voxels of    #
+#   the mask are split into batches of batch_voxels, and the batches are    #
+#   matched (see match.py and ann.py) by a pool of worker processes, each   #
+#   of which reads its own voxels from the series. The maps are written to  #
+#   memory-mapped .npy files in out_dir as the batches come back:           #
+#       <axis>.npy      one (x, y, z) map per parameter axis                 #
+#                       (see Params.axis_names, e.g. T1_f.npy, BAT.npy)      #
+#       corr.npy        normalized correlation of the best match             #
+#       pd.npy          proton density                                       #
+#       index.npy       flat index of the best entry (-1 outside the mask)   #
+#                                                                            #
+#   Memory is bounded by the number of batches in flight (a few per worker) #
+#   whatever the size of the volume: the voxels of a batch are found in the  #
+#   mask when it is sent out (see VoxelBatches), they are never all listed.  #
+#                                                                            #
+#   Progress is kept in out_dir: progress.json describes the run (volume,   #
+#   mask, dictionary, matcher and its arguments) and done.npy is a bitmap   #
+#   of the batches that are done (one bit per batch), which is only set     #
+#   once the maps of a batch are flushed to disk, so an interrupted run     #
+#   picks up where it stopped when it is called again with the same inputs. #
+##############################################################################
+
+import numpy as np
+import json
+import os
+from hashlib import sha256
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from .dict_manip import *
+from .Params import Params
+
+
+progress_name = "progress.json"
+batch_done_name = "done.npy"
+index_map_name = "index"
+corr_map_name = "corr"
+pd_map_name = "pd"
+
+# Matchers that can be used, see the matcher input of map_volume()
+matcher_names = ("exact", "subspace", "coarse", "ann")
+
+# State of each worker process (see init_worker())
+worker = {}
+
+
+
+def open_series(series, shape=None, dtype=None):
+    """
+    This function memory-maps a 4-D image series (x, y, z, time).
+
+    Input Parameters:
+        series:         Path of a .npy file, or of a raw file (C-order) in which case shape and
+                        dtype must be given. An array (or memmap) is returned as it is
+        shape:          Shape of a raw series
+        dtype:          Data type of a raw series
+    """
+    if not isinstance(series, str):
+        arr = series
+    elif series.endswith(".npy"):
+        arr = np.load(series, mmap_mode="r")
+    else:
+        if (shape is None) or (dtype is None):
+            raise ValueError("Error: shape and dtype are needed to read a raw series")
+        arr = np.memmap(series, dtype=dtype, mode="r", shape=tuple(shape))
+
+    if np.ndim(arr) != 4:
+        raise ValueError(f"Error: Expected a 4-D (x, y, z, time) series, got shape {np.shape(arr)}")
+
+    return arr
+
+
+def make_matcher(matcher, dict_filename, matcher_args, read_only=False):
+    """
+    This function creates the matcher with the given name (see matcher_names). A read-only
+    matcher never writes to the dictionary (see match.DictMatcher).
+    """
+    from .match import DictMatcher, SubspaceMatcher, CoarseToFineMatcher
+    from .ann import ANNIndex
+
+    if matcher == "exact":
+        return DictMatcher(dict_filename, **matcher_args, read_only=read_only)
+    elif matcher == "subspace":
+        return SubspaceMatcher(dict_filename, **matcher_args, read_only=read_only)
+    elif matcher == "coarse":
+        return CoarseToFineMatcher(dict_filename, **matcher_args, read_only=read_only)
+    elif matcher == "ann":
+        return ANNIndex(dict_filename, **matcher_args)
+    else:
+        raise ValueError(f"Error: Unknown matcher '{matcher}' (expected one of {matcher_names})")
+
+
+def init_worker(series, shape, dtype, matcher, dict_filename, matcher_args, match_args, read_only=False):
+    """
+    This function sets up a worker process: it maps the series and creates its own matcher.
+    """
+    worker["series"] = open_series(series, shape, dtype)
+    worker["matcher"] = make_matcher(matcher, dict_filename, matcher_args, read_only)
+    worker["match_args"] = match_args
+
+
+def match_batch(batch, voxels):
+    """
+    This function matches the given (flat) voxels of the series, in a worker process.
+    Returns (batch, inds, corr, pd) with one value per voxel.
+    """
+    series = worker["series"]
+    signals = np.asarray(series.reshape(-1, series.shape[-1])[voxels])
+
+    inds, corr, pd = worker["matcher"].match(signals, **worker["match_args"])
+
+    return batch, inds[:, 0], corr[:, 0], pd[:, 0]
+
+
+class VoxelBatches:
+    """
+    This class splits the voxels of a mask (in C-order flat index) into consecutive batches of
+    batch_voxels, without listing them all: it only keeps the number of voxels of the mask
+    before every chunk of batch_voxels voxels of the volume, and finds the voxels of a batch in
+    the chunks that hold them.
+
+    Input Parameters:
+        mask:           Boolean (x, y, z) mask
+        batch_voxels:   Number of voxels per batch
+
+    Class Variables:
+        num_voxels:     Number of voxels in the mask
+        num_batches:    Number of batches
+    """
+
+
+    def __init__(self, mask, batch_voxels):
+        self.mask = mask.reshape(-1)
+        self.batch_voxels = batch_voxels
+
+        counts = [np.count_nonzero(self.mask[a:a + batch_voxels]) for a in range(0, len(self.mask), batch_voxels)]
+        self.starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.num_voxels = int(self.starts[-1])
+        self.num_batches = int(np.ceil(self.num_voxels / batch_voxels))
+
+
+    def __getitem__(self, batch):
+        """
+        Returns the flat indices of the voxels of the given batch.
+        """
+        lo = batch * self.batch_voxels
+        hi = min(lo + self.batch_voxels, self.num_voxels)
+
+        # Chunks holding the first and the last voxel of the batch
+        c0 = np.searchsorted(self.starts, lo, side="right") - 1
+        c1 = np.searchsorted(self.starts, hi - 1, side="right") - 1
+        vox = np.flatnonzero(self.mask[c0 * self.batch_voxels:(c1 + 1) * self.batch_voxels]) + c0 * self.batch_voxels
+
+        return vox[lo - self.starts[c0]:hi - self.starts[c0]]
+
+
+
+def get_setup(mask, batches, dict_filename, matcher, matcher_args, match_args):
+    """
+    This function returns the python dict describing a run of map_volume(), which has to be the
+    same to resume it: the volume, a digest of the mask, the batches, the hashes of the
+    dictionary (see dict_cache.py), the matcher and a digest of its arguments.
+    """
+    with open_reader(dict_filename) as r:
+        hashes = r.get_hashes()
+
+    args = json.dumps({"matcher_args": matcher_args, "match_args": match_args}, sort_keys=True, default=str)
+
+    return {"shape": [int(n) for n in np.shape(mask)], "num_voxels": batches.num_voxels, "batch_voxels": int(batches.batch_voxels),
+            "mask": sha256(np.packbits(mask)).hexdigest(), "dict_hashes": hashes, "matcher": matcher,
+            "args": sha256(args.encode()).hexdigest()}
+
+
+def read_progress(out_dir):
+    """
+    This function returns the progress of the maps in out_dir, or None if there are none yet.
+    """
+    path = os.path.join(out_dir, progress_name)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def write_progress(out_dir, progress):
+    """
+    This function rewrites the progress file atomically (see dict_memmap.write_sidecar()).
+    """
+    path = os.path.join(out_dir, progress_name)
+    with open(path + ".tmp", "w") as f:
+        json.dump(progress, f)
+    os.replace(path + ".tmp", path)
+
+
+def map_volume(series, dict_filename, out_dir, mask=None, matcher="exact", matcher_args={}, match_args={},
+               batch_voxels=4096, workers=1, shape=None, dtype=None):
+    """
+    This function matches every voxel of a 4-D image series against a dictionary and writes
+    parameter maps (see the top of this file). Calling it again after an interruption, with the
+    same inputs, only matches the batches that were not done.
+
+    Input Parameters:
+        series:         The (x, y, z, time) series, see open_series() (a path if workers > 1)
+        dict_filename:  Path of the dictionary (either backend)
+        out_dir:        Directory the maps are written to
+        mask:           Optional boolean (x, y, z) mask (or path of a .npy file) of the voxels to match
+        matcher:        Which matcher to use, one of matcher_names:
+                            "exact"     match.DictMatcher
+                            "subspace"  match.SubspaceMatcher
+                            "coarse"    match.CoarseToFineMatcher
+                            "ann"       ann.ANNIndex (the index must have been built)
+        matcher_args:   Python dict of keyword arguments of the matcher (e.g. {"rank": 16})
+        match_args:     Python dict of keyword arguments of its match() method (e.g. {"nprobe": 8})
+        batch_voxels:   Number of voxels per batch
+        workers:        Number of worker processes (1 runs everything in this process)
+        shape:          Shape of a raw series (see open_series())
+        dtype:          Data type of a raw series (see open_series())
+
+    Output Values:
+        Python dict mapping the name of every map to its (read-only) memmap
+    """
+    if (workers > 1) and not isinstance(series, str):
+        raise ValueError("Error: The series must be given as a path to be shared with worker processes")
+    if (workers > 1) and (matcher_args.get("sim") is not None):
+        raise ValueError("Error: Missing entries can't be simulated (sim) by worker processes, use workers=1")
+
+    arr = open_series(series, shape, dtype)
+    vol_shape = arr.shape[:3]
+    is_complex = np.iscomplexobj(arr)
+
+    if mask is None:
+        mask = np.ones(vol_shape, dtype=bool)
+    elif isinstance(mask, str):
+        mask = np.load(mask, mmap_mode="r")
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape != vol_shape:
+        raise ValueError(f"Error: The mask has shape {mask.shape}, the series has {vol_shape}")
+
+    batches = VoxelBatches(mask, batch_voxels)
+    num_batches = batches.num_batches
+
+    with open_reader(dict_filename) as r:
+        vals = r.get_vals()
+
+    # Outputs (reopened as they are if we are resuming)
+    os.makedirs(out_dir, exist_ok=True)
+    progress = read_progress(out_dir)
+    setup = get_setup(mask, batches, dict_filename, matcher, matcher_args, match_args)
+    if (progress is not None) and (progress["setup"] != setup):
+        raise ValueError(f"Error: {out_dir} holds maps of a different volume, mask, batch size, dictionary or matcher")
+    resuming = progress is not None
+    if not resuming:
+        progress = {"setup": setup}
+
+    map_dtypes = {n: np.float32 for n in Params.axis_names}
+    map_dtypes.update({index_map_name: np.int64, corr_map_name: np.float32, pd_map_name: np.complex64 if is_complex else np.float32})
+    maps = {}
+    for n, t in map_dtypes.items():
+        path = os.path.join(out_dir, n + ".npy")
+        if resuming:
+            maps[n] = np.load(path, mmap_mode="r+")
+        else:
+            maps[n] = np.lib.format.open_memmap(path, mode="w+", dtype=t, shape=vol_shape)
+            maps[n][...] = -1 if n == index_map_name else 0
+
+    # Bitmap of the batches that are done (see dict_manip.set_bits())
+    done_path = os.path.join(out_dir, batch_done_name)
+    if resuming:
+        done = np.load(done_path, mmap_mode="r+")
+    else:
+        done = np.lib.format.open_memmap(done_path, mode="w+", dtype=np.uint8, shape=(max(1, bitmap_size(num_batches)),))
+        done[...] = 0
+
+    if not resuming:
+        for m in maps.values():
+            m.flush()
+        done.flush()
+        # Written last, a run that stops before this starts over
+        write_progress(out_dir, progress)
+
+    is_done = np.unpackbits(done, count=num_batches, bitorder="little").astype(bool)
+    todo = np.flatnonzero(~is_done)
+    if resuming:
+        print(f"Resuming volume mapping ({np.count_nonzero(is_done)} of {num_batches} batches done)")
+
+    def store(batch, inds, corr, pd):
+        vox = batches[batch]
+        params = index_to_vals(vals, inds)
+        for a, n in zip(Params.axis_names, val_names):
+            maps[a].reshape(-1)[vox] = params[n]
+        maps[index_map_name].reshape(-1)[vox] = inds
+        maps[corr_map_name].reshape(-1)[vox] = corr
+        maps[pd_map_name].reshape(-1)[vox] = pd
+
+        # The maps go to disk before the batch is marked as done
+        for m in maps.values():
+            m.flush()
+        set_bits(done, [batch])
+        done.flush()
+
+    init_args = (series, shape, dtype, matcher, dict_filename, matcher_args, match_args)
+
+    if workers <= 1:
+        init_worker(*init_args)
+        for b in todo:
+            store(*match_batch(b, batches[b]))
+    elif len(todo) > 0:
+        # The dictionary can only be opened for writing by one process at a time, so whatever
+        # the matcher caches in it (norms, SVD) is written here first, and the workers only
+        # read it
+        make_matcher(matcher, dict_filename, matcher_args)
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=init_args + (True,)) as pool:
+            pending = set()
+            todo = iter(todo)
+            while True:
+                # Only a few batches in flight, so that memory does not grow with the volume
+                for b in todo:
+                    pending.add(pool.submit(match_batch, b, batches[b]))
+                    if len(pending) >= 2 * workers:
+                        break
+
+                if len(pending) == 0:
+                    break
+
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for f in finished:
+                    store(*f.result())
+
+    print(f"Volume mapping complete ({batches.num_voxels} voxels)")
+
+    return {n: np.load(os.path.join(out_dir, n + ".npy"), mmap_mode="r") for n in maps}
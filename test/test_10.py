@@ -0,0 +1,53 @@
+import numpy as np
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE
+from UM_MRF.dict_manip import open_reader
+from UM_MRF.svd import load_svd
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks the streaming SVD computed during dictionary generation. We generate
+the same dictionary twice, once in full and once storing only the SVD coefficients, and
+compare the energy retention that was reported with the one of the exact (offline) SVD
+and with the actual reconstruction error.
+"""
+
+FULL_FILE = "test_10_full.h5"
+SVD_FILE = "test_10_svd.h5"
+RANK = 4
+
+
+def make_sim():
+    T1_f = np.linspace(300, 2000, 6)
+    T2_f = np.linspace(40, 300, 5)
+    flip = np.linspace(5, 40, 4)
+
+    p = Params(T1_f, T2_f, T1_s, 0.0000, 0.0000, 0, lam, 0, 0, 0, BAT, 1, 1, flip)
+    ps = MRFSim(p)
+
+    ps.add_sim(DeadAir(200, 20))
+    ps.add_sim(GRE(2.5, 30, 8, 20, 1.0, sample_times=np.arange(30) * 20 + 10, avg_samples=False))
+    ps.setup()
+
+    return p, ps
+
+
+if __name__ == "__main__":
+    p, ps = make_sim()
+    ps.generate_dict(FULL_FILE)
+
+    p, ps = make_sim()
+    ps.generate_dict(SVD_FILE, svd_rank=RANK, svd_only=True)
+
+    with open_reader(FULL_FILE) as r:
+        full = r.read_entries(np.arange(r.num_entries))
+
+    basis, coeffs, sv, retention = load_svd(SVD_FILE)
+    exact_sv = np.linalg.svd(full, compute_uv=False)
+
+    print("Streaming retention:", retention)
+    print("Exact retention:    ", np.sum(exact_sv[:RANK]**2) / np.sum(exact_sv**2))
+    print("Reconstruction error:", np.linalg.norm(coeffs @ basis - full)**2 / np.linalg.norm(full)**2)
+    print("Basis is orthonormal:", np.allclose(basis @ basis.T, np.identity(RANK)))
@@ -0,0 +1,46 @@
+import numpy as np
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE, DictMatcher
+from UM_MRF.dict_manip import open_reader, T1f_name, T2f_name
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks the blocked dictionary matcher. We generate a small dictionary, build
+noiseless signals out of a few of its entries (with a random proton density), match them
+with blocks much smaller than the dictionary, and make sure that we get back the entries
+(and parameter values) we started from, as well as the proton densities.
+"""
+
+DICT_FILE = "test_11_dict.h5"
+
+
+if __name__ == "__main__":
+    T1_f = np.linspace(300, 2000, 6)
+    T2_f = np.linspace(40, 300, 5)
+    flip = np.linspace(5, 40, 4)
+
+    p = Params(T1_f, T2_f, T1_s, 0.0000, 0.0000, 0, lam, 0, 0, 0, BAT, 1, 1, flip)
+    ps = MRFSim(p)
+    ps.add_sim(DeadAir(200, 20))
+    ps.add_sim(GRE(2.5, 30, 8, 20, 1.0, sample_times=np.arange(30) * 20 + 10, avg_samples=False))
+    ps.setup()
+    ps.generate_dict(DICT_FILE)
+
+    rng = np.random.default_rng(0)
+    truth = rng.choice(p.get_num_combs(), size=(4, 5), replace=False)
+    pd = rng.uniform(0.5, 2, size=truth.shape)
+
+    with open_reader(DICT_FILE) as r:
+        signals = r.read_entries(truth.ravel()).reshape(truth.shape + (-1,)) * pd[..., None]
+
+    m = DictMatcher(DICT_FILE, block_size=16, batch_size=8)
+    inds, corr, pd_est = m.match(signals, k=2)
+    maps = m.get_maps(inds)
+
+    print("Found every entry:", np.array_equal(inds[..., 0], truth))
+    print("Correlations:", corr[..., 0].min(), ">=", corr[..., 1].max())
+    print("Proton densities match:", np.allclose(pd_est[..., 0], pd, rtol=1e-4))
+    print("T1 map:\n", maps[T1f_name])
+    print("T2 map:\n", maps[T2f_name])
@@ -0,0 +1,68 @@
+import numpy as np
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE
+from UM_MRF.dict_manip import open_reader, done_name
+import h5py
+import shutil
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks the batched simulation of flip angles and B1 scales. We generate the same
+small dictionary (with a B1 axis) entry by entry and with batch_rf=True, and make sure that
+the two are the same. Then we resume the batched dictionary after a crash that left the first
+flip angle of every point and a few entries of the second one done, and make sure that every
+missing entry is simulated.
+"""
+
+DICT_FILE = "test_12_dict.h5"
+BATCH_DICT_FILE = "test_12_batch_dict.h5"
+RESUME_DICT_FILE = "test_12_resume_dict.h5"
+
+
+def make_sim():
+    T1_f = np.linspace(300, 2000, 4)
+    T2_f = np.linspace(40, 300, 3)
+    flip = np.linspace(5, 40, 4)
+    B1 = np.array([0.8, 1.0, 1.2])
+
+    p = Params(T1_f, T2_f, T1_s, 0.0000, 0.0000, 0, lam, 0, 0, 0, BAT, 1, 1, flip, B1=B1)
+    ps = MRFSim(p)
+    ps.add_sim(DeadAir(200, 20))
+    ps.add_sim(GRE(2.5, 30, 8, 20, 1.0, sample_times=np.arange(30) * 20 + 10, avg_samples=False))
+    ps.setup()
+
+    return ps
+
+
+if __name__ == "__main__":
+    make_sim().generate_dict(DICT_FILE)
+    make_sim().generate_dict(BATCH_DICT_FILE, batch_rf=True)
+
+    with open_reader(DICT_FILE) as r:
+        shape = r.shape
+        entries = r.read_entries(np.arange(np.prod(shape)))
+    with open_reader(BATCH_DICT_FILE) as r:
+        batch_entries = r.read_entries(np.arange(np.prod(shape)))
+
+    print("Dictionary shape:", shape)
+    print("Largest difference:", np.max(np.abs(entries - batch_entries)))
+    print("Batched dictionary matches:", np.allclose(entries, batch_entries, rtol=1e-5, atol=1e-8))
+
+    # Only the first flip angle of every point, and 3 entries of the second one, are done
+    shutil.copy(BATCH_DICT_FILE, RESUME_DICT_FILE)
+    done = np.zeros(shape, dtype=bool)
+    done[..., 0, :] = True
+    done.reshape(-1, *shape[-2:])[:3, 1, 0] = True
+    with h5py.File(RESUME_DICT_FILE, "r+") as f:
+        f[done_name][...] = np.packbits(done.ravel(), bitorder="little")
+        f["dictionary"][...] = f["dictionary"][...] * done[..., None]
+
+    ps = make_sim()
+    ps.params.resume(RESUME_DICT_FILE)
+    ps.generate_dict(RESUME_DICT_FILE, batch_rf=True)
+
+    with open_reader(RESUME_DICT_FILE) as r:
+        print("Resumed dictionary complete:", r.is_complete())
+        print("Resumed dictionary matches:", np.allclose(r.read_entries(np.arange(np.prod(shape))), entries, rtol=1e-5, atol=1e-8))
@@ -0,0 +1,102 @@
+import numpy as np
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE
+from UM_MRF.dict_manip import open_reader
+from UM_MRF.simulators.np_blochsim_ljn import np_blochsim_ljn_batch
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test measures how dictionary generation scales with the number of threads (see
+MRFSim.run_threaded()). First, we check how much of the LJN simulator runs without the GIL,
+by running the same simulation on several threads at once, for a batch of 1 and of 64 RF
+scales. Then we generate the same dictionary with threads=None and with more and more threads
+(entry by entry and with batch_rf=True), make sure that the dictionaries are the same, and
+print the speedup over a single thread. The threads always run the fused kernel, so they are
+compared against both the default (unfused) and the fused dictionary generated without threads.
+"""
+
+THREADS = sorted({1, 2, 4, os.cpu_count() or 1})
+
+
+def make_sim():
+    T1_f = np.linspace(300, 2000, 8)
+    T2_f = np.linspace(40, 300, 6)
+    flip = np.linspace(5, 40, 4)
+    B1 = np.array([0.8, 1.0, 1.2])
+
+    p = Params(T1_f, T2_f, T1_s, 0.0000, 0.0000, 0, lam, 0, 0, 0, BAT, 1, 1, flip, B1=B1)
+    ps = MRFSim(p)
+    ps.add_sim(DeadAir(200, 20))
+    ps.add_sim(GRE(2.5, 30, 8, 20, 1.0, sample_times=np.arange(30) * 20 + 10, avg_samples=False))
+    ps.setup()
+
+    return ps
+
+
+def generate(threads, batch_rf, fused=True):
+    name = f"test_13_dict_{threads}_{int(batch_rf)}_{int(fused)}.h5"
+    ps = make_sim()
+
+    start = time.time()
+    ps.generate_dict(name, batch_rf=batch_rf, fused=fused, threads=threads)
+    elapsed = time.time() - start
+
+    with open_reader(name) as r:
+        entries = r.read_entries(np.arange(r.num_entries))
+
+    return elapsed, entries
+
+
+def kernel_speedup(threads, K):
+    """
+    Returns the time of threads simulations run one after the other, over the time of the
+    same simulations run on threads threads at once (1 if the simulator never releases the
+    GIL, threads if it always does).
+    """
+    ps = make_sim()
+    part = ps.get_template().parts[0]
+    p = ps.params
+    args = (part["B"], part["s"], np.tile([0.0, 0.0, 1.0, 1.0], (K, 1)), part["dts"], np.linspace(0.5, 1.5, K), p.R1f_app, p.R2f_app, p.R1s_app, p.ks, p.kf, p.f, p.M0_f, p.M0_s, part["sample_inds"])
+    kwargs = {"crusher_inds": part["crusher_inds"], "absorp": part["absorp"], "s_sat": part["s_sat"]}
+
+    def run(_):
+        return np_blochsim_ljn_batch(*args, **kwargs)
+
+    start = time.time()
+    for i in range(threads):
+        run(i)
+    serial = time.time() - start
+
+    with ThreadPoolExecutor(threads) as pool:
+        start = time.time()
+        list(pool.map(run, range(threads)))
+        parallel = time.time() - start
+
+    return serial / parallel
+
+
+if __name__ == "__main__":
+    print("CPUs:", os.cpu_count())
+
+    for K in (1, 64):
+        for threads in THREADS[1:]:
+            print(f"Simulator, batch of {K}, {threads} threads: {kernel_speedup(threads, K):.2f}x")
+
+    for batch_rf in (False, True):
+        # The default, block by block (batch_rf always runs fused)
+        default_time, default = generate(None, batch_rf, fused=False)
+        print(f"batch_rf={batch_rf}, no threads, default: {default_time:.2f} s")
+
+        base_time, base = generate(None, batch_rf)
+        print(f"batch_rf={batch_rf}, no threads, fused: {base_time:.2f} s, largest difference from the default {np.max(np.abs(base - default))}")
+
+        times = {}
+        for threads in THREADS:
+            times[threads], entries = generate(threads, batch_rf)
+            print(f"batch_rf={batch_rf}, {threads} threads: {times[threads]:.2f} s, speedup {times[1] / times[threads]:.2f}x, "
+                  f"largest difference {np.max(np.abs(entries - base))} (fused), {np.max(np.abs(entries - default))} (default)")
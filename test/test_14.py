@@ -0,0 +1,73 @@
+import numpy as np
+import shutil
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE, pCASL
+from UM_MRF.dict_manip import open_reader, dict_name, label_name, control_name
+from UM_MRF.dict_cache import DictCache
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks the dictionary cache (see dict_cache.py). We generate a dictionary with a
+cache directory, then generate it again under another name, which should simply copy it from
+the cache. Then we add a T1 value: the entries of the two values that are in the cache should
+be reused, and the result should be the same as a dictionary generated without the cache.
+Paired dictionaries (label and control, see MRFSim.generate_dict()) are checked the same way,
+including their label and control channels.
+"""
+
+CACHE_DIR = "test_14_cache"
+
+
+def make_sim(T1_f):
+    T1_f = np.array(T1_f)
+    F = np.array([0.005, 0.01])
+    BAT = np.array([300, 1300])
+    flip = np.array([10, 30])
+
+    p = Params(T1_f, 60, T1_s, 0.001, 0.001, F, lam, 0, 0, 0.02, BAT, 1, 0.1, flip)
+    ps = MRFSim(p)
+
+    ps.add_sim(DeadAir(300, 1.0))
+    ps.add_sim(pCASL(800, 1.0))
+    ps.add_sim(DeadAir(400, 1.0))
+    ps.add_sim(GRE(2.0, 10, 5, 10, 1.0, sample_times=np.arange(10) * 10 + 6, avg_samples=False))
+    ps.setup()
+
+    return ps
+
+
+def read_all(name, channels):
+    with open_reader(name) as r:
+        return [r.read_entries(np.arange(r.num_entries), c) for c in channels], r.is_complete()
+
+
+if __name__ == "__main__":
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+    for paired in (False, True):
+        suffix = "paired" if paired else "plain"
+        channels = [dict_name, label_name, control_name] if paired else [dict_name]
+
+        # First run fills the cache, the second one is a cache hit
+        make_sim([800, 1400]).generate_dict(f"test_14_{suffix}_a.h5", cache_dir=CACHE_DIR, paired=paired)
+        make_sim([800, 1400]).generate_dict(f"test_14_{suffix}_b.h5", cache_dir=CACHE_DIR, paired=paired)
+
+        first, _ = read_all(f"test_14_{suffix}_a.h5", channels)
+        hit, complete = read_all(f"test_14_{suffix}_b.h5", channels)
+        print(f"{suffix}: cache hit complete:", complete)
+        print(f"{suffix}: cache hit matches:", all(np.array_equal(a, b) for a, b in zip(first, hit)))
+
+        # A new T1 value in the middle, the other two come from the cache
+        make_sim([800, 1100, 1400]).generate_dict(f"test_14_{suffix}_grown.h5", cache_dir=CACHE_DIR, paired=paired)
+        make_sim([800, 1100, 1400]).generate_dict(f"test_14_{suffix}_ref.h5", paired=paired)
+
+        grown, complete = read_all(f"test_14_{suffix}_grown.h5", channels)
+        ref, _ = read_all(f"test_14_{suffix}_ref.h5", channels)
+        for c, a, b in zip(channels, grown, ref):
+            print(f"{suffix}: partial reuse, largest difference in {c}:", np.max(np.abs(a - b)))
+        print(f"{suffix}: partial reuse complete:", complete)
+        print(f"{suffix}: partial reuse matches:", all(np.allclose(a, b, rtol=1e-5, atol=1e-8) for a, b in zip(grown, ref)))
+
+    print("Cached dictionaries:", len(DictCache(CACHE_DIR).entries()))
@@ -0,0 +1,77 @@
+import numpy as np
+import os
+import shutil
+import h5py
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE
+from UM_MRF.dict_manip import open_reader, dict_name, done_name, flip_name, T1f_name
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks that a dictionary can be extended with new parameter values (see
+MRFSim.extend_dict()). We generate a small dictionary, extend it with a T1 value and a flip
+angle (with both backends), and compare it with the same dictionary generated in one go.
+Then we leave an extension half done by hand (the ".extending" file with some of its
+entries missing) and make sure that calling extend_dict() again finishes it and replaces the
+original.
+"""
+
+DICT_FILE = "test_15_dict.h5"
+MEMMAP_DICT = "test_15_memmap"
+FULL_FILE = "test_15_full.h5"
+
+
+def make_sim(T1_f, flip):
+    T1_f = np.array(T1_f)
+    T2_f = np.array([50, 100])
+    flip = np.array(flip)
+
+    p = Params(T1_f, T2_f, T1_s, 0.0000, 0.0000, 0, lam, 0, 0, 0, BAT, 1, 1, flip)
+    ps = MRFSim(p)
+
+    ps.add_sim(DeadAir(200, 20))
+    ps.add_sim(GRE(2.5, 5, 8, 40, 1.0, sample_times=np.arange(5) * 40 + 12, avg_samples=False))
+    ps.setup()
+
+    return ps
+
+
+def read_all(name):
+    with open_reader(name) as r:
+        return r.read_entries(np.arange(r.num_entries)), r.get_vals(), r.is_complete()
+
+
+if __name__ == "__main__":
+    shutil.rmtree(MEMMAP_DICT, ignore_errors=True)
+
+    make_sim([500, 750, 1000], [10, 15, 20]).generate_dict(FULL_FILE)
+    full, full_vals, _ = read_all(FULL_FILE)
+
+    for name, backend in ((DICT_FILE, "hdf5"), (MEMMAP_DICT, "memmap")):
+        make_sim([500, 1000], [10, 20]).generate_dict(name, backend=backend)
+        make_sim([1], [5]).extend_dict(name, T1_f=750, flip=15)
+
+        entries, vals, complete = read_all(name)
+        print(f"{backend}: T1 values", vals[T1f_name], "flip angles", vals[flip_name])
+        print(f"{backend}: extended dictionary complete:", complete)
+        print(f"{backend}: matches full regeneration:", np.allclose(entries, full, rtol=1e-5, atol=1e-8))
+        print(f"{backend}: no files left over:", not os.path.exists(name + ".extending") and not os.path.exists(name + ".old"))
+
+    # An extension that stopped half way: the original is there, and so is the ".extending"
+    # file with half of its entries
+    make_sim([500, 1000], [10, 20]).generate_dict(DICT_FILE)
+    shutil.copy(FULL_FILE, DICT_FILE + ".extending")
+    with h5py.File(DICT_FILE + ".extending", "r+") as d:
+        done = np.zeros(len(full), dtype=bool)
+        done[::2] = True
+        d[done_name][...] = np.packbits(done, bitorder="little")
+        d[dict_name][...] = d[dict_name][...] * done.reshape(d[dict_name].shape[:-1])[..., None]
+
+    make_sim([1], [5]).extend_dict(DICT_FILE, T1_f=750, flip=15)
+
+    entries, vals, complete = read_all(DICT_FILE)
+    print("Resumed extension complete:", complete)
+    print("Resumed extension matches full regeneration:", np.allclose(entries, full, rtol=1e-5, atol=1e-8))
+    print("Extending file replaced the original:", not os.path.exists(DICT_FILE + ".extending"))
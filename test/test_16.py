@@ -0,0 +1,58 @@
+import numpy as np
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE
+from UM_MRF.dict_manip import open_reader
+from UM_MRF.quantize import export_quantized, QuantizedDict, quantization_report
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks the quantized export of a dictionary (see quantize.py). We generate a small
+dictionary, export it as float16 and int8, and make sure that the dequantized entries are
+close to the normalized originals. Then we match noiseless signals made out of a few entries
+(with a random proton density) against the quantized dictionaries, and print how they
+compare with exact matching (see quantization_report()).
+"""
+
+DICT_FILE = "test_16_dict.h5"
+
+
+if __name__ == "__main__":
+    T1_f = np.linspace(300, 2000, 6)
+    T2_f = np.linspace(40, 300, 5)
+    flip = np.linspace(5, 40, 4)
+
+    p = Params(T1_f, T2_f, T1_s, 0.0000, 0.0000, 0, lam, 0, 0, 0, BAT, 1, 1, flip)
+    ps = MRFSim(p)
+    ps.add_sim(DeadAir(200, 20))
+    ps.add_sim(GRE(2.5, 30, 8, 20, 1.0, sample_times=np.arange(30) * 20 + 10, avg_samples=False))
+    ps.setup()
+    ps.generate_dict(DICT_FILE)
+
+    with open_reader(DICT_FILE) as r:
+        entries = r.read_entries(np.arange(r.num_entries)).astype(np.float64)
+    norm = np.linalg.norm(entries, axis=1)
+
+    rng = np.random.default_rng(0)
+    truth = rng.choice(len(entries), size=20, replace=False)
+    pd = rng.uniform(0.5, 2, size=truth.shape)
+    signals = entries[truth] * pd[:, None]
+
+    for quantization in ("float16", "int8"):
+        qname = f"test_16_{quantization}.h5"
+        export_quantized(DICT_FILE, qname, quantization, block_size=16)
+        q = QuantizedDict(qname)
+
+        dequant = q.entries.astype(np.float64) * q.scale[:, None]
+        print(f"{quantization}: bytes per entry", q.nbytes() // q.num_entries, "instead of", entries.shape[1] * 4)
+        print(f"{quantization}: norms kept:", np.allclose(q.norm, norm, rtol=1e-6))
+        print(f"{quantization}: largest error of the normalized entries:", np.max(np.abs(dequant - entries / norm[:, None])))
+
+        inds, corr, pd_est = q.match(signals, block_size=16)
+        exact_corr = np.abs(np.sum(entries[inds[:, 0]] * signals, axis=1)) / (norm[inds[:, 0]] * np.linalg.norm(signals, axis=1))
+        print(f"{quantization}: found {np.count_nonzero(inds[:, 0] == truth)} of {len(truth)} entries, "
+              f"worst exact correlation of a match {exact_corr.min():.6f}")
+        print(f"{quantization}: proton densities within 1%:", np.allclose(pd_est[inds[:, 0] == truth, 0], pd[inds[:, 0] == truth], rtol=1e-2))
+
+        quantization_report(DICT_FILE, qname, num_signals=100, block_size=16)
@@ -0,0 +1,70 @@
+import numpy as np
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE, DictMatcher
+from UM_MRF.match import CoarseToFineMatcher
+from UM_MRF.dict_manip import open_reader, init_dict
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks the coarse-to-fine matcher (see match.CoarseToFineMatcher). We generate a
+dictionary and print how often the hierarchical search disagrees with exhaustive matching
+(DictMatcher) on noisy signals, for a few strides (striding the flip angle too, which the
+default leaves alone, should miss many more matches). Then we start from an empty
+dictionary and let the matcher simulate the entries it needs: the matches should be the
+same as on the full dictionary, and the entries it simulated should be the full ones.
+"""
+
+DICT_FILE = "test_17_dict.h5"
+LAZY_FILE = "test_17_lazy.h5"
+
+
+def make_sim():
+    T1_f = np.linspace(300, 2000, 12)
+    T2_f = np.linspace(40, 300, 10)
+    flip = np.linspace(5, 40, 6)
+
+    p = Params(T1_f, T2_f, T1_s, 0.0000, 0.0000, 0, lam, 0, 0, 0, BAT, 1, 1, flip)
+    ps = MRFSim(p)
+    ps.add_sim(DeadAir(200, 20))
+    ps.add_sim(GRE(2.5, 30, 8, 20, 1.0, sample_times=np.arange(30) * 20 + 10, avg_samples=False))
+    ps.setup()
+
+    return p, ps
+
+
+if __name__ == "__main__":
+    p, ps = make_sim()
+    ps.generate_dict(DICT_FILE)
+
+    for stride in ({"T1_f": 2, "T2_f": 2}, {"T1_f": 3, "T2_f": 3}, 2):
+        m = CoarseToFineMatcher(DICT_FILE, stride=stride)
+        report = m.report(num_signals=300, noise=0.005)
+        print("Stride", stride, f"({len(m.coarse)} coarse entries): mismatch rate", report["mismatch"])
+
+    # Entries simulated on demand
+    p, ps = make_sim()
+    iter(p)
+    init_dict(LAZY_FILE, p, 30)
+
+    p, ps = make_sim()
+    lazy = CoarseToFineMatcher(LAZY_FILE, sim=ps)
+
+    rng = np.random.default_rng(0)
+    with open_reader(DICT_FILE) as r:
+        truth = rng.choice(r.num_entries, size=8, replace=False)
+        signals = r.read_entries(truth)
+
+    inds, corr, _ = lazy.match(signals)
+    full_inds, _, _ = CoarseToFineMatcher(DICT_FILE).match(signals)
+    exact_inds, _, _ = DictMatcher(DICT_FILE).match(signals)
+
+    with open_reader(LAZY_FILE) as r, open_reader(DICT_FILE) as full:
+        done = np.flatnonzero(r.done_mask())
+        print(f"Simulated {len(done)} of {r.num_entries} entries")
+        print("Simulated entries match the full dictionary:", np.allclose(r.read_entries(done), full.read_entries(done), rtol=1e-5, atol=1e-8))
+
+    print("Same matches as on the full dictionary:", np.array_equal(inds, full_inds))
+    print("Found every entry:", np.array_equal(inds[:, 0], truth), "(exhaustive:", np.array_equal(exact_inds[:, 0], truth), ")")
+    print("Correlations:", corr[:, 0])
@@ -0,0 +1,83 @@
+import numpy as np
+import os
+import shutil
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE
+from UM_MRF.dict_manip import open_reader
+from UM_MRF.volume import map_volume, batch_done_name, index_map_name, pd_map_name
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks the whole-volume mapping pipeline (see volume.py). We build a small 4-D
+series out of dictionary entries (with a random proton density), and map it with several
+worker processes, with the exact and the subspace matchers, on a dictionary that has none of
+their caches (norms, SVD) yet. The maps should be the same as with a single process. Then we
+undo the last batches by hand, as if the run had stopped, and make sure that calling
+map_volume() again only redoes those and ends up with the same maps.
+"""
+
+DICT_FILE = "test_18_dict.h5"
+SERIES_FILE = "test_18_series.npy"
+
+
+def make_dict():
+    T1_f = np.linspace(300, 2000, 6)
+    T2_f = np.linspace(40, 300, 5)
+    flip = np.linspace(5, 40, 4)
+
+    p = Params(T1_f, T2_f, T1_s, 0.0000, 0.0000, 0, lam, 0, 0, 0, BAT, 1, 1, flip)
+    ps = MRFSim(p)
+    ps.add_sim(DeadAir(200, 20))
+    ps.add_sim(GRE(2.5, 30, 8, 20, 1.0, sample_times=np.arange(30) * 20 + 10, avg_samples=False))
+    ps.setup()
+
+    # A new file every time, without the caches of the previous matcher
+    if os.path.exists(DICT_FILE):
+        os.remove(DICT_FILE)
+    ps.generate_dict(DICT_FILE)
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+
+    for matcher, matcher_args in (("exact", {}), ("subspace", {"rank": 6})):
+        make_dict()
+        with open_reader(DICT_FILE) as r:
+            entries = r.read_entries(np.arange(r.num_entries))
+
+        truth = rng.integers(0, len(entries), size=(6, 5, 4))
+        pd = rng.uniform(0.5, 2, size=truth.shape)
+        np.save(SERIES_FILE, (entries[truth] * pd[..., None]).astype(np.float32))
+        mask = rng.random(truth.shape) > 0.3
+
+        out = {}
+        for workers in (2, 1):
+            out_dir = f"test_18_{matcher}_{workers}"
+            shutil.rmtree(out_dir, ignore_errors=True)
+            maps = map_volume(SERIES_FILE, DICT_FILE, out_dir, mask=mask, matcher=matcher, matcher_args=matcher_args,
+                              batch_voxels=7, workers=workers)
+            out[workers] = {n: np.array(m) for n, m in maps.items()}
+
+        print(f"{matcher}: same maps with 2 workers and 1:", all(np.array_equal(out[2][n], out[1][n]) for n in out[1]))
+        print(f"{matcher}: voxels outside the mask left out:", np.all(out[2][index_map_name][~mask] == -1))
+        print(f"{matcher}: proton densities within 1%:", np.allclose(out[2][pd_map_name][mask], pd[mask], rtol=1e-2))
+
+        # Only the first 3 batches done, and their maps are all that is left
+        out_dir = f"test_18_{matcher}_2"
+        done = np.load(f"{out_dir}/{batch_done_name}", mmap_mode="r+")
+        bits = np.unpackbits(done, bitorder="little")
+        bits[3:] = 0
+        done[...] = np.packbits(bits, bitorder="little")
+        done.flush()
+        del done
+
+        index = np.load(f"{out_dir}/{index_map_name}.npy", mmap_mode="r+")
+        index.reshape(-1)[np.flatnonzero(mask)[21:]] = -1
+        index.flush()
+        del index
+
+        maps = map_volume(SERIES_FILE, DICT_FILE, out_dir, mask=mask, matcher=matcher, matcher_args=matcher_args,
+                          batch_voxels=7, workers=2)
+        print(f"{matcher}: resumed maps match:", all(np.array_equal(maps[n], out[1][n]) for n in out[1]))
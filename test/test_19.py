@@ -0,0 +1,62 @@
+import numpy as np
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE, DictMatcher
+from UM_MRF.dict_manip import open_reader, val_names, T1f_name, T2f_name
+from UM_MRF.refine import refine_matches
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks the sub-grid refinement of matches (see refine.py). We generate a dictionary,
+simulate signals at parameter values between its grid points (see MRFSim.simulate_vals()),
+match them, and make sure that refine_matches() gets closer to the true T1 and T2 than the
+grid values of the matches. The "parabola" model is only printed, it is not expected to do
+much better than the grid on a grid this coarse.
+"""
+
+DICT_FILE = "test_19_dict.h5"
+
+
+if __name__ == "__main__":
+    T1_f = np.linspace(300, 2000, 12)
+    T2_f = np.linspace(40, 300, 10)
+
+    p = Params(T1_f, T2_f, T1_s, 0.0000, 0.0000, 0, lam, 0, 0, 0, BAT, 1, 1, 20)
+    ps = MRFSim(p)
+    ps.add_sim(DeadAir(200, 20))
+    ps.add_sim(GRE(2.5, 30, 8, 20, 1.0, sample_times=np.arange(30) * 20 + 10, avg_samples=False))
+    ps.setup()
+    ps.generate_dict(DICT_FILE)
+
+    with open_reader(DICT_FILE) as r:
+        vals = r.get_vals()
+
+    # Off the grid, away from its edges
+    rng = np.random.default_rng(0)
+    true_T1 = rng.uniform(T1_f[1], T1_f[-2], size=10)
+    true_T2 = rng.uniform(T2_f[1], T2_f[-2], size=10)
+
+    signals = []
+    for t1, t2 in zip(true_T1, true_T2):
+        point = [vals[n][0] for n in val_names]
+        point[val_names.index(T1f_name)] = t1
+        point[val_names.index(T2f_name)] = t2
+        signals.append(ps.simulate_vals(point))
+    signals = np.array(signals)
+
+    m = DictMatcher(DICT_FILE)
+    inds, corr, _ = m.match(signals)
+    grid = m.get_maps(inds)
+
+    def rel_error(maps, n, truth):
+        return np.median(np.abs(maps[n] - truth) / truth)
+
+    print("Grid T1 error", rel_error(grid, T1f_name, true_T1), "T2 error", rel_error(grid, T2f_name, true_T2))
+    for model in ("quadratic", "parabola"):
+        refined = refine_matches(DICT_FILE, signals, inds, model=model)
+        e1, e2 = rel_error(refined, T1f_name, true_T1), rel_error(refined, T2f_name, true_T2)
+        print(f"{model}: T1 error", e1, "T2 error", e2)
+        if model == "quadratic":
+            print(f"{model}: closer than the grid:", e1 < rel_error(grid, T1f_name, true_T1) and e2 < rel_error(grid, T2f_name, true_T2))
+        print(f"{model}: correlation at least that of the match:", np.all(refined["corr"] >= corr[:, 0] - 1e-6))
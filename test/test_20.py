@@ -0,0 +1,45 @@
+import numpy as np
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE
+from UM_MRF.dict_manip import open_reader, points_name, T1f_name, T2f_name
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks adaptive dictionary generation (see adaptive.py). We start from a coarse
+T1/T2 grid and refine it where adjacent entries differ too much. The stored entries should be
+the simulations of their stored parameters (see MRFSim.simulate_vals()), the coarse grid
+should be kept, and the refinement should stay below the uniform grid of the same resolution.
+"""
+
+DICT_FILE = "test_20_dict.h5"
+
+
+if __name__ == "__main__":
+    T1_f = np.array([300, 1150, 2000])
+    T2_f = np.array([40, 170, 300])
+
+    p = Params(T1_f, T2_f, T1_s, 0.0000, 0.0000, 0, lam, 0, 0, 0, BAT, 1, 1, 20)
+    ps = MRFSim(p)
+    ps.add_sim(DeadAir(200, 20))
+    ps.add_sim(GRE(2.5, 30, 8, 20, 1.0, sample_times=np.arange(30) * 20 + 10, avg_samples=False))
+    ps.setup()
+    num = ps.generate_adaptive_dict(DICT_FILE, tol=0.002, max_level=3)
+
+    with open_reader(DICT_FILE) as r:
+        points = r.get_vals()[points_name]
+        entries = r.read_entries(np.arange(r.num_entries))
+        vals = r.get_vals()
+
+    # 3 values halved 3 times on each axis: 17 x 17 uniform grid
+    print("Refined, and fewer entries than the uniform grid:", 9 < num < 17 * 17)
+    print("Coarse grid kept:", all(np.any(np.all(points[:, [3, 4]] == [t1, t2], axis=1)) for t1 in T1_f for t2 in T2_f))
+    print("T1 values", vals[T1f_name])
+    print("T2 values", vals[T2f_name])
+
+    rng = np.random.default_rng(0)
+    check = rng.choice(num, size=min(num, 20), replace=False)
+    sims = np.array([ps.simulate_vals(points[i]) for i in check])
+    print("Largest difference with simulate_vals():", np.max(np.abs(sims - entries[check])))
+    print("Entries match simulate_vals():", np.allclose(sims, entries[check], rtol=1e-5, atol=1e-8))
@@ -0,0 +1,69 @@
+import numpy as np
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE
+from UM_MRF.dict_manip import open_reader, points_name, val_names
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks constrained grids (see Params.add_constraint() and Params.set_mask()). We
+generate a dictionary with T2 < T1 / 5 and a mask that leaves out one flip angle for the
+shortest T1, and the same grid without any constraint. The constrained dictionary should
+only hold the valid points, and its entries should be those of the dense dictionary at the
+same parameters, and the simulations of these parameters (see MRFSim.simulate_vals()).
+"""
+
+DICT_FILE = "test_21_dict.h5"
+DENSE_FILE = "test_21_dense.h5"
+
+
+def make_sim():
+    T1_f = np.linspace(300, 2000, 6)
+    T2_f = np.linspace(40, 300, 5)
+    flip = np.linspace(5, 40, 4)
+
+    p = Params(T1_f, T2_f, T1_s, 0.0000, 0.0000, 0, lam, 0, 0, 0, BAT, 1, 1, flip)
+    ps = MRFSim(p)
+    ps.add_sim(DeadAir(200, 20))
+    ps.add_sim(GRE(2.5, 30, 8, 20, 1.0, sample_times=np.arange(30) * 20 + 10, avg_samples=False))
+    ps.setup()
+
+    return p, ps
+
+
+if __name__ == "__main__":
+    p, ps = make_sim()
+    ps.generate_dict(DENSE_FILE)
+    with open_reader(DENSE_FILE) as r:
+        dense = r.read_entries(np.arange(r.num_entries))
+        dense_vals = r.get_vals()
+
+    p, ps = make_sim()
+    p.add_constraint(lambda T1_f, T2_f, **others: T2_f * 5 < T1_f)
+    mask = np.ones(p.get_shape(), dtype=bool)
+    mask[:, :, :, 0, :, :, :, :, :, 1] = False
+    p.set_mask(mask)
+    ps.setup()
+    ps.generate_dict(DICT_FILE)
+
+    with open_reader(DICT_FILE) as r:
+        entries = r.read_entries(np.arange(r.num_entries))
+        points = r.get_vals()[points_name]
+        complete = r.is_complete()
+
+    # Every point of the dense grid, in the order of its entries
+    grid = np.stack([g.ravel() for g in np.meshgrid(*[dense_vals[n] for n in val_names], indexing="ij")], axis=1)
+    valid = (grid[:, 4] * 5 < grid[:, 3]) & ~((grid[:, 3] == grid[:, 3].min()) & (grid[:, 9] == np.unique(grid[:, 9])[1]))
+
+    print("Constrained dictionary complete:", complete)
+    print(f"Entries: {len(entries)} of {len(dense)}, expected {np.count_nonzero(valid)}")
+    print("Only the valid points are stored:", set(map(tuple, points)) == set(map(tuple, grid[valid])))
+
+    lookup = {tuple(g): i for i, g in enumerate(grid)}
+    same = dense[[lookup[tuple(q)] for q in points]]
+    print("Entries match the dense dictionary:", np.allclose(entries, same, rtol=1e-5, atol=1e-8))
+
+    check = np.random.default_rng(0).choice(len(points), size=10, replace=False)
+    sims = np.array([ps.simulate_vals(points[i]) for i in check])
+    print("Entries match simulate_vals():", np.allclose(sims, entries[check], rtol=1e-5, atol=1e-8))
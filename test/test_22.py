@@ -0,0 +1,61 @@
+import numpy as np
+from test_globals import *
+
+from UM_MRF import MRFSim, PointSet, DeadAir, GRE
+from UM_MRF.dict_manip import open_reader, points_name
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks dictionaries generated from a PointSet (see pointset.py). We generate one
+from explicit points (a few shared flip angles, random T1 and T2) and one from Latin
+hypercube samples. The stored points should be the given ones, in the order of the PointSet,
+and every entry should be the simulation of its point (see MRFSim.simulate_vals()).
+"""
+
+DICT_FILE = "test_22_dict.h5"
+LHS_FILE = "test_22_lhs.h5"
+
+
+def make_sim(p):
+    ps = MRFSim(p)
+    ps.add_sim(DeadAir(200, 20))
+    ps.add_sim(GRE(2.5, 30, 8, 20, 1.0, sample_times=np.arange(30) * 20 + 10, avg_samples=False))
+    ps.setup()
+
+    return ps
+
+
+def check(name, p, ps):
+    with open_reader(name) as r:
+        entries = r.read_entries(np.arange(r.num_entries))
+        points = r.get_vals()[points_name]
+        complete = r.is_complete()
+
+    print(f"{name}: complete:", complete, f"({len(entries)} entries)")
+    print(f"{name}: points stored in the PointSet order:", np.array_equal(points, p.points))
+
+    sims = np.array([ps.simulate_vals(q) for q in points])
+    print(f"{name}: largest difference with simulate_vals():", np.max(np.abs(sims - entries)))
+    print(f"{name}: entries match simulate_vals():", np.allclose(sims, entries, rtol=1e-5, atol=1e-8))
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    n = 24
+    points = {"T1_f": rng.uniform(300, 2000, n), "T2_f": rng.uniform(40, 300, n), "T1_s": T1_s, "ks": 0, "kf": 0,
+              "F": 0, "CBV": 0, "BAT": BAT, "alpha": 0.86, "flip": rng.choice([10, 20, 30], n)}
+
+    p = PointSet(points, lam, 0, 0, 1, 1)
+    ps = make_sim(p)
+    ps.generate_dict(DICT_FILE)
+    print("Given points kept:", np.array_equal(p.points[np.argsort(p.order)], PointSet.to_table(points)))
+    check(DICT_FILE, p, ps)
+
+    ranges = {"T1_f": (300, 2000), "T2_f": (40, 300), "flip": (5, 40), "T1_s": T1_s, "ks": 0, "kf": 0,
+              "F": 0, "CBV": 0, "BAT": BAT, "alpha": 0.86}
+    p = PointSet.latin_hypercube(ranges, 20, lam, 0, 0, 1, 1, levels={"flip": 4}, seed=0)
+    ps = make_sim(p)
+    ps.generate_dict(LHS_FILE)
+    print("Latin hypercube flip angles:", np.unique(p.points[:, 9]))
+    check(LHS_FILE, p, ps)
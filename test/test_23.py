@@ -0,0 +1,65 @@
+import numpy as np
+import shutil
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE, pCASL
+from UM_MRF.dict_manip import open_reader, dict_name, label_name, control_name
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks paired dictionaries (see MRFSim.generate_dict(), paired=True), which
+simulate the label and control experiments of an ASL sequence together. We generate the label
+and the control dictionaries separately (see MRFSim.set_control()), then the paired one with
+both backends, with and without batched flip angles (batch_rf). Its label and control channels
+should be the two separate dictionaries, and its entries their difference.
+"""
+
+LABEL_FILE = "test_23_label.h5"
+CONTROL_FILE = "test_23_control.h5"
+
+
+def make_sim(control=False):
+    T1_f = np.array([800, 1400])
+    F = np.array([0.005, 0.01])
+    BAT = np.array([300, 1300])
+    flip = np.array([10, 30])
+
+    p = Params(T1_f, 60, T1_s, 0.001, 0.001, F, lam, 0, 0, 0.02, BAT, 1, 0.1, flip)
+    ps = MRFSim(p)
+
+    ps.add_sim(DeadAir(300, 1.0))
+    ps.add_sim(pCASL(800, 1.0))
+    ps.add_sim(DeadAir(400, 1.0))
+    ps.add_sim(GRE(2.0, 10, 5, 10, 1.0, sample_times=np.arange(10) * 10 + 6, avg_samples=False))
+    if control:
+        ps.set_control()
+    ps.setup()
+
+    return ps
+
+
+def read_all(name, channel=dict_name):
+    with open_reader(name) as r:
+        return r.read_entries(np.arange(r.num_entries), channel)
+
+
+if __name__ == "__main__":
+    make_sim().generate_dict(LABEL_FILE)
+    make_sim(control=True).generate_dict(CONTROL_FILE)
+    label = read_all(LABEL_FILE)
+    control = read_all(CONTROL_FILE)
+    print("Label and control differ:", np.max(np.abs(label - control)) > 0)
+
+    for backend in ("hdf5", "memmap"):
+        for batch_rf in (False, True):
+            name = f"test_23_paired_{int(batch_rf)}" + (".h5" if backend == "hdf5" else "")
+            shutil.rmtree(name, ignore_errors=True)
+            make_sim().generate_dict(name, paired=True, backend=backend, batch_rf=batch_rf)
+
+            with open_reader(name) as r:
+                complete = r.is_complete()
+            same = [np.allclose(read_all(name, label_name), label, rtol=1e-5, atol=1e-8),
+                    np.allclose(read_all(name, control_name), control, rtol=1e-5, atol=1e-8),
+                    np.allclose(read_all(name), label - control, rtol=1e-5, atol=1e-8)]
+            print(f"{backend}, batch_rf={batch_rf}: complete:", complete, "label, control, difference match:", same)
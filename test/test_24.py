@@ -0,0 +1,80 @@
+import numpy as np
+from itertools import product
+from concurrent.futures import ThreadPoolExecutor
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE, pCASL
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks sequence templates (see template.py). We build the template of an ASL
+sequence, and run every grid point that shares the parameters its fields depend on (the other
+T1, flip angles and B1 scales, see SequenceTemplate.field_vals) on SimState objects, one after
+the other and from several threads at once. The samples should be those of
+MRFSim.simulate_point(). A state with another BAT should be refused, and the arrays of the
+template should be read-only.
+"""
+
+
+def make_sim():
+    T1_f = np.array([800, 1400])
+    F = np.array([0.005, 0.01])
+    BAT = np.array([300, 1300])
+    flip = np.array([0, 10, 30])
+    B1 = np.array([0.8, 1.0, 1.15])
+
+    p = Params(T1_f, 60, T1_s, 0.001, 0.001, F, lam, 0, 0, 0.02, BAT, 1, 0.1, flip, B1=B1)
+    ps = MRFSim(p)
+
+    ps.add_sim(DeadAir(300, 1.0))
+    ps.add_sim(pCASL(800, 1.0))
+    ps.add_sim(DeadAir(400, 1.0))
+    ps.add_sim(GRE(2.0, 10, 5, 10, 1.0, sample_times=np.arange(10) * 10 + 6, avg_samples=False))
+    ps.setup()
+
+    return p, ps
+
+
+if __name__ == "__main__":
+    p, ps = make_sim()
+    shape = p.get_shape()
+    bat = Params.axis_names.index("BAT")
+
+    # The RF field is scaled from the one of the template, so not at a flip angle of 0
+    p.set_point((0,) * (len(shape) - 2) + (2, 1))
+    tpl = ps.get_template()
+
+    print("Fields depend on", tpl.field_vals)
+    inds, points = [], []
+    for i in product(*[range(n) for n in shape]):
+        point = [getattr(p, n + "_vals")[j] for n, j in zip(Params.axis_names, i)]
+        named = dict(zip(Params.axis_names, point))
+        if all(named.get(n, v) == v for n, v in tpl.field_vals.items()):
+            inds.append(i)
+            points.append(point)
+
+    refs = np.array([ps.simulate_point(i) for i in inds])
+
+    def run(point):
+        st = tpl.new_state()
+        st.set_point_vals(point)
+        return st.run().copy()
+
+    serial = np.array([run(q) for q in points])
+    with ThreadPoolExecutor(4) as ex:
+        threaded = np.array(list(ex.map(run, points)))
+
+    print(f"{len(inds)} points, largest difference with simulate_point():", np.max(np.abs(serial - refs)))
+    print("States match simulate_point():", np.allclose(serial, refs, rtol=1e-5, atol=1e-8))
+    print("Threads match:", np.array_equal(threaded, serial))
+
+    other = list(points[0])
+    other[bat] = p.BAT_vals[1]
+    try:
+        run(other)
+        print("Another BAT refused: False")
+    except ValueError as e:
+        print("Another BAT refused: True,", e)
+
+    print("Template arrays read-only:", not any(v.flags.writeable for part in tpl.parts for v in part.values() if isinstance(v, np.ndarray)))
@@ -0,0 +1,86 @@
+import numpy as np
+import os
+import pickle
+import multiprocessing as mp
+from itertools import product
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE, pCASL, share_template, attach_template
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks the sharing of sequence templates between worker processes (see shared.py).
+We share the template of an ASL sequence, attach it in the workers of a process pool (forked
+and spawned), and run grid points there. The samples should be those of
+MRFSim.simulate_point(), the template in the workers should be read-only views of the shared
+file, the handle should be much smaller than the pickled template, and the file should be
+removed at the end.
+"""
+
+TEMPLATE = None
+
+
+def init_worker(handle):
+    global TEMPLATE
+    TEMPLATE = attach_template(handle)
+
+
+def run_worker(point):
+    st = TEMPLATE.new_state()
+    st.set_point_vals(point)
+    arr = TEMPLATE.parts[0]["B"]
+    return st.run().copy(), isinstance(arr.base, np.memmap) and not arr.flags.writeable
+
+
+def make_sim():
+    T1_f = np.array([800, 1400])
+    F = np.array([0.005, 0.01])
+    BAT = np.array([300, 1300])
+    flip = np.array([10, 30])
+    B1 = np.array([0.8, 1.0, 1.15])
+
+    p = Params(T1_f, 60, T1_s, 0.001, 0.001, F, lam, 0, 0, 0.02, BAT, 1, 0.1, flip, B1=B1)
+    ps = MRFSim(p)
+
+    ps.add_sim(DeadAir(300, 1.0))
+    ps.add_sim(pCASL(800, 1.0))
+    ps.add_sim(DeadAir(400, 1.0))
+    ps.add_sim(GRE(2.0, 10, 5, 10, 1.0, sample_times=np.arange(10) * 10 + 6, avg_samples=False))
+    ps.setup()
+
+    return p, ps
+
+
+if __name__ == "__main__":
+    p, ps = make_sim()
+    shape = p.get_shape()
+    p.set_point((0,) * len(shape))
+    tpl = ps.get_template()
+
+    # The grid points the template can run (see SequenceTemplate.field_vals)
+    inds, points = [], []
+    for i in product(*[range(n) for n in shape]):
+        point = [getattr(p, n + "_vals")[j] for n, j in zip(Params.axis_names, i)]
+        named = dict(zip(Params.axis_names, point))
+        if all(named.get(n, v) == v for n, v in tpl.field_vals.items()):
+            inds.append(i)
+            points.append(point)
+
+    refs = np.array([ps.simulate_point(i) for i in inds])
+
+    with share_template(tpl) as shared:
+        handle = shared.get_handle()
+        path = shared.path
+        print("Pickled template", len(pickle.dumps(tpl)), "bytes, handle", len(pickle.dumps(handle)), "bytes")
+
+        for method in ("fork", "spawn"):
+            with mp.get_context(method).Pool(3, initializer=init_worker, initargs=(handle,)) as pool:
+                out = pool.map(run_worker, points)
+
+            samples = np.array([o[0] for o in out])
+            print(f"{method}: {len(points)} points, largest difference with simulate_point():", np.max(np.abs(samples - refs)))
+            print(f"{method}: workers match simulate_point():", np.allclose(samples, refs, rtol=1e-5, atol=1e-8))
+            print(f"{method}: read-only views of the shared file:", all(o[1] for o in out))
+
+    print("Shared file removed:", not os.path.exists(path))
@@ -0,0 +1,56 @@
+import numpy as np
+import h5py
+from test_globals import *
+
+from UM_MRF import MRFSim, Params, DeadAir, GRE
+from UM_MRF.dict_manip import dict_name, done_name, read_done
+import UM_MRF
+print(UM_MRF.__file__)
+
+"""
+This test checks that a dictionary can be resumed after a crash, even if the entries
+that are missing were not the last ones to be simulated. We generate a small dictionary,
+erase a few entries (and their completion bits) by hand, resume, and make sure that we
+end up with the same dictionary as the first time around.
+"""
+
+DICT_FILE = "test_9_dict.h5"
+
+
+def make_sim():
+    T1_f = np.linspace(300, 2000, 3)
+    T2_f = np.linspace(50, 300, 3)
+    flip = np.linspace(5, 25, 2)
+
+    p = Params(T1_f, T2_f, T1_s, 0.0000, 0.0000, 0, lam, 0, 0, 0, BAT, 1, 1, flip)
+    ps = MRFSim(p)
+
+    ps.add_sim(DeadAir(500, 50))
+    ps.add_sim(GRE(2.5, 5, 8, 40, 0.5, sample_times=np.arange(5) * 40 + 12.5, avg_samples=False))
+    ps.setup()
+
+    return p, ps
+
+
+if __name__ == "__main__":
+    p, ps = make_sim()
+    ps.generate_dict(DICT_FILE)
+
+    with h5py.File(DICT_FILE, "r+") as d:
+        reference = d[dict_name][:]
+        done = read_done(d, p.get_num_combs())
+
+        # "Crash" in the middle of a few entries spread accross the dictionary
+        lost = np.array([1, 7, 12])
+        for i in lost:
+            d[dict_name][np.unravel_index(i, p.get_shape())] = 0.0
+        done[lost] = False
+        d[done_name][:] = np.packbits(done, bitorder="little")
+
+    p, ps = make_sim()
+    p.resume(DICT_FILE)
+    ps.generate_dict(DICT_FILE)
+
+    with h5py.File(DICT_FILE, "r") as d:
+        print("All entries done:", np.all(read_done(d, p.get_num_combs())))
+        print("Matches original:", np.allclose(d[dict_name][:], reference))